@@ -25,6 +25,10 @@ from ion.agents.alerts.alerts import *
 
 class AgentAlertManager(object):
     """
+    Alerts are indexed by what triggers them: stream value alerts by
+    (stream_name, value_id), other stream alerts by stream_name, state and
+    command alerts apart. An evaluation only visits the alerts it can affect,
+    and the aggregate status is only recomputed when some alert status changed.
     """
     def __init__(self, agent):
         self._agent = agent
@@ -35,17 +39,110 @@ class AgentAlertManager(object):
         for aggregate_type in AggregateStatusType._str_map.keys():
             agent.aparam_aggstatus[aggregate_type] = DeviceStatusType.STATUS_UNKNOWN
         agent.aparam_set_aggstatus = self.aparam_set_aggstatus
-    
+
+        self._indexed = None        # (alerts list, length) the index was built for
+        self._value_alerts = {}     # (stream_name, value_id) -> alerts
+        self._stream_alerts = {}    # stream_name -> alerts
+        self._state_alerts = []     # alerts on agent state and command errors
+        self._other_alerts = []     # alerts evaluated on every call
+        self._aggstatus = None      # aggregate status of the alert statuses at the last recompute
+        self._watched_statuses = None
+
+    def _index_alerts(self):
+        """
+        (Re)builds the alert index when the agent's alert list has changed.
+        """
+        alerts = self._agent.aparam_alerts
+        if self._indexed and self._indexed[0] is alerts and self._indexed[1] == len(alerts):
+            return
+
+        self._value_alerts = {}
+        self._stream_alerts = {}
+        self._state_alerts = []
+        self._other_alerts = []
+        for a in alerts:
+            if isinstance(a, StreamValueAlert):
+                self._value_alerts.setdefault((a._stream_name, a._value_id), []).append(a)
+            elif isinstance(a, StreamAlert):
+                self._stream_alerts.setdefault(a._stream_name, []).append(a)
+            elif isinstance(a, (StateAlert, CommandErrorAlert)):
+                self._state_alerts.append(a)
+            else:
+                self._other_alerts.append(a)
+        self._indexed = (alerts, len(alerts))
+        self._aggstatus = None
+
+    def _watched_alerts(self):
+        """
+        Alerts whose status can also change outside of an evaluation (e.g. LateDataAlert).
+        """
+        return [a for alerts in self._stream_alerts.itervalues() for a in alerts] + self._other_alerts
+
     def process_alerts(self, **kwargs):
 
         log.debug("process_alerts: aparam_alerts=%s; kwargs=%s", self._agent.aparam_alerts, kwargs)
 
-        for a in self._agent.aparam_alerts:
+        self._index_alerts()
+        alerts = list(self._other_alerts)
+        stream_name = kwargs.get('stream_name', None)
+        if stream_name is not None:
+            alerts.extend(self._stream_alerts.get(stream_name, ()))
+            alerts.extend(self._value_alerts.get((stream_name, kwargs.get('value_id', None)), ()))
+        if kwargs.get('state', None) is not None or kwargs.get('command', None) is not None:
+            alerts.extend(self._state_alerts)
+
+        statuses = [a._status for a in alerts]
+        for a in alerts:
             a.eval_alert(**kwargs)
 
         # update the aggreate status for this device
+        self._update_aggregate_alerts(any(a._status != status for a, status in zip(alerts, statuses)))
+
+    def process_stream_alerts(self, stream_name, values):
+        """
+        Evaluates the alerts of a stream over a batch of values, e.g. all the
+        values of a particle or granule, and updates the aggregate status once.
+        Value alerts that support it evaluate each value array in one go.
+
+        @param stream_name   name of the stream
+        @param values        dict of value_id -> sequence of values
+        """
+        self._index_alerts()
+        changed = False
+        for value_id, vals in values.iteritems():
+            for a in self._value_alerts.get((stream_name, value_id), ()):
+                status = a._status
+                if hasattr(a, 'eval_values'):
+                    a.eval_values(vals)
+                else:
+                    for value in vals:
+                        a.eval_alert(stream_name=stream_name, value=value, value_id=value_id)
+                changed = changed or a._status != status
+
+            alerts = self._stream_alerts.get(stream_name, []) + self._other_alerts
+            if alerts:
+                statuses = [a._status for a in alerts]
+                for value in vals:
+                    for a in alerts:
+                        a.eval_alert(stream_name=stream_name, value=value, value_id=value_id)
+                changed = changed or any(a._status != status for a, status in zip(alerts, statuses))
+
+        self._update_aggregate_alerts(changed)
+
+    def _update_aggregate_alerts(self, changed):
+        """
+        Recomputes the aggregate status if an alert status changed since the last
+        time, or the agent's aggregate status no longer matches it.
+        """
+        if not changed and self._aggstatus is not None:
+            watched = [a._status for a in self._watched_alerts()]
+            if watched == self._watched_statuses and \
+                    all(self._agent.aparam_aggstatus[aggregate_type] == status
+                        for aggregate_type, status in self._aggstatus.iteritems()):
+                return
+
         self._process_aggregate_alerts()
-        
+
     def _update_aggstatus(self, aggregate_type, new_status, alerts_list=None):
         """
         Called by this manager to set a new status value for an aggstatus type.
@@ -108,6 +205,9 @@ class AgentAlertManager(object):
                         elif  a._alert_type is StreamAlertType.WARNING and current_agg_state is not DeviceStatusType.STATUS_CRITICAL:
                             updated_status[ a._aggregate_type ] = DeviceStatusType.STATUS_WARNING
 
+        self._aggstatus = updated_status
+        self._watched_statuses = [a._status for a in self._watched_alerts()]
+
         #compare old state with new state and publish alerts for any agg status that has changed.
         for aggregate_type in AggregateStatusType._str_map.keys():
             if updated_status[aggregate_type] != self._agent.aparam_aggstatus[aggregate_type]:
@@ -180,6 +280,7 @@ class AgentAlertManager(object):
             [x.stop() for x in old_alerts]
             self._agent.aparam_alerts = new_alerts
 
+        self._indexed = None
         for a in self._agent.aparam_alerts:
             log.info('Agent alert: %s', str(a))
                        
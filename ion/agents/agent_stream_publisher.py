@@ -31,7 +31,7 @@ from interface.objects import StreamRoute
 from pyon.core.bootstrap import get_obj_registry
 from pyon.core.object import IonObjectDeserializer
 
-from ion.agents.populate_rdt import populate_rdt
+from ion.agents.populate_rdt import ParticleColumns
 
 class AgentStreamPublisher(object):
     """
@@ -74,6 +74,7 @@ class AgentStreamPublisher(object):
                     self._stream_defs[stream_name] = stream_def
                     rdt = RecordDictionaryTool(stream_definition_id=stream_def)    
                 self._agent.aparam_streams[stream_name] = rdt.fields
+                self._stream_buffers[stream_name] = ParticleColumns(rdt)
                 self._agent.aparam_pubrate[stream_name] = 0
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
@@ -95,7 +96,6 @@ class AgentStreamPublisher(object):
                                     stream_id=stream_id, stream_route=route)
                 self._publishers[stream_name] = publisher
                 self._stream_greenlets[stream_name] = None
-                self._stream_buffers[stream_name] = []
         
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
@@ -112,7 +112,7 @@ class AgentStreamPublisher(object):
         
         try:
             stream_name = sample['stream_name']
-            self._stream_buffers[stream_name].insert(0, sample)
+            self._stream_buffers[stream_name].append(sample)
             if not self._stream_greenlets[stream_name]:
                 self._publish_stream_buffer(stream_name)
 
@@ -128,7 +128,7 @@ class AgentStreamPublisher(object):
         for sample in sample_list:
             try:
                 stream_name = sample['stream_name']
-                self._stream_buffers[stream_name].insert(0, sample)
+                self._stream_buffers[stream_name].append(sample)
                 streams.add(stream_name)
             except KeyError:
                 log.warning('Instrument agent %s received sample with bad stream name %s.',
@@ -197,8 +197,8 @@ class AgentStreamPublisher(object):
                 log.debug("ASP Flush Agent State")
                 self._agent._flush_state()
 
-            buf_len = len(self._stream_buffers[stream_name])
-            if buf_len == 0:
+            buf = self._stream_buffers[stream_name]
+            if len(buf) == 0:
                 return
 
             stream_def = self._stream_defs[stream_name]
@@ -208,11 +208,7 @@ class AgentStreamPublisher(object):
                 rdt = RecordDictionaryTool(stream_definition=stream_def)
                 
             publisher = self._publishers[stream_name]
-            vals = []
-            for x in xrange(buf_len):
-                vals.append(self._stream_buffers[stream_name].pop())
-    
-            rdt = populate_rdt(rdt, vals)
+            rdt = buf.fill(rdt)
             
             #log.info('Outgoing granule: %s',
                      #['%s: %s'%(k,v) for k,v in rdt.iteritems()])
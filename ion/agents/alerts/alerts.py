@@ -16,6 +16,8 @@ from pyon.public import IonObject, log
 # Standard imports.
 import time
 import copy
+import operator
+import numpy
 
 # gevent.
 import gevent
@@ -331,6 +333,27 @@ class IntervalAlert(StreamValueAlert):
             self._upper_rel_op = upper_rel_op
             self._upper_bound= upper_bound
 
+        self._check = self._compile_check()
+
+    def _compile_check(self):
+        """
+        Returns a function of a value telling whether it lies in the interval,
+        so the bounds and operators are not inspected again for every value.
+        The same function applies elementwise to numpy arrays.
+        """
+        ops = {'<' : operator.lt, '<=' : operator.le}
+        lower_op = ops.get(self._lower_rel_op)
+        upper_op = ops.get(self._upper_rel_op)
+        lower_bound = self._lower_bound
+        upper_bound = self._upper_bound
+
+        if isinstance(lower_bound, (int, float)) and isinstance(upper_bound, (int, float)):
+            return lambda x: lower_op(lower_bound, x) & upper_op(x, upper_bound)
+        elif isinstance(lower_bound, (int, float)):
+            return lambda x: lower_op(lower_bound, x)
+        else:
+            return lambda x: upper_op(x, upper_bound)
+
     def get_status(self):
         status = super(IntervalAlert, self).get_status()
         status['lower_bound'] = self._lower_bound
@@ -362,37 +385,45 @@ class IntervalAlert(StreamValueAlert):
         self._current_value = value
         self._prev_status = self._status
         self._current_value_id = value_id
-        
-        if isinstance(self._lower_bound, (int, float)) and isinstance(self._upper_bound, (int, float)):
-            if self._lower_rel_op == '<=':
-                if self._upper_rel_op == '<=':
-                    self._status = (self._lower_bound <= self._current_value <= self._upper_bound)
-                
-                else:
-                    self._status = (self._lower_bound <= self._current_value < self._upper_bound)
-                    
-            else:
-                if self._upper_rel_op == '<=':
-                    self._status = (self._lower_bound < self._current_value <= self._upper_bound)
-                
-                else:
-                    self._status = (self._lower_bound < self._current_value < self._upper_bound)
-                        
-        elif isinstance(self._lower_bound, (int, float)):
-            if self._lower_rel_op == '<=':
-                self._status = (self._lower_bound <= self._current_value)
-            else:
-                self._status = (self._lower_bound < self._current_value)
-            
-        elif isinstance(self._upper_bound, (int, float)):
-            if self._upper_rel_op == '<=':
-                self._status = (self._current_value <= self._upper_bound)
-            else:
-                self._status = (self._current_value < self._upper_bound)
-                
+        self._status = bool(self._check(value))
+
         if self._prev_status != self._status:
             self.publish_alert()
 
+    def eval_values(self, values):
+        """
+        Evaluates a sequence of values of the alert's stream and value id at once,
+        with the same status transitions and alert publications as calling
+        eval_alert for each value in turn.
+        """
+        values = [v for v in values if v]
+        if not values:
+            return
+        array = numpy.asarray(values)
+        if array.ndim != 1 or array.dtype.kind not in 'biuf':
+            # Not plain numbers, evaluate one by one
+            for value in values:
+                self.eval_alert(self._stream_name, value, self._value_id)
+            return
+        status = numpy.asarray(self._check(array), dtype=bool)
+
+        # Indexes at which the status differs from the one before
+        changes = numpy.flatnonzero(status[1:] != status[:-1]) + 1
+        if self._status is None or self._status != status[0]:
+            changes = numpy.concatenate([[0], changes])
+
+        self._current_value_id = self._value_id
+        prev_status = self._status
+        for i in changes:
+            self._current_value = values[i]
+            self._prev_status = prev_status if i == 0 else bool(status[i-1])
+            self._status = bool(status[i])
+            self.publish_alert()
+
+        self._current_value = values[-1]
+        self._prev_status = prev_status if len(values) == 1 else bool(status[-2])
+        self._status = bool(status[-1])
+
 
 class RSNEventAlert(BaseAlert):
     """
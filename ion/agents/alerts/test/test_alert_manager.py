@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.alerts.test.test_alert_manager
+@file ion/agents/alerts/test/test_alert_manager.py
+@brief Unit tests for the indexed alert evaluation in AgentAlertManager
+"""
+
+# bin/nosetests -v ion/agents/alerts/test/test_alert_manager.py
+
+from pyon.util.unit_test import IonUnitTestCase
+from nose.plugins.attrib import attr
+
+from interface.objects import StreamAlertType, AggregateStatusType, DeviceStatusType
+
+from ion.agents.agent_alert_manager import AgentAlertManager
+from ion.agents.alerts.alerts import IntervalAlert, StateAlert, BaseAlert
+
+from mock import Mock, patch
+import random
+
+
+class LoopAlertManager(AgentAlertManager):
+    """
+    Evaluates every alert and recomputes the aggregate status on every call.
+    """
+    def process_alerts(self, **kwargs):
+        for a in self._agent.aparam_alerts:
+            a.eval_alert(**kwargs)
+        self._process_aggregate_alerts()
+
+
+def make_alerts():
+    common = dict(resource_id='abc123', origin_type='InstrumentDevice', description='test')
+    return [
+        IntervalAlert(name='temp_warning', stream_name='parsed', value_id='temp',
+                      alert_type=StreamAlertType.WARNING, aggregate_type=AggregateStatusType.AGGREGATE_DATA,
+                      lower_bound=10, lower_rel_op='<', upper_bound=20, upper_rel_op='<=', **common),
+        IntervalAlert(name='temp_alarm', stream_name='parsed', value_id='temp',
+                      alert_type=StreamAlertType.ALARM, aggregate_type=AggregateStatusType.AGGREGATE_DATA,
+                      lower_bound=5, lower_rel_op='<=', **common),
+        IntervalAlert(name='pressure_warning', stream_name='parsed', value_id='pressure',
+                      alert_type=StreamAlertType.WARNING, aggregate_type=AggregateStatusType.AGGREGATE_DATA,
+                      upper_bound=100, upper_rel_op='<', **common),
+        IntervalAlert(name='raw_warning', stream_name='raw', value_id='temp',
+                      alert_type=StreamAlertType.WARNING, aggregate_type=AggregateStatusType.AGGREGATE_POWER,
+                      upper_bound=15, upper_rel_op='<=', **common),
+        StateAlert(name='comms', alert_type=StreamAlertType.ALARM, aggregate_type=AggregateStatusType.AGGREGATE_COMMS,
+                   alert_states=['DISCONNECTED'], clear_states=['IDLE', 'COMMAND'], **common),
+    ]
+
+
+@attr('UNIT', group='sa')
+class TestAgentAlertManager(IonUnitTestCase):
+
+    def setUp(self):
+        self.published = []
+        def publish_alert(alert):
+            self.published.append((alert._name, alert._status, alert._current_value))
+        patcher = patch.object(BaseAlert, 'publish_alert', publish_alert)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_manager(self, cls):
+        agent = Mock()
+        agent.resource_id = 'abc123'
+        agent.aparam_aggstatus = {}
+        agent.aparam_alerts = make_alerts()
+        agent.__class__.ORIGIN_TYPE = 'InstrumentDevice'
+        return cls(agent)
+
+    def _random_calls(self, seed, count):
+        rand = random.Random(seed)
+        calls = []
+        for i in xrange(count):
+            if rand.random() < 0.05:
+                calls.append(dict(state=rand.choice(['DISCONNECTED', 'IDLE', 'COMMAND', 'STREAMING'])))
+            else:
+                calls.append(dict(stream_name=rand.choice(['parsed', 'raw']),
+                                  value_id=rand.choice(['temp', 'pressure', 'salinity']),
+                                  value=rand.choice([0, rand.uniform(0, 30), rand.uniform(90, 110)])))
+        return calls
+
+    def _agg_events(self, manager):
+        return [call[1] for call in manager._agent._event_publisher.publish_event.call_args_list]
+
+    def test_matches_full_evaluation(self):
+        calls = self._random_calls(0, 2000)
+
+        reference = self._create_manager(LoopAlertManager)
+        for kwargs in calls:
+            reference.process_alerts(**kwargs)
+        expected = self.published
+        self.published = []
+
+        manager = self._create_manager(AgentAlertManager)
+        for kwargs in calls:
+            manager.process_alerts(**kwargs)
+
+        self.assertEquals(self.published, expected)
+        self.assertEquals(self._agg_events(manager), self._agg_events(reference))
+        self.assertEquals(manager._agent.aparam_aggstatus, reference._agent.aparam_aggstatus)
+
+    def test_value_arrays(self):
+        calls = [kwargs for kwargs in self._random_calls(1, 2000) if 'stream_name' in kwargs]
+
+        reference = self._create_manager(LoopAlertManager)
+        for kwargs in calls:
+            reference.process_alerts(**kwargs)
+        expected = sorted(self.published)
+        self.published = []
+
+        # The same values, a granule of 100 values at a time
+        manager = self._create_manager(AgentAlertManager)
+        for start in xrange(0, len(calls), 100):
+            for stream_name in ('parsed', 'raw'):
+                values = {}
+                for kwargs in calls[start:start+100]:
+                    if kwargs['stream_name'] == stream_name:
+                        values.setdefault(kwargs['value_id'], []).append(kwargs['value'])
+                manager.process_stream_alerts(stream_name, values)
+
+        # Alert publications per alert are the same, in a different order across alerts
+        self.assertEquals(sorted(self.published), expected)
+        self.assertEquals(manager._agent.aparam_aggstatus, reference._agent.aparam_aggstatus)
+        for a, b in zip(manager._agent.aparam_alerts, reference._agent.aparam_alerts):
+            self.assertEquals(a.get_status(), b.get_status())
+
+    def test_aggregate_only_on_change(self):
+        manager = self._create_manager(AgentAlertManager)
+        manager.process_stream_alerts('parsed', {'temp' : [15.]})
+        self.assertEquals(manager._agent.aparam_aggstatus[AggregateStatusType.AGGREGATE_DATA],
+                          DeviceStatusType.STATUS_OK)
+
+        with patch.object(manager, '_process_aggregate_alerts') as process_aggregate:
+            manager.process_stream_alerts('parsed', {'temp' : [16., 17., 18.], 'salinity' : [35.]})
+            manager.process_alerts(stream_name='raw', value_id='pressure', value=1.)
+            self.assertEquals(process_aggregate.call_count, 0)
+
+            manager.process_stream_alerts('parsed', {'temp' : [16., 25.]})
+            self.assertEquals(process_aggregate.call_count, 1)
+
+        # Changing the alerts rebuilds the index
+        manager._agent.aparam_alerts = [a for a in manager._agent.aparam_alerts if a._name != 'temp_warning']
+        manager.process_stream_alerts('parsed', {'temp' : [16.]})
+        self.assertEquals([a._name for a in manager._value_alerts[('parsed', 'temp')]], ['temp_alarm'])
+        self.assertEquals(manager._agent.aparam_aggstatus[AggregateStatusType.AGGREGATE_DATA],
+                          DeviceStatusType.STATUS_OK)
@@ -12,11 +12,12 @@ import msgpack
 
 from pyon.public import log, OT, RT
 from pyon.util.async import spawn
-from pyon.core.exception import NotFound
+from pyon.core.exception import NotFound, Conflict, BadRequest
 from pyon.util.containers import get_safe
 from pyon.event.event import EventPublisher
+from pyon.core import bootstrap
 from pyon.core.bootstrap import IonObject
-from interface.objects import Granule, Attachment, AttachmentType, StreamRoute
+from interface.objects import Granule, StreamRoute
 
 from ion.core.includes.mi import DriverParameter, DriverEvent
 from ion.agents.instrument.exceptions import InstrumentParameterException, InstrumentCommandException, InstrumentDataException, NotImplementedException, InstrumentException
@@ -26,7 +27,7 @@ from interface.services.coi.iresource_registry_service import ResourceRegistrySe
 ### For new granule and stream interface
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 
-from ion.agents.data.handlers.handler_utils import calculate_iteration_count, list_file_info, get_time_from_filename
+from ion.agents.data.handlers.handler_utils import calculate_iteration_count, list_file_info, get_listing_cache, get_time_from_filename
 from pyon.agent.agent import ResourceAgentState
 from pyon.ion.stream import StandaloneStreamPublisher
 
@@ -469,12 +470,17 @@ class BaseDataHandler(object):
 
     def _find_new_data_check_attachment(self, res_id):
         """
-        Returns a list of the last data files that were found
+        Returns a list of the last data files that were found, from the NewDataCheck
+        document or, for datasets not checkpointed there yet, the NewDataCheck attachment
 
         @param res_id The resource ID of the external dataset resource
         @throws InstrumentException if no attachment is found
         @retval list of data file names and sizes
         """
+        content = NewDataCheckStore.read(res_id)
+        if content is not None:
+            return content
+
         rr_cli = ResourceRegistryServiceClient()
         try:
             attachment_objs = rr_cli.find_attachments(resource_id=res_id, include_content=True, id_only=False)
@@ -491,33 +497,14 @@ class BaseDataHandler(object):
     @classmethod
     def _update_new_data_check_attachment(cls, res_id, new_content):
         """
-        Update the list of data files for the external dataset resource
+        Checkpoint the list of data files for the external dataset resource
+        in its NewDataCheck document
 
         @param res_id the ID of the external dataset resource
         @param new_content list of new files found on data host
-        @throws InstrumentException if external dataset resource can't be found
-        @retval the attachment ID
+        @retval the document ID
         """
-        rr_cli = ResourceRegistryServiceClient()
-        try:
-            # Delete any attachments with the "NewDataCheck" keyword
-            attachment_objs = rr_cli.find_attachments(resource_id=res_id, include_content=False, id_only=False)
-            for attachment_obj in attachment_objs:
-                kwds = set(attachment_obj.keywords)
-                if 'NewDataCheck' in kwds:
-                    log.debug('Delete NewDataCheck attachment: {0}'.format(attachment_obj._id))
-                    rr_cli.delete_attachment(attachment_obj._id)
-                else:
-                    log.debug('Found attachment: {0}'.format(attachment_obj))
-
-            # Create the new attachment
-            att = Attachment(name='new_data_check', attachment_type=AttachmentType.ASCII, keywords=['NewDataCheck', ], content_type='text/plain', content=msgpack.packb(new_content))
-            att_id = rr_cli.create_attachment(resource_id=res_id, attachment=att)
-
-        except NotFound:
-            raise InstrumentException('ExternalDatasetResource \'{0}\' not found'.format(res_id))
-
-        return att_id
+        return NewDataCheckStore.write(res_id, new_content)
 
     @classmethod
     def _acquire_sample(cls, config, publisher, unlock_new_data_callback, update_new_data_check_attachment):
@@ -620,20 +607,121 @@ class BaseDataHandler(object):
         if data_generator is None or not hasattr(data_generator, '__iter__'):
             raise InstrumentDataException('Invalid object returned from _get_data: returned object cannot be None and must have \'__iter__\' attribute')
 
-        for count, gran in enumerate(data_generator):
-            if isinstance(gran, Granule):
-                #log.warn('_publish_data: {0}\n{1}'.format(count, gran))
-                publisher.publish(gran)
-                if config and 'set_new_data_check' in config:
-                    update_new_data_check_attachment(config['external_dataset_res_id'], config['set_new_data_check'])
-            else:
-                log.warn('Could not publish object of {0} returned by _get_data: {1}'.format(type(gran), gran))
+        # set_new_data_check is the NewDataCheck state once every granule was published. Until then
+        # handlers record the files, or positions in them, whose granules were published with
+        # _set_published, and that is checkpointed every checkpoint_granules granules or
+        # checkpoint_interval seconds and when publishing fails. A restart resumes from published
+        # data and may at most publish some of it again
+        checkpoint = config and 'set_new_data_check' in config
+        if checkpoint:
+            checkpoint_granules = get_safe(config, 'checkpoint_granules', 100)
+            checkpoint_interval = get_safe(config, 'checkpoint_interval', 30)
+            last_checkpoint = time.time()
+        published = 0
+        pending = 0
+
+        try:
+            for count, gran in enumerate(data_generator):
+                if isinstance(gran, Granule):
+                    #log.warn('_publish_data: {0}\n{1}'.format(count, gran))
+                    publisher.publish(gran)
+                    published += 1
+                    if checkpoint:
+                        pending += 1
+                        if pending >= checkpoint_granules or time.time() - last_checkpoint >= checkpoint_interval:
+                            cls._checkpoint_published(config, update_new_data_check_attachment)
+                            pending = 0
+                            last_checkpoint = time.time()
+                else:
+                    log.warn('Could not publish object of {0} returned by _get_data: {1}'.format(type(gran), gran))
+        except Exception:
+            if checkpoint and pending:
+                cls._checkpoint_published(config, update_new_data_check_attachment)
+            raise
+
+        if checkpoint and published:
+            update_new_data_check_attachment(config['external_dataset_res_id'], config['set_new_data_check'])
 
         publisher.close()
-        #TODO: Persist the 'state' of this operation so that it can be re-established in case of failure
 
         #TODO: When finished publishing, update (either directly, or via an event callback to the agent) the UpdateDescription
 
+    @classmethod
+    def _set_published(cls, config, file_info):
+        """
+        Records that the granules of a file were published up to file_info, its (name, mtime, size, position)
+        NewDataCheck entry. _get_data calls it once it resumes after yielding the file's granules, which is
+        after they were published
+        @param config dict containing configuration parameters
+        @param file_info the NewDataCheck entry of the file
+        """
+        published = config.setdefault('published_new_data_check', list(get_safe(config, 'new_data_check') or []))
+        for i, entry in enumerate(published):
+            if entry[0] == file_info[0]:
+                published[i] = tuple(file_info)
+                return
+        published.append(tuple(file_info))
+
+    @classmethod
+    def _checkpoint_published(cls, config, update_new_data_check_attachment):
+        """
+        Checkpoints the NewDataCheck state of the published granules, if the handler records it
+        """
+        published = get_safe(config, 'published_new_data_check')
+        if published is not None:
+            update_new_data_check_attachment(config['external_dataset_res_id'], list(published))
+
+
+class NewDataCheckStore(object):
+    """
+    The NewDataCheck state of external datasets, kept in one object store document
+    per dataset and updated in place. The document revisions written are remembered
+    so a checkpoint is a single update.
+    """
+    _revs = {}
+
+    @staticmethod
+    def doc_key(res_id):
+        return 'NewDataCheck_%s' % res_id
+
+    @classmethod
+    def _object_store(cls):
+        return bootstrap.container_instance.object_store
+
+    @classmethod
+    def read(cls, res_id):
+        """
+        Returns the NewDataCheck content of the dataset or None if it has none
+        """
+        try:
+            doc = cls._object_store().read_doc(cls.doc_key(res_id))
+        except NotFound:
+            return None
+        cls._revs[res_id] = doc['_rev']
+        return doc['content']
+
+    @classmethod
+    def write(cls, res_id, content):
+        """
+        Creates or updates the NewDataCheck document of the dataset
+        """
+        object_store = cls._object_store()
+        doc = {'resource_id': res_id, 'content': content}
+        rev = cls._revs.get(res_id)
+        try:
+            if rev is None:
+                doc_id, rev = object_store.create_doc(doc, object_id=cls.doc_key(res_id))
+            else:
+                doc['_id'], doc['_rev'] = cls.doc_key(res_id), rev
+                doc_id, rev = object_store.update_doc(doc)
+        except (BadRequest, Conflict):
+            # Written by someone else since, update the current revision
+            current = object_store.read_doc(cls.doc_key(res_id))
+            doc['_id'], doc['_rev'] = current['_id'], current['_rev']
+            doc_id, rev = object_store.update_doc(doc)
+        cls._revs[res_id] = rev
+        return doc_id
+
 
 class DataHandlerError(Exception):
     """
@@ -757,7 +845,7 @@ class DummyDataHandler(BaseDataHandler):
         date_pattern = get_safe(config, 'ds_params.date_pattern')
         date_extraction_pattern = get_safe(config, 'ds_params.date_extraction_pattern')
 
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         # Determine which files are new
         #Not exactly the prettiest method, but here goes:
@@ -806,7 +894,7 @@ class DummyDataHandler(BaseDataHandler):
         end_time = get_safe(config, 'constraints.end_time')
 
         new_list = []
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         for x in curr_list:
             curr_time = get_time_from_filename(x[0], date_extraction_pattern, date_pattern)
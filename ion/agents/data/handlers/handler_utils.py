@@ -7,7 +7,11 @@
 @brief
 """
 from pyon.public import log
+from pyon.util.containers import get_safe
+from gevent.pool import Pool
 import glob
+import hashlib
+import json
 import os
 import re
 import time
@@ -29,7 +33,7 @@ def _get_type(base):
     return type
 
 
-def list_file_info(base, pattern, name_index=0, type=None):
+def list_file_info(base, pattern, name_index=0, type=None, cache=None):
     """
     Constructs a list of tuples containing information about the files as indicated by the pattern.
     The name_index should correspond to the index in the resulting tuple that contains the name of the file, default is 0
@@ -37,7 +41,10 @@ def list_file_info(base, pattern, name_index=0, type=None):
     @param pattern regular expression describing file names
     @param name_index
     @param type the type of server (http, ftp, or local file system)
+    @param cache FileListingCache to list the files with, only re-listing what changed since the previous listing
     """
+    if cache is not None:
+        return cache.list(base, pattern, name_index, type)
 
     # If type isn't specified, attempt to determine based on base
     type = type or _get_type(base)
@@ -63,8 +70,17 @@ def list_file_info_http(base, pattern, name_index=0):
     @param name_index
     """
     response = requests.get(base)
-    base_url = response.url
-    flst = re.findall(pattern, response.content)
+    return _parse_file_info_http(response.url, response.content, pattern, name_index)
+
+
+def _parse_file_info_http(base_url, content, pattern, name_index=0):
+    """
+    @param base_url URL of the listing
+    @param content the listing page
+    @param pattern regular expression describing file names
+    @param name_index
+    """
+    flst = re.findall(pattern, content)
     olst = []
     for f in flst:
         if not isinstance(f, tuple):
@@ -111,6 +127,180 @@ def list_file_info_fs(base, pattern):
     return olst
 
 
+class FileListingCache(object):
+    """
+    Remembers the last listing of each source (base, pattern) so a poll only does the work needed for what changed:
+    local directories are only re-read (and matched against the pattern) when their modification time changes, and
+    HTTP listings are requested conditionally (ETag/Last-Modified) and only parsed when the page changed. FTP sources
+    are listed every time. Listings are identical to those of list_file_info.
+
+    With a cache_dir, the listings are persisted there (one JSON file per source) so deltas carry over restarts.
+    If immutable_files is True, files are assumed not to change once listed and only new local files are stat'ed.
+    """
+
+    # A directory modified this close (in seconds) to its listing may have changed again within its mtime resolution
+    RACY_INTERVAL = 2
+
+    def __init__(self, cache_dir=None, immutable_files=False):
+        self.cache_dir = cache_dir
+        self.immutable_files = immutable_files
+        self._states = {}
+
+    def list(self, base, pattern, name_index=0, type=None):
+        """
+        Returns the listing of the source, as list_file_info
+        """
+        return self.update(base, pattern, name_index, type)[0]
+
+    def update(self, base, pattern, name_index=0, type=None):
+        """
+        Lists the source and returns the listing with its delta from the previous listing of the source
+        @retval tuple (listing, added, removed) - added and removed are the entries of listing that weren't in the
+        previous listing and the entries of the previous listing that aren't in listing. A file that changed is in both
+        """
+        type = type or _get_type(base)
+        key = [type, base, pattern, name_index]
+        state = self._get_state(key)
+        previous = state.get('listing', [])
+
+        if type == 'fs':
+            listing = self._list_fs(state, base, pattern)
+        elif type == 'http':
+            listing = self._list_http(state, base, pattern, name_index)
+        else:
+            listing = list_file_info(base, pattern, name_index, type)
+
+        prev_set = set(previous)
+        curr_set = set(listing)
+        added = [x for x in listing if x not in prev_set]
+        removed = [x for x in previous if x not in curr_set]
+
+        state['listing'] = listing
+        dirty = state.pop('dirty', False)
+        if added or removed or dirty:
+            self._save_state(key, state)
+
+        return listing, added, removed
+
+    def update_many(self, sources, workers=10):
+        """
+        Lists several sources concurrently
+        @param sources list of (base, pattern[, name_index[, type]]) tuples
+        @param workers the maximum number of sources listed at the same time
+        @retval list of (listing, added, removed) tuples, in the order of sources
+        """
+        pool = Pool(workers)
+        greenlets = [pool.spawn(self.update, *source) for source in sources]
+        pool.join()
+        return [g.get() for g in greenlets]
+
+    def _list_fs(self, state, base, pattern):
+        dirname, file_pattern = os.path.split(base + '/' + pattern)
+        if glob.has_magic(dirname) or not glob.has_magic(file_pattern):
+            return list_file_info_fs(base, pattern)
+
+        if not os.path.exists(base):
+            raise StandardError('base \'{0}\' does not exist'.format(base))
+        if not os.path.isdir(base):
+            raise StandardError('base \'{0}\' is not a directory'.format(base))
+
+        # The names in a directory can only have changed if its modification time did
+        now = time.time()
+        try:
+            dir_mtime = os.stat(dirname).st_mtime
+        except OSError:
+            # The sub-directory of the pattern doesn't exist (anymore)
+            state.update(names=None, stats={})
+            return []
+        names = state.get('names')
+        if names is None or dir_mtime != state.get('dir_mtime') or state['listed_at'] - dir_mtime < self.RACY_INTERVAL:
+            names = glob.glob1(dirname, file_pattern)
+            state.update(names=names, dir_mtime=dir_mtime, listed_at=now, dirty=True)
+
+        old_stats = state.get('stats', {})
+        stats = {}
+        listing = []
+        for name in names:
+            if self.immutable_files and name in old_stats:
+                stats[name] = old_stats[name]
+            else:
+                try:
+                    st = os.stat(os.path.join(dirname, name))
+                except OSError:
+                    # Removed since the directory was read
+                    continue
+                stats[name] = [st.st_mtime, st.st_size]
+            listing.append((os.path.join(dirname, name), stats[name][0], stats[name][1], 0))
+
+        state['stats'] = stats
+        return listing
+
+    def _list_http(self, state, base, pattern, name_index):
+        headers = {}
+        if 'listing' in state:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+
+        response = requests.get(base, headers=headers)
+        if response.status_code == 304:
+            return state['listing']
+
+        state.update(etag=response.headers.get('etag'), last_modified=response.headers.get('last-modified'), dirty=True)
+        return _parse_file_info_http(response.url, response.content, pattern, name_index)
+
+    def _get_state(self, key):
+        state_key = json.dumps(key)
+        if state_key not in self._states:
+            state = {}
+            if self.cache_dir:
+                try:
+                    with open(self._state_path(state_key)) as f:
+                        saved = json.load(f)
+                    if saved['key'] == key:
+                        state = saved['state']
+                        state['listing'] = [tuple(x) if isinstance(x, list) else x for x in state['listing']]
+                except IOError:
+                    pass
+                except (ValueError, KeyError):
+                    log.warn('Ignoring corrupt file listing cache for %s', key)
+            self._states[state_key] = state
+        return self._states[state_key]
+
+    def _save_state(self, key, state):
+        if not self.cache_dir:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._state_path(json.dumps(key))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'key': key, 'state': state}, f)
+        os.rename(path + '.tmp', path)
+
+    def _state_path(self, state_key):
+        return os.path.join(self.cache_dir, hashlib.sha1(state_key).hexdigest() + '.json')
+
+
+_listing_caches = {}
+
+
+def get_listing_cache(config):
+    """
+    Returns the FileListingCache for a data handler configuration, shared by the handlers with the same
+    ds_params.listing_cache_dir (listings are only kept in memory without one) and ds_params.immutable_files,
+    or None if ds_params.listing_cache is False
+    @param config dictionary of configuration parameters
+    """
+    if not get_safe(config, 'ds_params.listing_cache', True):
+        return None
+
+    key = get_safe(config, 'ds_params.listing_cache_dir'), bool(get_safe(config, 'ds_params.immutable_files', False))
+    if key not in _listing_caches:
+        _listing_caches[key] = FileListingCache(*key)
+    return _listing_caches[key]
+
+
 def get_time_from_filename(file_name, date_extraction_pattern, date_pattern):
     """
     @param file_name name of the file
@@ -11,7 +11,7 @@ from pyon.public import log
 from pyon.util.containers import get_safe
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler
-from ion.agents.data.handlers.handler_utils import list_file_info, calculate_iteration_count, get_time_from_filename
+from ion.agents.data.handlers.handler_utils import list_file_info, get_listing_cache, calculate_iteration_count, get_time_from_filename
 import numpy as np
 import struct
 
@@ -56,7 +56,7 @@ class HYPMDataHandler(BaseDataHandler):
         date_pattern = get_safe(config, 'ds_params.date_pattern')
         date_extraction_pattern = get_safe(config, 'ds_params.date_extraction_pattern')
 
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         #compare the last read files (old_list) with the current directory contents (curr_list)
         #if the file names are the same (curr_file[0] and old_file[0]) check the size of the
@@ -92,7 +92,7 @@ class HYPMDataHandler(BaseDataHandler):
         end_time = get_safe(config, 'constraints.end_time')
 
         new_list = []
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         new_list = curr_list
 
@@ -161,6 +161,7 @@ class HYPMDataHandler(BaseDataHandler):
                         config['set_new_data_check'][index] = (f[0], f[1], f[2], file_pos)
 
                     yield g
+                    cls._set_published(config, (f[0], f[1], f[2], file_pos))
 
                 parser.close()
 
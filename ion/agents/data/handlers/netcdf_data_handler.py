@@ -10,20 +10,31 @@
 
 from pyon.public import log
 from pyon.util.containers import get_safe
+from pyon.util.async import spawn
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler
 from ion.agents.data.handlers.handler_utils import calculate_iteration_count
 import hashlib
+import os
 import numpy as np
 from pyon.core.interceptor.encode import encode_ion, decode_ion
 import msgpack
-from interface.objects import CompareResult, CompareResultEnum
+from interface.objects import CompareResult, CompareResultEnum, DatasetDescriptionDataSamplingEnum
 
+from gevent.queue import Queue
 from netCDF4 import Dataset
 
 
 class NetcdfDataHandler(BaseDataHandler):
 
+    FINGERPRINT_CACHE_LIMIT = 10000
+    # The number of values read at a time to fingerprint a whole variable
+    FINGERPRINT_BLOCK_SIZE = 1000000
+    # Fingerprints by dataset path and sampling, with the modification time and size of the file they were calculated for
+    _fingerprint_cache = {}
+    # New data slices by dataset path and new_data_check digest, with the version of the dataset they were found in
+    _new_data_cache = {}
+
     @classmethod
     def _constraints_for_new_request(cls, config):
         """
@@ -46,6 +57,16 @@ class NetcdfDataHandler(BaseDataHandler):
 
             t_slice = slice(None)
             if base_nd_check:
+                # The time variable is only read again when the dataset may have changed
+                ds_url = ext_dset_res.dataset_description.parameters['dataset_path']
+                version = cls._get_data_version(ds_url, ext_dset_res.dataset_description.data_sampling, ds)
+                key = ds_url, hashlib.sha1(base_nd_check).hexdigest()
+                cached = cls._new_data_cache.get(key)
+                if version is not None and cached is not None and cached[0] == version:
+                    return {
+                        'temporal_slice': cached[1]
+                    }
+
                 t_new_vname = ext_dset_res.dataset_description.parameters['temporal_dimension']
                 t_new_arr = ds.variables[t_new_vname][t_slice]
 
@@ -65,6 +86,11 @@ class NetcdfDataHandler(BaseDataHandler):
 
                     t_slice = slice(first_index, last_index)
 
+                if version is not None:
+                    if len(cls._new_data_cache) >= cls.FINGERPRINT_CACHE_LIMIT:
+                        cls._new_data_cache.clear()
+                    cls._new_data_cache[key] = version, t_slice
+
             return {
                 'temporal_slice': t_slice
             }
@@ -84,8 +110,10 @@ class NetcdfDataHandler(BaseDataHandler):
     @classmethod
     def _get_data(cls, config):
         """
-        Retrieves config['constraints']['count'] number of random samples of length config['constraints']['array_len']
-        @param config Dict of configuration parameters - must contain ['constraints']['count'] and ['constraints']['count']
+        Retrieves the config['constraints']['temporal_slice'] records of the dataset in granules of at most
+        config['max_records'] records. The time and data variables are read from the file one granule at a time and,
+        while a granule is published, the next config['prefetch'] granules (default 1, 0 to disable) are read ahead
+        @param config Dict of configuration parameters - must contain ['constraints']['temporal_slice']
         """
         ext_dset_res = get_safe(config, 'external_dataset_res', None)
 
@@ -104,42 +132,98 @@ class NetcdfDataHandler(BaseDataHandler):
             if isinstance(t_slice, str):
                 t_slice = eval(t_slice)
 
-            lon = ds.variables[x_vname][:]
-            lat = ds.variables[y_vname][:]
-            z = ds.variables[z_vname][:]
-
-            t_arr = ds.variables[t_vname][t_slice]
-            data_arrays = {}
-            for varn in var_lst:
-                data_arrays[varn] = ds.variables[varn][t_slice]
-
             max_rec = get_safe(config, 'max_records', 1)
             #dprod_id = get_safe(config, 'data_producer_id', 'unknown data producer')
 
             stream_def = get_safe(config, 'stream_def')
+            prefetch = get_safe(config, 'prefetch', 1)
 
-            cnt = calculate_iteration_count(t_arr.size, max_rec)
-            for x in xrange(cnt):
-                ta = t_arr[x * max_rec:(x + 1) * max_rec]
+            variables = ds.variables
+            if isinstance(t_slice, slice):
+                chunks = cls._chunk_slices(t_slice, len(variables[t_vname]), max_rec)
+            else:
+                # Index lists can't be split into slices of the file: read them up front
+                variables = dict((varn, variables[varn][t_slice]) for varn in [t_vname] + var_lst)
+                chunks = cls._chunk_slices(slice(None), len(variables[t_vname]), max_rec)
 
-                # Make a 'master' RecDict
-                rdt = RecordDictionaryTool(stream_definition_id=stream_def)
+            # Make a 'master' RecDict with the coordinate values, which are the same for every granule
+            template = RecordDictionaryTool(stream_definition_id=stream_def)
+            template[x_vname] = ds.variables[x_vname][:]
+            template[y_vname] = ds.variables[y_vname][:]
+            template[z_vname] = ds.variables[z_vname][:]
 
-                # Assign coordinate values to the RecDict
-                rdt[x_vname] = lon
-                rdt[y_vname] = lat
-                rdt[z_vname] = z
+            def build_granule(chunk):
+                rdt = template.copy()
 
                 # Assign data values to the RecDict
-                rdt[t_vname] = ta
-                for key, arr in data_arrays.iteritems():
-                    d = arr[x * max_rec:(x + 1) * max_rec]
-                    rdt[key] = d
+                rdt[t_vname] = variables[t_vname][chunk]
+                for varn in var_lst:
+                    rdt[varn] = variables[varn][chunk]
+
+                return rdt.to_granule()
+
+            try:
+                for g in cls._prefetch(build_granule, chunks, prefetch):
+                    yield g
+            finally:
+                ds.close()
+
+    @classmethod
+    def _chunk_slices(cls, t_slice, size, max_rec):
+        """
+        Splits a slice of a variable with size records into slices of at most max_rec records
+        @param t_slice the slice to split
+        @param size the number of records in the variable
+        @param max_rec the maximum number of records in a chunk
+        @retval list of slices, in order
+        """
+        start, stop, step = t_slice.indices(size)
+        count = len(xrange(start, stop, step))
 
-                g = rdt.to_granule()
-                yield g
+        chunks = []
+        for x in xrange(calculate_iteration_count(count, max_rec)):
+            first = start + x * max_rec * step
+            end = start + min((x + 1) * max_rec, count) * step
+            # A backwards slice that ends before the first record runs to the start of the variable
+            chunks.append(slice(first, end if end >= 0 else None, step))
 
-            ds.close()
+        return chunks
+
+    @classmethod
+    def _prefetch(cls, func, items, depth):
+        """
+        Yields func(item) for each of items, in order. With a depth above 0 the results are computed by a separate
+        greenlet up to depth results ahead of the consumer, so they are ready when it is done waiting on its own I/O
+        @param func the function to call on each item
+        @param items the items
+        @param depth the number of results to compute ahead
+        """
+        if depth < 1:
+            for item in items:
+                yield func(item)
+            return
+
+        queue = Queue(maxsize=depth)
+
+        def produce():
+            try:
+                for item in items:
+                    queue.put((func(item), None))
+                queue.put((None, StopIteration()))
+            except Exception as ex:
+                queue.put((None, ex))
+
+        producer = spawn(produce)
+        try:
+            while True:
+                result, ex = queue.get()
+                if isinstance(ex, StopIteration):
+                    break
+                elif ex is not None:
+                    raise ex
+                yield result
+        finally:
+            producer.kill()
 
     @classmethod
     def _init_acquisition_cycle(cls, config):
@@ -154,10 +238,91 @@ class NetcdfDataHandler(BaseDataHandler):
             config['dataset_object'] = Dataset(ds_url)
 
     @classmethod
-    def _get_fingerprint(cls, ds):
+    def _get_data_version(cls, path, data_sampling=None, ds=None):
+        """
+        Returns a value that changes whenever the values of the local dataset at path may have changed. That's its
+        fingerprint when every value is sampled, otherwise the modification time and size of the file, since a partial
+        fingerprint misses a file rewritten in place with new times.
+        @param path the path of the dataset
+        @param data_sampling the DatasetDescriptionDataSamplingEnum configured for the dataset
+        @param ds the dataset at path if it is already open
+        @retval the version of the dataset, or None for remote datasets which have to be read to tell
+        """
+        if not os.path.isfile(path):
+            return None
+        if data_sampling == DatasetDescriptionDataSamplingEnum.FULL:
+            return cls._get_file_fingerprint(path, data_sampling=data_sampling, ds=ds)
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    @classmethod
+    def _get_file_fingerprint(cls, path, mtime=None, size=None, data_sampling=None, shotgun_count=10, ds=None):
+        """
+        Calculate the fingerprint of the dataset at path, unless the file is unchanged since it was last fingerprinted.
+        Local files are checked with os.stat, for remote datasets pass the modification time and/or size given by the
+        listing (see handler_utils.list_file_info) - without either the fingerprint is always calculated
+        @param path the path or URL of the dataset
+        @param mtime the modification time of the dataset
+        @param size the size of the dataset
+        @param data_sampling the DatasetDescriptionDataSamplingEnum of the data to include in the fingerprint
+        @param shotgun_count the number of values sampled per variable for DatasetDescriptionDataSamplingEnum.SHOTGUN
+        @param ds the dataset at path if it is already open
+        @retval a fingerprint representing the dataset and its contents
+        """
+        if mtime is None and size is None and os.path.isfile(path):
+            stat = os.stat(path)
+            mtime, size = stat.st_mtime, stat.st_size
+
+        cacheable = mtime is not None or size is not None
+        key = path, data_sampling, shotgun_count
+        if cacheable:
+            cached = cls._fingerprint_cache.get(key)
+            if cached is not None and cached[0] == (mtime, size):
+                return cached[1]
+
+        if ds is not None:
+            fingerprint = cls._get_fingerprint(ds, data_sampling, shotgun_count)
+        else:
+            ds = Dataset(path)
+            try:
+                fingerprint = cls._get_fingerprint(ds, data_sampling, shotgun_count)
+            finally:
+                ds.close()
+
+        if cacheable:
+            if len(cls._fingerprint_cache) >= cls.FINGERPRINT_CACHE_LIMIT:
+                cls._fingerprint_cache.clear()
+            cls._fingerprint_cache[key] = (mtime, size), fingerprint
+
+        return fingerprint
+
+    @classmethod
+    def _get_fingerprints(cls, file_info, data_sampling=None, shotgun_count=10):
+        """
+        Calculate the fingerprints of a set of datasets, only re-calculating those of the files that changed
+        @param file_info list of tuples as returned by handler_utils.list_file_info: (path[, mtime[, size, ...]])
+        @param data_sampling the DatasetDescriptionDataSamplingEnum of the data to include in the fingerprints
+        @param shotgun_count the number of values sampled per variable for DatasetDescriptionDataSamplingEnum.SHOTGUN
+        @retval dict of fingerprints by path
+        """
+        ret = {}
+        for info in file_info:
+            if not isinstance(info, tuple):
+                info = (info,)
+            mtime = info[1] if len(info) > 1 else None
+            size = info[2] if len(info) > 2 else None
+            ret[info[0]] = cls._get_file_fingerprint(info[0], mtime, size, data_sampling, shotgun_count)
+
+        return ret
+
+    @classmethod
+    def _get_fingerprint(cls, ds, data_sampling=None, shotgun_count=10):
         """
         Calculate the fingerprint of the dataset
         @param ds the dataset
+        @param data_sampling the DatasetDescriptionDataSamplingEnum of the data to include in the fingerprint,
+        by default only the structure and attributes of the dataset are
+        @param shotgun_count the number of values sampled per variable for DatasetDescriptionDataSamplingEnum.SHOTGUN
         @retval a fingerprint representing the dataset and its contents
         """
 
@@ -173,32 +338,8 @@ class NetcdfDataHandler(BaseDataHandler):
                     var_atts[ak] = hashlib.sha1(str(att)).hexdigest()
                     var_sha.update(var_atts[ak])
 
-                #                if not data_sampling is DatasetDescriptionDataSamplingEnum.NONE:
-                #                    var = self.get_variable_data(vk.index_key)
-                #                    if data_sampling is DatasetDescriptionDataSamplingEnum.FIRST_LAST:
-                #                        slice_first = []
-                #                        slice_last = []
-                #                        for s in var.shape:
-                #                            # get the first...where outer dims == 0 and the innermost == 1
-                #                            slice_first.append(slice(0, 1))
-                #                            # get the last...where outer dims == max for dim
-                #                            slice_last.append(slice(s-1,s))
-                #
-                #                        dat_f = var[slice_first]
-                #                        dat_l = var[slice_last]
-                #
-                #                        # add the string data arrays into the sha
-                #                        var_sha.update(str(dat_f))
-                #                        var_sha.update(str(dat_l))
-                #
-                #                    elif data_sampling is DatasetDescriptionDataSamplingEnum.FULL:
-                #                        var_sha.update(str(var[:]))
-                #                        pass
-                #                    elif data_sampling is DatasetDescriptionDataSamplingEnum.SHOTGUN:
-                #                        shotgun_count = kwargs[DatasetDescriptionDataSamplingEnum.SHOTGUN_COUNT] or 10
-                #                        pass
-                #                    else:
-                #                        pass
+                if data_sampling not in (None, DatasetDescriptionDataSamplingEnum.NONE):
+                    cls._update_data_sha(var_sha, var, data_sampling, shotgun_count)
 
                 var_map[vk] = var_sha.hexdigest(), var_atts
 
@@ -240,6 +381,56 @@ class NetcdfDataHandler(BaseDataHandler):
 
         return sha_full.hexdigest(), ret
 
+    @classmethod
+    def _update_data_sha(cls, var_sha, var, data_sampling, shotgun_count=10):
+        """
+        Adds the shape and a sample of the values of the variable to its sha
+        @param var_sha the sha of the variable
+        @param var the variable
+        @param data_sampling the DatasetDescriptionDataSamplingEnum of the values to add
+        @param shotgun_count the number of values sampled for DatasetDescriptionDataSamplingEnum.SHOTGUN
+        """
+        shape = var.shape
+        var_sha.update(str(shape))
+        if 0 in shape:
+            return
+
+        if not shape or data_sampling == DatasetDescriptionDataSamplingEnum.FULL:
+            # Read a block of records at a time so large variables are never held in memory at once
+            if shape:
+                step = max(1, cls.FINGERPRINT_BLOCK_SIZE / max(1, int(np.prod(shape[1:]))))
+                for start in xrange(0, shape[0], step):
+                    var_sha.update(cls._data_string(var[start:start + step]))
+            else:
+                var_sha.update(cls._data_string(var.getValue()))
+
+        elif data_sampling == DatasetDescriptionDataSamplingEnum.FIRST_LAST:
+            var_sha.update(cls._data_string(var[tuple(slice(0, 1) for s in shape)]))
+            var_sha.update(cls._data_string(var[tuple(slice(s - 1, s) for s in shape)]))
+
+        elif data_sampling == DatasetDescriptionDataSamplingEnum.SHOTGUN:
+            # The same, evenly spread, values are sampled for as long as the shape doesn't change
+            size = int(np.prod(shape))
+            for flat_index in np.unique(np.linspace(0, size - 1, max(2, shotgun_count)).astype(np.int64)):
+                index = np.unravel_index(flat_index, shape)
+                var_sha.update(cls._data_string(var[tuple(slice(i, i + 1) for i in index)]))
+
+        else:
+            log.warn('Unknown data sampling: {0}'.format(data_sampling))
+
+    @classmethod
+    def _data_string(cls, arr):
+        """
+        Returns the values of the (possibly masked) array as a string, with masked values replaced by a fixed fill
+        """
+        if np.ma.isMaskedArray(arr):
+            arr = arr.filled(0) if np.ma.count_masked(arr) else arr.data
+        arr = np.asarray(arr)
+        if arr.dtype == object:
+            # Variable length strings
+            return str(arr.tolist())
+        return np.ascontiguousarray(arr).tostring()
+
     def _compare(self, base_fingerprint, new_fingerprint):
         """
         Compares two fingerprints to see what, if anything, is different
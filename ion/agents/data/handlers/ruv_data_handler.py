@@ -9,7 +9,7 @@
 from pyon.public import log
 from pyon.util.containers import get_safe
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler, NoNewDataWarning
-from ion.agents.data.handlers.handler_utils import list_file_info, get_sbuffer, get_time_from_filename
+from ion.agents.data.handlers.handler_utils import list_file_info, get_listing_cache, get_sbuffer, get_time_from_filename
 import numpy as np
 import re
 from StringIO import StringIO
@@ -51,7 +51,7 @@ class RuvDataHandler(BaseDataHandler):
         date_pattern = get_safe(config, 'ds_params.date_pattern')
         date_extraction_pattern = get_safe(config, 'ds_params.date_extraction_pattern')
 
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         # Determine which files are new
         new_list = [x for x in curr_list if x not in old_list]
@@ -82,7 +82,7 @@ class RuvDataHandler(BaseDataHandler):
         end_time = get_safe(config, 'constraints.end_time')
 
         new_list = []
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         for x in curr_list:
             curr_time = get_time_from_filename(x[0], date_extraction_pattern, date_pattern)
@@ -41,7 +41,7 @@ from pyon.util.containers import get_safe, named_any
 from ion.agents.populate_rdt import populate_rdt
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler
-from ion.agents.data.handlers.handler_utils import list_file_info, calculate_iteration_count, get_time_from_filename
+from ion.agents.data.handlers.handler_utils import list_file_info, get_listing_cache, calculate_iteration_count, get_time_from_filename
 
 
 DH_CONFIG_DETAILS = {
@@ -87,7 +87,7 @@ class SBE52BinaryDataHandler(BaseDataHandler):
         date_pattern = get_safe(config, 'ds_params.date_pattern')
         date_extraction_pattern = get_safe(config, 'ds_params.date_extraction_pattern')
 
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         #compare the last read files (old_list) with the current directory contents (curr_list)
         #if the file names are the same (curr_file[0] and old_file[0]) check the size of the
@@ -123,7 +123,7 @@ class SBE52BinaryDataHandler(BaseDataHandler):
         end_time = get_safe(config, 'constraints.end_time')
 
         new_list = []
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         new_list = curr_list
 
@@ -176,12 +176,13 @@ class SBE52BinaryDataHandler(BaseDataHandler):
 # TODO: record files already read for future additions...
 #                    #update new data check with the latest file position
                     if 'set_new_data_check' in config and index > -1:
-                        # WRONG: should only record this after file finished parsing,
-                        # but may not have another yield at that point to trigger update
+                        # The state once everything was published, checkpoints only record the file once it's finished
                         config['set_new_data_check'][index] = (f[0], f[1], f[2], size)
 
                     yield g
 
+                cls._set_published(config, (f[0], f[1], f[2], size))
+
 #                parser.close()
 
             except Exception as ex:
@@ -11,7 +11,7 @@ from pyon.public import log
 from pyon.util.containers import get_safe
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler
-from ion.agents.data.handlers.handler_utils import list_file_info, get_sbuffer, calculate_iteration_count, get_time_from_filename
+from ion.agents.data.handlers.handler_utils import list_file_info, get_listing_cache, get_sbuffer, calculate_iteration_count, get_time_from_filename
 import numpy as np
 
 DH_CONFIG_DETAILS = {
@@ -54,7 +54,7 @@ class SlocumDataHandler(BaseDataHandler):
         date_pattern = get_safe(config, 'ds_params.date_pattern')
         date_extraction_pattern = get_safe(config, 'ds_params.date_extraction_pattern')
 
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         new_list = [x for x in curr_list if x not in old_list]
 
@@ -78,7 +78,7 @@ class SlocumDataHandler(BaseDataHandler):
         end_time = get_safe(config, 'constraints.end_time')
 
         new_list = []
-        curr_list = list_file_info(base_url, list_pattern)
+        curr_list = list_file_info(base_url, list_pattern, cache=get_listing_cache(config))
 
         for x in curr_list:
             curr_time = get_time_from_filename(x[0], date_extraction_pattern, date_pattern)
@@ -11,7 +11,7 @@
 from nose.plugins.attrib import attr
 from mock import patch, Mock, call, sentinel, MagicMock
 from pyon.util.unit_test import PyonTestCase
-from pyon.core.exception import NotFound
+from pyon.core.exception import NotFound, Conflict
 from pyon.ion.stream import StandaloneStreamPublisher
 import unittest
 
@@ -21,7 +21,7 @@ from ion.agents.instrument.exceptions import InstrumentParameterException,\
 from interface.objects import Granule, Attachment, StreamRoute
 
 from ion.agents.data.handlers.base_data_handler import BaseDataHandler,\
-    ConfigurationError, DummyDataHandler, FibonacciDataHandler
+    ConfigurationError, DummyDataHandler, FibonacciDataHandler, NewDataCheckStore
 from ion.services.dm.utility.granule.record_dictionary import\
     RecordDictionaryTool
 from pyon.agent.agent import ResourceAgentState
@@ -505,6 +505,7 @@ class TestBaseDataHandlerUnit(PyonTestCase):
                                           'stream_route': stream_route})
         self._bdh._semaphore.acquire.assert_called_once_with(blocking=False)
 
+    @patch.object(NewDataCheckStore, 'read', Mock(return_value=None))
     @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
     def test__find_new_data_check_attachment(self, rr_cli_cls):
         rr_cli = rr_cli_cls.return_value
@@ -520,6 +521,7 @@ class TestBaseDataHandlerUnit(PyonTestCase):
             include_content=True,
             id_only=False)
 
+    @patch.object(NewDataCheckStore, 'read', Mock(return_value=None))
     @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
     def test__find_new_data_check_attachment_no_newdatacheck(self, rr_cli_cls):
         rr_cli = rr_cli_cls.return_value
@@ -535,6 +537,7 @@ class TestBaseDataHandlerUnit(PyonTestCase):
             include_content=True,
             id_only=False)
 
+    @patch.object(NewDataCheckStore, 'read', Mock(return_value=None))
     @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
     def test__find_new_data_check_attachment_raise_notfound(self, rr_cli_cls):
         rr_cli = rr_cli_cls.return_value
@@ -548,62 +551,106 @@ class TestBaseDataHandlerUnit(PyonTestCase):
             id_only=False)
 
     @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
-    def test__update_new_data_check_attachment(self, rr_cli_cls):
-        rr_cli = rr_cli_cls.return_value
-        attachment_1 = Mock()
-        attachment_1._id = 'attachment_1'
-        attachment_1.keywords = ['NewDataCheck']
-        attachment_1.content = 'content'
-
-        attachment_2 = Mock()
-        attachment_2._id = 'attachment_2'
-        attachment_2.keywords = ['NewDataCheck']
-        attachment_2.content = 'new_content'
-        rr_cli.find_attachments.return_value = [attachment_1]
-        rr_cli.create_attachment.return_value = attachment_2._id
-
-        self._bdh._update_new_data_check_attachment(res_id='res_id',
-            new_content=attachment_2.content)
-        rr_cli.find_attachments.assert_called_once_with(resource_id='res_id',
-            include_content=False,
-            id_only=False)
-        rr_cli.delete_attachment.assert_called_once_with(attachment_1._id)
-        self.assertTrue(rr_cli.create_attachment.called)
-
-    @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
-    def test__update_new_data_check_attachment_no_newdatacheck(self, rr_cli_cls):
-        rr_cli = rr_cli_cls.return_value
-        attachment_1 = Mock()
-        attachment_1._id = 'attachment_1'
-        attachment_1.keywords = ['notfound']
-        attachment_1.content = 'content'
+    @patch.object(NewDataCheckStore, 'read')
+    def test__find_new_data_check_document(self, read_mock, rr_cli_cls):
+        read_mock.return_value = [['file_1', 1, 100]]
 
-        attachment_2 = Mock()
-        attachment_2._id = 'attachment_2'
-        attachment_2.keywords = ['NewDataCheck']
-        attachment_2.content = 'new_content'
-        rr_cli.find_attachments.return_value = [attachment_1]
-        rr_cli.create_attachment.return_value = attachment_2._id
-
-        self._bdh._update_new_data_check_attachment(res_id='res_id',
-            new_content=attachment_2.content)
-        rr_cli.find_attachments.assert_called_once_with(resource_id='res_id',
-            include_content=False,
-            id_only=False)
-        self.assertTrue(rr_cli.create_attachment.called)
-
-    @patch('ion.agents.data.handlers.base_data_handler.ResourceRegistryServiceClient')
-    def test__update_new_data_check_attachment_raise_notfound(self, rr_cli_cls):
-        rr_cli = rr_cli_cls.return_value
-        rr_cli.find_attachments.side_effect = NotFound
-
-        with self.assertRaises(InstrumentException):
-            self._bdh._update_new_data_check_attachment(res_id='not_found',
-                new_content='new_content')
+        ret = self._bdh._find_new_data_check_attachment(res_id='res_id')
+        self.assertEqual(ret, [['file_1', 1, 100]])
+        read_mock.assert_called_once_with('res_id')
+        self.assertFalse(rr_cli_cls.called)
+
+    @patch.object(NewDataCheckStore, '_object_store')
+    def test__update_new_data_check_attachment(self, object_store_cls):
+        object_store = object_store_cls.return_value
+        object_store.create_doc.return_value = ('NewDataCheck_res_id', 'rev_1')
+        object_store.update_doc.return_value = ('NewDataCheck_res_id', 'rev_2')
+        NewDataCheckStore._revs.pop('res_id', None)
+
+        # The document is created once, then updated in place
+        self._bdh._update_new_data_check_attachment(res_id='res_id', new_content=['content'])
+        object_store.create_doc.assert_called_once_with({'resource_id': 'res_id', 'content': ['content']},
+                                                        object_id='NewDataCheck_res_id')
+        self._bdh._update_new_data_check_attachment(res_id='res_id', new_content=['new_content'])
+        object_store.update_doc.assert_called_once_with({'resource_id': 'res_id', 'content': ['new_content'],
+                                                         '_id': 'NewDataCheck_res_id', '_rev': 'rev_1'})
+        self.assertFalse(object_store.read_doc.called)
+        self.assertEqual(NewDataCheckStore._revs['res_id'], 'rev_2')
+
+    @patch.object(NewDataCheckStore, '_object_store')
+    def test__update_new_data_check_attachment_conflict(self, object_store_cls):
+        object_store = object_store_cls.return_value
+        object_store.update_doc.side_effect = [Conflict, ('NewDataCheck_res_id', 'rev_3')]
+        object_store.read_doc.return_value = {'_id': 'NewDataCheck_res_id', '_rev': 'rev_2'}
+        NewDataCheckStore._revs['res_id'] = 'rev_1'
+
+        self._bdh._update_new_data_check_attachment(res_id='res_id', new_content=['content'])
+        self.assertEqual(object_store.update_doc.call_args[0][0]['_rev'], 'rev_2')
+        self.assertEqual(NewDataCheckStore._revs['res_id'], 'rev_3')
+
+    def _file_granules(self, config, files, granules):
+        # Two granules per file, its progress is recorded once the generator resumes after each
+        for name in files:
+            for i in xrange(2):
+                granule = Mock(spec=Granule)
+                granules.append(granule)
+                yield granule
+                BaseDataHandler._set_published(config, (name, 0, 10, (i + 1) * 5))
 
-        rr_cli.find_attachments.assert_called_once_with(resource_id='not_found',
-            include_content=False,
-            id_only=False)
+    @patch('ion.agents.data.handlers.base_data_handler.time')
+    def test__publish_data_checkpoints(self, time_mock):
+        time_mock.time.return_value = 0
+        publisher = Mock()
+        update = Mock()
+        config = {'external_dataset_res_id': 'res_id', 'set_new_data_check': ['state'], 'new_data_check': [('old', 0, 10, 10)],
+                  'checkpoint_granules': 3, 'checkpoint_interval': 60}
+        granules = []
+
+        BaseDataHandler._publish_data(publisher, self._file_granules(config, ['a', 'b', 'c'], granules), config, update)
+        self.assertEqual(publisher.publish.call_count, 6)
+        # After granules 3 and 6, only covering what was published, and the whole state at the end
+        self.assertEqual(update.call_args_list, [
+            call('res_id', [('old', 0, 10, 10), ('a', 0, 10, 10)]),
+            call('res_id', [('old', 0, 10, 10), ('a', 0, 10, 10), ('b', 0, 10, 10), ('c', 0, 10, 5)]),
+            call('res_id', ['state'])])
+
+        # Checkpoints on time too
+        update.reset_mock()
+        config.pop('published_new_data_check')
+        time_mock.time.side_effect = [0] + [i * 40 for i in xrange(1, 11)]
+        BaseDataHandler._publish_data(publisher, self._file_granules(config, ['a', 'b'], granules), config, update)
+        self.assertEqual(update.call_count, 3)
+
+    def test__publish_data_checkpoint_on_failure(self):
+        config = {'external_dataset_res_id': 'res_id', 'set_new_data_check': ['state'],
+                  'checkpoint_granules': 100}
+
+        # Failing to get data: what was published is checkpointed
+        def data_generator():
+            for granule in self._file_granules(config, ['a'], []):
+                yield granule
+            raise InstrumentDataException()
+        update = Mock()
+        with self.assertRaises(InstrumentDataException):
+            BaseDataHandler._publish_data(Mock(), data_generator(), config, update)
+        update.assert_called_once_with('res_id', [('a', 0, 10, 10)])
+
+        # Failing to publish: the unpublished granule isn't checkpointed
+        config.pop('published_new_data_check')
+        publisher = Mock()
+        publisher.publish.side_effect = [None, InstrumentDataException()]
+        update = Mock()
+        with self.assertRaises(InstrumentDataException):
+            BaseDataHandler._publish_data(publisher, self._file_granules(config, ['a'], []), config, update)
+        update.assert_called_once_with('res_id', [('a', 0, 10, 5)])
+
+        # Handlers that don't record their progress only checkpoint once everything was published
+        config.pop('published_new_data_check')
+        publisher.publish.side_effect = [None, InstrumentDataException()]
+        update = Mock()
+        with self.assertRaises(InstrumentDataException):
+            BaseDataHandler._publish_data(publisher, [Mock(spec=Granule)] * 2, config, update)
+        self.assertEqual(update.call_count, 0)
 
     @patch('ion.agents.data.handlers.base_data_handler.StandaloneStreamPublisher', spec=StandaloneStreamPublisher)
     @patch('ion.agents.data.handlers.base_data_handler.spawn')
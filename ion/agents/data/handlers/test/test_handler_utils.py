@@ -2,12 +2,20 @@ from mock import MagicMock, patch
 from nose.plugins.attrib import attr
 from ion.agents.data.handlers.handler_utils import _get_type, list_file_info, \
     list_file_info_http, list_file_info_ftp, list_file_info_fs, \
-    get_time_from_filename, calculate_iteration_count, get_sbuffer
+    get_time_from_filename, calculate_iteration_count, get_sbuffer, \
+    FileListingCache, get_listing_cache
 from pyon.util.unit_test import PyonTestCase
 
 import requests
 from ftplib import FTP
 from StringIO import StringIO
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 
 @attr('UNIT', group='eoi')
@@ -154,3 +162,177 @@ class TestHandlerUtils(PyonTestCase):
     def test_get_sbuffer_ftp(self):
         with self.assertRaises(NotImplementedError):
             get_sbuffer(url='http://marine.rutgers.edu/cool/maracoos/codar/ooi/radials/BELM/', type='ftp')
+
+
+class ListingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves an Apache style listing of the server's directory, with an ETag
+    """
+    def do_GET(self):
+        names = sorted(os.listdir(self.server.directory))
+        etag = '"%s"' % hashlib.sha1(str(names)).hexdigest()
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        content = '<html><body>' + ''.join('<a href="%s">%s</a>\n' % (n, n) for n in names) + '</body></html>'
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@attr('UNIT', group='eoi')
+class TestFileListingCache(PyonTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def _write(self, name, content='data', directory=None):
+        with open(os.path.join(directory or self.directory, name), 'w') as f:
+            f.write(content)
+
+    def _age_directory(self, directory=None):
+        # Past the racy interval, so the directory listing can be reused
+        directory = directory or self.directory
+        mtime = time.time() - 10
+        os.utime(directory, (mtime, mtime))
+
+    def _start_server(self):
+        server = BaseHTTPServer.HTTPServer(('localhost', 0), ListingRequestHandler)
+        server.directory = self.directory
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://localhost:%d/' % server.server_address[1]
+
+    def test_fs(self):
+        for i in xrange(5):
+            self._write('file_%d.dat' % i)
+        self._write('other.txt')
+        self._age_directory()
+
+        cache = FileListingCache()
+        listing, added, removed = cache.update(self.directory, '*.dat')
+        self.assertEqual(listing, list_file_info_fs(self.directory, '*.dat'))
+        self.assertEqual(added, listing)
+        self.assertEqual(removed, [])
+
+        # An unchanged directory isn't read again
+        with patch('ion.agents.data.handlers.handler_utils.glob.glob1') as glob1:
+            self.assertEqual(cache.update(self.directory, '*.dat'), (listing, [], []))
+            self.assertFalse(glob1.called)
+
+        # New, changed and removed files
+        self._write('file_5.dat')
+        self._write('file_0.dat', 'more data')
+        os.remove(os.path.join(self.directory, 'file_1.dat'))
+        listing2, added, removed = cache.update(self.directory, '*.dat')
+        self.assertEqual(listing2, list_file_info_fs(self.directory, '*.dat'))
+        self.assertEqual(sorted(x[0] for x in added), [os.path.join(self.directory, 'file_%d.dat' % i) for i in (0, 5)])
+        self.assertEqual(sorted(x[0] for x in removed), [os.path.join(self.directory, 'file_%d.dat' % i) for i in (0, 1)])
+
+        # list_file_info takes the cache
+        self.assertEqual(list_file_info(self.directory, '*.dat', cache=cache), listing2)
+
+    def test_fs_sub_directory(self):
+        sub = os.path.join(self.directory, 'sub')
+        os.mkdir(sub)
+        self._write('file_0.dat', directory=sub)
+        self._age_directory(sub)
+        self._age_directory()
+
+        cache = FileListingCache()
+        self.assertEqual(cache.list(self.directory, 'sub/*.dat'), list_file_info_fs(self.directory, 'sub/*.dat'))
+
+        # Files added to the sub-directory only change its modification time
+        self._write('file_1.dat', directory=sub)
+        listing, added, removed = cache.update(self.directory, 'sub/*.dat')
+        self.assertEqual(listing, list_file_info_fs(self.directory, 'sub/*.dat'))
+        self.assertEqual([x[0] for x in added], [os.path.join(sub, 'file_1.dat')])
+
+        shutil.rmtree(sub)
+        self.assertEqual(cache.list(self.directory, 'sub/*.dat'), [])
+
+    def test_fs_immutable_files(self):
+        for i in xrange(5):
+            self._write('file_%d.dat' % i)
+
+        cache = FileListingCache(immutable_files=True)
+        listing = cache.list(self.directory, '*.dat')
+        self._write('file_5.dat')
+        with patch('ion.agents.data.handlers.handler_utils.os.stat', wraps=os.stat) as stat:
+            listing, added, removed = cache.update(self.directory, '*.dat')
+            # Only the new file
+            self.assertEqual([c[0][0] for c in stat.call_args_list if c[0][0].endswith('.dat')],
+                             [os.path.join(self.directory, 'file_5.dat')])
+        self.assertEqual(listing, list_file_info_fs(self.directory, '*.dat'))
+        self.assertEqual([x[0] for x in added], [os.path.join(self.directory, 'file_5.dat')])
+
+    def test_persisted(self):
+        for i in xrange(5):
+            self._write('file_%d.dat' % i)
+        listing = FileListingCache(self.cache_dir).list(self.directory, '*.dat')
+
+        # A new cache resumes from the persisted listing
+        self._write('file_5.dat')
+        listing2, added, removed = FileListingCache(self.cache_dir).update(self.directory, '*.dat')
+        self.assertEqual(set(listing2) - set(listing), set(added))
+        self.assertEqual([x[0] for x in added], [os.path.join(self.directory, 'file_5.dat')])
+        self.assertEqual(removed, [])
+
+        # Shared by the handlers with the same configuration
+        config = {'ds_params': {'listing_cache_dir': self.cache_dir}}
+        self.assertIs(get_listing_cache(config), get_listing_cache(config))
+        self.assertEqual(get_listing_cache(config).cache_dir, self.cache_dir)
+        self.assertIsNone(get_listing_cache({'ds_params': {'listing_cache': False}}))
+
+    def test_http(self):
+        for i in xrange(5):
+            self._write('file_%d.dat' % i)
+        server, url = self._start_server()
+        pattern = '<a href="([^"]*\.dat)">'
+
+        cache = FileListingCache(self.cache_dir)
+        listing, added, removed = cache.update(url, pattern)
+        self.assertEqual(listing, list_file_info_http(url, pattern))
+        self.assertEqual(len(added), 5)
+
+        # Unchanged listings aren't sent (or parsed) again
+        with patch('ion.agents.data.handlers.handler_utils._parse_file_info_http') as parse:
+            self.assertEqual(cache.update(url, pattern), (listing, [], []))
+            self.assertFalse(parse.called)
+        self.assertIsNone(server.requests[0])
+        self.assertIsNotNone(server.requests[-1])
+
+        self._write('file_5.dat')
+        listing, added, removed = FileListingCache(self.cache_dir).update(url, pattern)
+        self.assertEqual(added, [(url + 'file_5.dat',)])
+        self.assertEqual(removed, [])
+
+    def test_update_many(self):
+        directories = []
+        for d in xrange(3):
+            directory = os.path.join(self.directory, 'dir_%d' % d)
+            os.mkdir(directory)
+            for i in xrange(d + 1):
+                self._write('file_%d.dat' % i, directory=directory)
+            directories.append(directory)
+        server, url = self._start_server()
+        pattern = '<a href="([^"]*)">'
+
+        sources = [(directory, '*.dat') for directory in directories] + [(url, pattern)]
+        results = FileListingCache().update_many(sources, workers=2)
+        self.assertEqual([r[0] for r in results], [list_file_info(*source) for source in sources])
+        self.assertEqual([len(r[1]) for r in results], [1, 2, 3, 3])
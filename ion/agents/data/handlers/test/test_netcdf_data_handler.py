@@ -14,10 +14,17 @@ from mock import Mock, sentinel, MagicMock, patch
 
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.agents.data.handlers.netcdf_data_handler import NetcdfDataHandler
-from interface.objects import ContactInformation, UpdateDescription, DatasetDescription, ExternalDataset, Granule
+from ion.agents.data.handlers.handler_utils import calculate_iteration_count, list_file_info
+from interface.objects import ContactInformation, UpdateDescription, DatasetDescription, ExternalDataset, Granule,\
+    DatasetDescriptionDataSamplingEnum
 from netCDF4 import Dataset
 from pyon.core.interceptor.encode import encode_ion
 import msgpack
+import gevent
+import numpy as np
+import os
+import shutil
+import tempfile
 
 
 @attr('UNIT', group='eoi')
@@ -133,17 +140,226 @@ class TestNetcdfDataHandlerUnit(PyonTestCase):
         retval = MagicMock(spec=RecordDictionaryTool)
         retval.__setitem__ = Mock(side_effect=setitem)
         retval.to_granule.return_value = MagicMock(spec=Granule)
+        retval.copy.return_value = retval
         RecordDictionaryTool_mock.return_value = retval
 
         for x in NetcdfDataHandler._get_data(config):
             self.assertTrue(isinstance(x, Granule))
             retval.to_granule.assert_any_call()
 
+    @patch('ion.agents.data.handlers.netcdf_data_handler.RecordDictionaryTool')
+    def test__get_data_streaming(self, RecordDictionaryTool_mock):
+        edres = ExternalDataset(name='test_ed_res', dataset_description=DatasetDescription(), update_description=UpdateDescription(), contact=ContactInformation())
+        edres.dataset_description.parameters['dataset_path'] = 'test_data/usgs.nc'
+        edres.dataset_description.parameters['temporal_dimension'] = 'time'
+        edres.dataset_description.parameters['zonal_dimension'] = 'lat'
+        edres.dataset_description.parameters['meridional_dimension'] = 'lon'
+        edres.dataset_description.parameters['vertical_dimension'] = 'z'
+        edres.dataset_description.parameters['variables'] = ['water_temperature', 'streamflow']
+
+        ds = Dataset(edres.dataset_description.parameters['dataset_path'])
+        t_slice = slice(1, len(ds.variables['time']) - 1)
+        expected_time = ds.variables['time'][t_slice]
+        expected_temp = ds.variables['water_temperature'][t_slice]
+
+        for prefetch in (0, 1, 3):
+            granules = []
+            template = MagicMock(spec=RecordDictionaryTool)
+
+            def copy():
+                rdt = {}
+                rdt_mock = MagicMock(spec=RecordDictionaryTool)
+                rdt_mock.__setitem__ = Mock(side_effect=rdt.__setitem__)
+                rdt_mock.to_granule.side_effect = lambda: granules.append(rdt) or MagicMock(spec=Granule)
+                return rdt_mock
+            template.copy.side_effect = copy
+            RecordDictionaryTool_mock.reset_mock()
+            RecordDictionaryTool_mock.return_value = template
+
+            config = {'external_dataset_res': edres,
+                      'dataset_object': Dataset(edres.dataset_description.parameters['dataset_path']),
+                      'constraints': {'temporal_slice': t_slice},
+                      'max_records': 4,
+                      'prefetch': prefetch,
+                      'stream_def': sentinel.stream_def_id}
+
+            for x in NetcdfDataHandler._get_data(config):
+                self.assertTrue(isinstance(x, Granule))
+
+            # One template per acquisition, with the coordinates set once
+            RecordDictionaryTool_mock.assert_called_once_with(stream_definition_id=sentinel.stream_def_id)
+            self.assertEqual([c[0][0] for c in template.__setitem__.call_args_list], ['lat', 'lon', 'z'])
+
+            self.assertEqual(len(granules), calculate_iteration_count(expected_time.size, 4))
+            self.assertTrue(all(len(g['time']) <= 4 for g in granules))
+            self.assertTrue(np.array_equal(np.concatenate([g['time'] for g in granules]), expected_time))
+            self.assertTrue(np.array_equal(np.concatenate([g['water_temperature'] for g in granules]), expected_temp))
+
+    def test__chunk_slices(self):
+        arr = np.arange(23)
+        for t_slice in (slice(None), slice(0, 1), slice(3, 17), slice(-5, None), slice(2, 20, 3),
+                        slice(None, None, -1), slice(20, 2, -4), slice(30, 40), slice(5, 5)):
+            for max_rec in (1, 4, 23, 50):
+                chunks = NetcdfDataHandler._chunk_slices(t_slice, arr.size, max_rec)
+                self.assertTrue(all(0 < arr[c].size <= max_rec for c in chunks))
+                self.assertEqual(list(np.concatenate([arr[c] for c in chunks] or [[]])), list(arr[t_slice]))
+
+    def test__prefetch(self):
+        for depth in (0, 1, 5):
+            self.assertEqual(list(NetcdfDataHandler._prefetch(lambda x: x * 2, xrange(10), depth)), range(0, 20, 2))
+
+        def fail(x):
+            if x == 3:
+                raise ValueError()
+            return x
+        results = []
+        with self.assertRaises(ValueError):
+            for x in NetcdfDataHandler._prefetch(fail, xrange(10), 2):
+                results.append(x)
+        self.assertEqual(results, [0, 1, 2])
+
+        # Closing the consumer stops the producer
+        func = Mock(side_effect=lambda x: x)
+        gen = NetcdfDataHandler._prefetch(func, xrange(100), 2)
+        self.assertEqual(next(gen), 0)
+        gen.close()
+        gevent.sleep(0.1)
+        self.assertLess(func.call_count, 10)
+
     def test__get_fingerprint(self):
         ds = Dataset('test_data/ncom.nc')
         retval = NetcdfDataHandler._get_fingerprint(ds)
         log.debug(retval)
 
+    def test__get_fingerprint_data_sampling(self):
+        ds = Dataset('test_data/usgs.nc')
+        structure = NetcdfDataHandler._get_fingerprint(ds)
+        self.assertEqual(NetcdfDataHandler._get_fingerprint(ds, DatasetDescriptionDataSamplingEnum.NONE), structure)
+
+        fingerprints = set()
+        for data_sampling in (DatasetDescriptionDataSamplingEnum.FIRST_LAST, DatasetDescriptionDataSamplingEnum.SHOTGUN,
+                              DatasetDescriptionDataSamplingEnum.FULL):
+            fingerprint = NetcdfDataHandler._get_fingerprint(ds, data_sampling)
+            self.assertEqual(NetcdfDataHandler._get_fingerprint(ds, data_sampling), fingerprint)
+            self.assertEqual(set(fingerprint[1]), set(structure[1]))
+            fingerprints.add(fingerprint[0])
+        self.assertNotIn(structure[0], fingerprints)
+
+    def _copy_dataset(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'usgs.nc')
+        shutil.copy('test_data/usgs.nc', path)
+        return path
+
+    def test__get_fingerprint_data_change(self):
+        path = self._copy_dataset()
+        sampling = (None, DatasetDescriptionDataSamplingEnum.FIRST_LAST, DatasetDescriptionDataSamplingEnum.FULL)
+        ds = Dataset(path)
+        before = [NetcdfDataHandler._get_fingerprint(ds, data_sampling) for data_sampling in sampling]
+        ds.close()
+
+        ds = Dataset(path, 'a')
+        var = ds.variables['water_temperature']
+        var[-1] = 1234.5
+        ds.close()
+
+        ds = Dataset(path)
+        after = [NetcdfDataHandler._get_fingerprint(ds, data_sampling) for data_sampling in sampling]
+        ds.close()
+
+        # Only the data-aware fingerprints see the new value
+        self.assertEqual(before[0], after[0])
+        for b, a in zip(before[1:], after[1:]):
+            self.assertNotEqual(b[0], a[0])
+            self.assertNotEqual(b[1]['vars'][1]['water_temperature'], a[1]['vars'][1]['water_temperature'])
+            self.assertEqual(b[1]['vars'][1]['time'], a[1]['vars'][1]['time'])
+
+    @patch.object(NetcdfDataHandler, '_fingerprint_cache', {})
+    def test__get_file_fingerprint_cache(self):
+        path = self._copy_dataset()
+        ds = Dataset(path)
+        expected = NetcdfDataHandler._get_fingerprint(ds)
+        ds.close()
+
+        with patch.object(NetcdfDataHandler, '_get_fingerprint', wraps=NetcdfDataHandler._get_fingerprint) as get_fingerprint:
+            self.assertEqual(NetcdfDataHandler._get_file_fingerprint(path), expected)
+            self.assertEqual(NetcdfDataHandler._get_file_fingerprint(path), expected)
+            self.assertEqual(get_fingerprint.call_count, 1)
+
+            # Modified files and other samplings are fingerprinted again
+            mtime = os.path.getmtime(path)
+            os.utime(path, (mtime + 10, mtime + 10))
+            NetcdfDataHandler._get_file_fingerprint(path)
+            self.assertEqual(get_fingerprint.call_count, 2)
+            NetcdfDataHandler._get_file_fingerprint(path, data_sampling=DatasetDescriptionDataSamplingEnum.FIRST_LAST)
+            self.assertEqual(get_fingerprint.call_count, 3)
+
+            # A file set listing only fingerprints what changed
+            file_info = list_file_info(os.path.dirname(path), '*.nc')
+            self.assertEqual(NetcdfDataHandler._get_fingerprints(file_info), {path: expected})
+            self.assertEqual(get_fingerprint.call_count, 3)
+
+            # Without a modification time or size a remote dataset can't be cached
+            with patch('ion.agents.data.handlers.netcdf_data_handler.os.path.isfile', return_value=False):
+                NetcdfDataHandler._get_fingerprints([(path,)])
+                NetcdfDataHandler._get_fingerprints([(path,)])
+            self.assertEqual(get_fingerprint.call_count, 5)
+
+    def _poll(self, edres, ds):
+        config = {'external_dataset_res': edres, 'dataset_object': ds}
+        return NetcdfDataHandler._constraints_for_new_request(config)['temporal_slice']
+
+    def _new_data_resource(self, path, data_sampling):
+        edres = ExternalDataset(name='test_ed_res', dataset_description=DatasetDescription(), update_description=UpdateDescription(), contact=ContactInformation())
+        edres.dataset_description.parameters['dataset_path'] = path
+        edres.dataset_description.parameters['temporal_dimension'] = 'time'
+        edres.dataset_description.data_sampling = data_sampling
+        ds = Dataset(path)
+        times = ds.variables['time'][:]
+        ds.close()
+        edres.update_description.parameters['new_data_check'] = msgpack.packb(times[:100].tolist(), default=encode_ion)
+        return edres, times
+
+    @patch.object(NetcdfDataHandler, '_new_data_cache', {})
+    @patch.object(NetcdfDataHandler, '_fingerprint_cache', {})
+    def test__constraints_for_new_request_unchanged(self):
+        path = self._copy_dataset()
+        edres, times = self._new_data_resource(path, DatasetDescriptionDataSamplingEnum.FULL)
+        ds = Dataset(path)
+        self.addCleanup(ds.close)
+
+        with patch.object(NetcdfDataHandler, '_get_fingerprint', wraps=NetcdfDataHandler._get_fingerprint) as get_fingerprint:
+            self.assertEqual(self._poll(edres, ds), slice(100, 295, None))
+            self.assertEqual(get_fingerprint.call_args[0][1], DatasetDescriptionDataSamplingEnum.FULL)
+
+            # An unchanged dataset gets the same slice without reading the time variable again
+            unread = MagicMock()
+            self.assertEqual(self._poll(edres, unread), slice(100, 295, None))
+            self.assertFalse(unread.variables.__getitem__.called)
+            self.assertEqual(get_fingerprint.call_count, 1)
+
+    @patch.object(NetcdfDataHandler, '_new_data_cache', {})
+    def test__constraints_for_new_request_rewritten(self):
+        path = self._copy_dataset()
+        edres, times = self._new_data_resource(path, DatasetDescriptionDataSamplingEnum.NONE)
+        ds = Dataset(path)
+        self.assertEqual(self._poll(edres, ds), slice(100, 295, None))
+        ds.close()
+        unread = MagicMock()
+        self.assertEqual(self._poll(edres, unread), slice(100, 295, None))
+        self.assertFalse(unread.variables.__getitem__.called)
+
+        # A structural fingerprint doesn't see new times written in place, the file's modification does
+        ds = Dataset(path, 'a')
+        ds.variables['time'][:100] = times[:100] - 1
+        ds.close()
+        mtime = os.path.getmtime(path)
+        os.utime(path, (mtime + 10, mtime + 10))
+        ds = Dataset(path)
+        self.addCleanup(ds.close)
+        self.assertEqual(self._poll(edres, ds), slice(0, 295, None))
+
     def test__compare_equal(self):
         base_fingerprint = ('9a2dcda4a8b8823881f14708c3328047cde6c176', {'dims': ('82aef4d2eb3355675c368f05b028a97b4d076974', {u'time': 'ac442c96b516911fdbf67d49e077645496cf4bb7'}), 'gbl_atts': ('614d96bff45c969c9cf08f9636bc67955985247f', {u'ion_geospatial_vertical_positive': '77346d0447daff959358a0ecbeec83bfd9ec86bb', u'ion_geospatial_lat_min': '48559c14f388bfa389e3bddd3f86fbfc55472b3e', u'source': 'b21cefcd86db619dc52f824849e8751f85d7847a', u'CF:featureType': '2da36ff30a38777c28fe7c9fd17f2a4982050cdc', u'ion_geospatial_lat_max': 'ac15063961ed183c6c7ba66c90483201602b4895', u'ion_geospatial_vertical_max': '38f6d7875e3195bdaee448d2cb6917f3ae4994af', u'Conventions': 'a1c3406199f676d4b90c7273b495fe00c47a5e5f', u'ion_time_coverage_start': '4bd0ba8e3cdacf91109d4b1b977ff9d3cbbc1d9c', u'references': '1e981ae63056fd89a5c93429779f42daeee25f53', u'ion_geospatial_lon_min': '588fb99431cb37aa5444328af1be09c4c8c94f61', u'NCO': '559001a22d744138e76553a04e52ead00c38650c', u'ion_time_coverage_end': 'b8cd51caffd68b595a77bf839bce8ae3ec37c6aa', u'title': '2a011784e88ce5332085af7fb2abaeede89aa721', u'ion_geospatial_lon_max': '588fb99431cb37aa5444328af1be09c4c8c94f61', u'institution': '1112e986b9cbe43dbd758f75c65a2c6fe9c50640', u'ion_geospatial_vertical_min': '38f6d7875e3195bdaee448d2cb6917f3ae4994af'}), 'vars': ('941d3ff0bdfb4d1fb9991f2f2363b66f0564c463', {u'streamflow': ('6710202fcfc74ebd64f9a979abe6a22b1c9dee54', {u'units': 'c329772c90300e531ee80bb19b18c50deb55dbcb', u'long_name': 'bbf1ade4a8b825901c20e884b815d1d684147c5f', u'standard_name': '906f870f9d69c17a115554a4f369e807eb2b73b7', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf'}), u'lon': ('9139b25efd691deec60d870606c43efd5d109369', {u'units': 'f3333f58f05198b1ce9622350d52c1b6be65fedf', u'long_name': 'd2a773ae817d7d07c19d9e37be4e792cec37aff0', u'standard_name': 'd2a773ae817d7d07c19d9e37be4e792cec37aff0', u'_CoordinateAxisType': 'eb9297283a5a34ca7d2cff274e9ff4c0db8ddbc5'}), u'data_qualifier': ('2d1b57081def53fbd187a1aa97cbf9627e4055c4', {u'_FillValue': 'b6589fc6ab0dc82cf12099d1c2d40ab994e8410c', u'flag_meanings': '457c49c797bc533a404955ae1842e237345a5247', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf', u'valid_range': 'aad1409b889ef360dad475dc32649f26d9df142a', u'long_name': '39ad280b35a4716efa8e46f597c355826d97757b', u'flag_values': 'aad1409b889ef360dad475dc32649f26d9df142a'}), u'specific_conductance': ('fff3ceebe90a2c95cc71335c6149f3ffde6408c7', {u'units': 'f177d83132385aba3b671086fead28e76eb775e0', u'long_name': '0646bfc3c2a9692e8df107f40b6c25bf72b29673', u'standard_name': 'd58675e27ed4039cd2385df6c9272eb8af8a3d9e', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf'}), u'water_temperature_bottom': ('c90b36e64f40a3a1c08a95ca139e7769e1c6132d', {u'units': '86385633c95f56f924236571319fc39a4ab157bf', u'long_name': '46ec4f2f9bcb7e58d95a24dc034fe75de2630e73', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf'}), u'time': ('5d4eb6e75f3990319bcd6aec0c8e445c05d506ef', {u'units': 'd779896565174fdacafb4c96fc70455a2ac7d826', u'long_name': '714eea0f4c980736bde0065fe73f573487f08e3a', u'standard_name': '714eea0f4c980736bde0065fe73f573487f08e3a', u'_CoordinateAxisType': '6c82e6dd86807ee3db07e3c82bec1ae1ce00b08b'}), u'stnId': ('2badd3674c0e6937f5ea45786f67b1b5b0e7bcde', {u'long_name': '3ec72d178ffa0ff9e78f8f645e55d1af43cbeec2', u'cf_role': '7e8d422307b3765fe973cfd567009274b02d3756'}), u'lat': ('a806cf5409ed3201819e5beca52bb04e1e7449e8', {u'units': '0f64995555efe141f90225e843501790654ae08c', u'long_name': '5fcccdcf1d079c4a85c92c6fe7c8d29a27e49bed', u'standard_name': '5fcccdcf1d079c4a85c92c6fe7c8d29a27e49bed', u'_CoordinateAxisType': '4b5152274022e4a3e476ccee4ce6ae0e0dfb1c9f'}), u'z': ('4f0c43b6d2fa144f2a28c5b0853ff6c0363676e7', {u'positive': '77346d0447daff959358a0ecbeec83bfd9ec86bb', u'long_name': '1ae7667dfa9dafd04883d07989e99c9da613bae8', u'standard_name': 'f82a8e8dd311d353948062cb1a0b67c9e9850be1', u'_CoordinateZisPositive': '77346d0447daff959358a0ecbeec83bfd9ec86bb', u'units': '6b0d31c0d563223024da45691584643ac78c96e8', u'_CoordinateAxisType': '3f608b4935ead643d43b2642dc4ec863d170aa1d', u'missing_value': 'e23fb30f847fda4fabf293091a78216f980e4c8e'}), u'water_temperature_middle': ('1d5bc255639aea10ba273827d354f1fc3b50233f', {u'units': '86385633c95f56f924236571319fc39a4ab157bf', u'long_name': '0132619eed74bdcfdf9e70920e97feff2d3b7317', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf'}), u'water_temperature': ('1b1c792453f5ed44378e6ed4b813b0cf851bc232', {u'units': '86385633c95f56f924236571319fc39a4ab157bf', u'long_name': '4e470f31ee04784da9ca08953eeb1bd2a10152c9', u'coordinates': '72b91e45da579f5802cb2759d3929e2310b9f8bf'})})})
         dh_config = {}
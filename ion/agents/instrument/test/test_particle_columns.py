@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.instrument.test.test_particle_columns
+@file ion/agents/instrument/test/test_particle_columns.py
+@brief Unit tests for the columnar particle accumulator.
+"""
+
+from pyon.util.unit_test import IonUnitTestCase
+from nose.plugins.attrib import attr
+
+from ion.agents.populate_rdt import ParticleColumns
+
+import base64
+import numpy
+
+
+class MockRDT(dict):
+    """
+    The parts of a RecordDictionaryTool the accumulator uses.
+    """
+    temporal_parameter = 'time'
+
+    def __init__(self, fields):
+        dict.__init__(self)
+        self.fields = fields
+
+    def __contains__(self, key):
+        return key in self.fields
+
+
+def particle(ts, values, **kwargs):
+    p = {'quality_flag' : 'ok',
+         'preferred_timestamp' : 'port_timestamp',
+         'stream_name' : 'parsed',
+         'port_timestamp' : ts,
+         'driver_timestamp' : ts + 0.5,
+         'pkt_format_id' : 'JSON_Data',
+         'values' : values}
+    p.update(kwargs)
+    return p
+
+
+@attr('UNIT', group='mi')
+class TestParticleColumns(IonUnitTestCase):
+
+    def setUp(self):
+        self.fields = ['time', 'port_timestamp', 'driver_timestamp', 'quality_flag', 'temp', 'raw']
+        self.columns = ParticleColumns(MockRDT(self.fields))
+
+    def test_fill(self):
+        self.columns.append(particle(1., [{'value_id' : 'temp', 'value' : 10.},
+                                          {'value_id' : 'unknown', 'value' : 1}]))
+        self.columns.append(particle(2., [{'value_id' : 'temp', 'value' : 11.}],
+                                     preferred_timestamp='driver_timestamp'))
+        self.assertEquals(len(self.columns), 2)
+
+        rdt = self.columns.fill(MockRDT(self.fields))
+        numpy.testing.assert_array_equal(rdt['time'], [1., 2.5])
+        numpy.testing.assert_array_equal(rdt['temp'], [10., 11.])
+        numpy.testing.assert_array_equal(rdt['quality_flag'], ['ok', 'ok'])
+        self.assertNotIn('unknown', rdt.keys())
+        self.assertNotIn('pkt_format_id', rdt.keys())
+
+        # Filling empties the accumulator
+        self.assertEquals(len(self.columns), 0)
+
+    def test_sparse_and_binary(self):
+        self.columns.extend([
+            particle(1., [{'value_id' : 'raw', 'value' : base64.b64encode('abc'), 'binary' : True}]),
+            particle(2., [{'value_id' : 'temp', 'value' : 12.}]),
+            particle(3., [{'value_id' : 'raw', 'value' : base64.b64encode('de'), 'binary' : True}]),
+        ])
+        rdt = self.columns.fill(MockRDT(self.fields))
+        self.assertEquals(rdt['raw'].tolist(), ['abc', None, 'de'])
+        self.assertEquals(rdt['temp'].tolist(), [None, 12., None])
+
+    def test_missing_timestamp(self):
+        self.columns.append({'values' : [{'value_id' : 'temp', 'value' : 1.}]})
+        rdt = self.columns.fill(MockRDT(self.fields))
+        self.assertEquals(rdt['time'].tolist(), [None])
@@ -21,6 +21,7 @@ from pyon.ion.stream import StreamPublisher
 from interface.objects import StreamRoute
 
 from ion.agents.platform.platform_driver_event import AttributeValueDriverEvent
+from ion.agents.platform.platform_driver_event import AlignedAttributeValueDriverEvent
 
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 import numpy
@@ -35,6 +36,10 @@ import uuid
 import logging
 
 
+# elementwise "is None" over object arrays
+_is_none = numpy.frompyfunc(lambda val: val is None, 1, 1)
+
+
 class PlatformAgentStreamPublisher(object):
     """
     Stream publishing support for platform agents.
@@ -161,7 +166,7 @@ class PlatformAgentStreamPublisher(object):
         pub_params = {}
         selected_timestamps = None
 
-        for param_name, param_value in driver_event.vals_dict.iteritems():
+        for param_name, vals, timestamps in self._value_columns(driver_event):
 
             in_rdt = False
             param_name = param_name.lower()
@@ -208,9 +213,6 @@ class PlatformAgentStreamPublisher(object):
             if not in_rdt:
                 continue
 
-            # separate values and timestamps:
-            vals, timestamps = zip(*param_value)
-
             self._agent._dispatch_value_alerts(stream_name, param_name, vals)
 
             # Use fill_value in context to replace any None values:
@@ -220,7 +222,9 @@ class PlatformAgentStreamPublisher(object):
                 log.debug("%r: param_name=%r fill_value=%s",
                           self._platform_id, param_name, fill_value)
                 # do the replacement:
-                vals = [fill_value if val is None else val for val in vals]
+                vals = numpy.array(vals, dtype=object)
+                vals[_is_none(vals).astype(bool)] = fill_value
+                vals = vals.tolist()
 
                 if log.isEnabledFor(logging.TRACE):  # pragma: no cover
                     log.trace("%r: vals array after replacing None with fill_value:\n%s",
@@ -230,8 +234,9 @@ class PlatformAgentStreamPublisher(object):
                 log.warn("%r: unexpected: parameter context not found for %r",
                          self._platform_id, param_name)
 
-            # Set values in rdt:
-            rdt[param_name] = numpy.array(vals)
+            # Set values in rdt (aligned rows are object arrays, let numpy
+            # infer the type from the values):
+            rdt[param_name] = numpy.array(list(vals))
 
             pub_params[param_name] = vals
 
@@ -244,6 +249,21 @@ class PlatformAgentStreamPublisher(object):
         self._publish_granule(stream_name, publisher, param_dict, rdt,
                               pub_params, selected_timestamps)
 
+    def _value_columns(self, driver_event):
+        """
+        Generates (param_name, vals, timestamps) for each attribute in the
+        event. Aligned events are read from their value array directly.
+        """
+        if isinstance(driver_event, AlignedAttributeValueDriverEvent):
+            for param_name, vals in zip(driver_event.attr_ids, driver_event.values):
+                yield param_name, vals, driver_event.timestamps
+            return
+
+        for param_name, param_value in driver_event.vals_dict.iteritems():
+            # separate values and timestamps:
+            vals, timestamps = zip(*param_value)
+            yield param_name, vals, timestamps
+
     def _publish_granule(self, stream_name, publisher, param_dict, rdt,
                          pub_params, timestamps):
 
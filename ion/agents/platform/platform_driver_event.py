@@ -59,6 +59,50 @@ class AttributeValueDriverEvent(DriverEvent):
             summary)
 
 
+class AlignedAttributeValueDriverEvent(AttributeValueDriverEvent):
+    """
+    Event to notify the values of several platform attributes aligned on a
+    common, sorted set of timestamps: values[i][j] is the value of
+    attr_ids[i] at timestamps[j], or None if it was not reported.
+    vals_dict is only constructed if requested.
+    """
+    def __init__(self, platform_id, stream_name, timestamps, attr_ids, values):
+        AttributeValueDriverEvent.__init__(self, platform_id, stream_name, None)
+        self._timestamps = timestamps
+        self._attr_ids = attr_ids
+        self._values = values
+
+    @property
+    def timestamps(self):
+        return self._timestamps
+
+    @property
+    def attr_ids(self):
+        return self._attr_ids
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def vals_dict(self):
+        if self._vals_dict is None:
+            timestamps = self._timestamps.tolist()
+            self._vals_dict = dict((attr_id, zip(row.tolist(), timestamps))
+                                   for attr_id, row in zip(self._attr_ids, self._values))
+        return self._vals_dict
+
+    def brief(self):
+        """
+        A brief string representation.
+        """
+        summary = dict((attr_id, "(%d vals)" % len(self._timestamps))
+                       for attr_id in self._attr_ids)
+        return "%s(platform_id=%r, stream_name=%r, vals_dict=%r)" % (
+            self.__class__.__name__, self.platform_id, self.stream_name,
+            summary)
+
+
 class ExternalEventDriverEvent(DriverEvent):
     """
     Event to notify an external event.
@@ -16,11 +16,12 @@ import logging
 
 from ion.agents.platform.resource_monitor import ResourceMonitor
 from ion.agents.platform.resource_monitor import _STREAM_NAME
-from ion.agents.platform.platform_driver_event import AttributeValueDriverEvent
+from ion.agents.platform.platform_driver_event import AlignedAttributeValueDriverEvent
 
 from gevent import Greenlet, sleep
 from gevent.coros import RLock
 
+import numpy
 import pprint
 
 
@@ -273,85 +274,45 @@ class PlatformResourceMonitor(object):
         aggregated AttributeValueDriverEvent.
 
         Keeps all samples for each attribute, reporting all associated timestamps
-        and filling with None values for missing values at particular timestamps,
-        but an attribute is included *only* if it has at least an actual value.
+        and filling with None values for missing values at particular timestamps.
+        The values are aligned in a single (attributes x timestamps) array.
 
         @note The platform agent will translate any None entries to
               corresponding fill_values.
         """
 
         # step 1:
-        # - collect all actual values in a dict indexed by timestamp
-        # - keep track of the attributes having actual values
-        by_ts = {}  # { ts0 : { attr_n : val_n, ... }, ... }
-        attrs_with_actual_values = set()
-        for attr_id, attr_vals in self._buffers.iteritems():
-            for v, ts in attr_vals:
-                if not ts in by_ts:
-                    by_ts[ts] = {}
-
-                by_ts[ts][attr_id] = v
-
-                attrs_with_actual_values.add(attr_id)
-
-            # re-init buffer for this attribute:
+        # - collect all actual values with the row of their attribute
+        # - re-init the buffers
+        attr_ids = self._buffers.keys()
+        counts = [len(self._buffers[attr_id]) for attr_id in attr_ids]
+        samples = []
+        for attr_id in attr_ids:
+            samples += self._buffers[attr_id]
             self._buffers[attr_id] = []
 
-        if not attrs_with_actual_values:
+        if not samples:
             # No new data collected at all; nothing to publish, just return:
             log.debug("%r: _dispatch_publication: no new data collected.", self._platform_id)
             return
 
-        """
         # step 2:
-        # - put None's for any missing attribute value per timestamp:
-        for ts in by_ts:
-            # only do this for attrs_with_actual_values:
-            # (note: these attributes do have actual values, but not necessarily
-            # at every reported timestamp in this cycle):
-            for attr_id in attrs_with_actual_values:
-                if not attr_id in by_ts[ts]:
-                    by_ts[ts][attr_id] = None
-        """
-
-        # step 2:
-        # - put None's for any missing attribute value per timestamp:
-        # EH. Here I used all attributes instead of only the measured ones
-        # so the agent can properly populate rdts and construct granules.
-        for ts in by_ts:
-            # only do this for attrs_with_actual_values:
-            # (note: these attributes do have actual values, but not necessarily
-            # at every reported timestamp in this cycle):
-            for attr_id in self._buffers.keys():
-                if not attr_id in by_ts[ts]:
-                    by_ts[ts][attr_id] = None
-
-        """        
-        # step 3:
-        # - construct vals_dict for the event:
-        vals_dict = {}
-        for attr_id in attrs_with_actual_values:
-            vals_dict[attr_id] = []
-            for ts in sorted(by_ts.iterkeys()):
-                val = by_ts[ts][attr_id]
-                vals_dict[attr_id].append((val, ts))
-        """
-        
-        # step 3:
-        # - construct vals_dict for the event:
+        # - align the values on the sorted set of reported timestamps, with
+        #   None for any missing attribute value per timestamp.
         # EH. Here I used all attributes instead of only the measured ones
         # so the agent can properly populate rdts and construct granules.
-        vals_dict = {}
-        for attr_id in self._buffers.keys():
-            vals_dict[attr_id] = []
-            for ts in sorted(by_ts.iterkeys()):
-                val = by_ts[ts][attr_id]
-                vals_dict[attr_id].append((val, ts))
+        vals, timestamps = zip(*samples)
+        timestamps, columns = numpy.unique(numpy.array(timestamps), return_inverse=True)
+        rows = numpy.repeat(numpy.arange(len(attr_ids)), counts)
+        values = numpy.empty((len(attr_ids), len(timestamps)), dtype=object)
+        values[rows, columns] = numpy.array(vals, dtype=object)
 
         # finally, create and notify event:
-        driver_event = AttributeValueDriverEvent(self._platform_id,
-                                                 _STREAM_NAME,
-                                                 vals_dict)
+        driver_event = AlignedAttributeValueDriverEvent(self._platform_id,
+                                                        _STREAM_NAME,
+                                                        timestamps,
+                                                        attr_ids,
+                                                        values)
 
         log.debug("%r: _dispatch_publication: notifying event: %s",
                   self._platform_id, driver_event)
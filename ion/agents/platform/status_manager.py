@@ -24,7 +24,9 @@ from interface.objects import ProcessStateEnum
 from pyon.agent.agent import ResourceAgentClient
 
 import logging
+import time
 
+from gevent import spawn_later
 from gevent.coros import RLock
 
 
@@ -51,6 +53,29 @@ def _consolidate_status(statuses, warn_if_unknown=False):
     return DeviceStatusType.STATUS_UNKNOWN
 
 
+def _consolidate_counts(counts, status, warn_if_unknown=False):
+    """
+    Same as _consolidate_status over the statuses counted in counts
+    ({status: number of children}) plus the given status, in constant time.
+    """
+    def present(s):
+        return s == status or counts.get(s, 0) > 0
+
+    if present(DeviceStatusType.STATUS_CRITICAL):
+        return DeviceStatusType.STATUS_CRITICAL
+
+    if present(DeviceStatusType.STATUS_WARNING):
+        return DeviceStatusType.STATUS_WARNING
+
+    if present(DeviceStatusType.STATUS_OK):
+        if present(DeviceStatusType.STATUS_UNKNOWN) and warn_if_unknown:
+            return DeviceStatusType.STATUS_WARNING
+        else:
+            return DeviceStatusType.STATUS_OK
+
+    return DeviceStatusType.STATUS_UNKNOWN
+
+
 class StatusManager(object):
     """
     Supporting class for status handling (aparam_child_agg_status,
@@ -96,6 +121,20 @@ class StatusManager(object):
         # set to False by a call to destroy
         self._active = True
 
+        # {status_name: {status: number of children with that status}}, kept
+        # in sync with aparam_child_agg_status so the rollup is O(1)
+        self._child_status_counts = {}
+
+        # Minimum number of seconds between published rollup status changes
+        # for a status category; changes within the interval are coalesced
+        # into a single event. 0 publishes every change immediately.
+        self._publish_interval = pa.CFG.get_safe('status_manager.publish_interval', 0)
+        # {status_name: time of the last published rollup event}
+        self._last_published = {}
+        # {status_name: (prev_status, child_origin, alerts_list)} changes
+        # waiting for the end of the publish interval
+        self._pending_publications = {}
+
         # RLock to synchronize access to the various mutable variables here.
         self._lock = RLock()
 
@@ -105,6 +144,7 @@ class StatusManager(object):
             for status_name in AggregateStatusType._str_map.keys():
                 self.aparam_aggstatus[status_name]     = DeviceStatusType.STATUS_UNKNOWN
                 self.aparam_rollup_status[status_name] = DeviceStatusType.STATUS_UNKNOWN
+                self._child_status_counts[status_name] = {}
 
             # do status preparations for the immediate children
             for origin in pa._children_resource_ids:
@@ -137,8 +177,10 @@ class StatusManager(object):
 
             self._event_subscribers.clear()
             self.aparam_child_agg_status.clear()
+            self._pending_publications.clear()
             for status_name in AggregateStatusType._str_map.keys():
                 self.aparam_rollup_status[status_name] = DeviceStatusType.STATUS_UNKNOWN
+                self._child_status_counts[status_name] = {}
 
             log.debug("%r: about to destroy %d event subscribers", self._platform_id, len(ess))
             for origin, es in ess.iteritems():
@@ -178,7 +220,7 @@ class StatusManager(object):
             with self._lock:
                 for status_name, status in aggstatus.iteritems():
                     # update my image of the child's status:
-                    self.aparam_child_agg_status[i_resource_id][status_name] = status
+                    self._set_child_status(i_resource_id, status_name, status)
 
                     self._update_rollup_status(status_name)
 
@@ -235,7 +277,7 @@ class StatusManager(object):
                 # update my own child_agg_status from the child's rollup_status
                 # and also my rollup_status:
                 for status_name, status in child_rollup_status.iteritems():
-                    self.aparam_child_agg_status[sub_resource_id][status_name] = status
+                    self._set_child_status(sub_resource_id, status_name, status)
                     self._update_rollup_status(status_name)
 
             log.trace("%r: my updated child status after processing sub-platform %r: %s",
@@ -595,13 +637,26 @@ class StatusManager(object):
         @param origin               resource id of the child that has been added.
         @param statuses             initial values
         """
-        self.aparam_child_agg_status[origin] = {}
+        if origin not in self.aparam_child_agg_status:
+            self.aparam_child_agg_status[origin] = {}
         for status_name in AggregateStatusType._str_map.keys():
             if statuses is None:
                 value = DeviceStatusType.STATUS_UNKNOWN
             else:
                 value = statuses[status_name]
-            self.aparam_child_agg_status[origin][status_name] = value
+            self._set_child_status(origin, status_name, value)
+
+    def _set_child_status(self, origin, status_name, status):
+        """
+        Updates my image of a child's status and the per-category counts.
+        """
+        child_statuses = self.aparam_child_agg_status[origin]
+        counts = self._child_status_counts.setdefault(status_name, {})
+        if status_name in child_statuses:
+            old_status = child_statuses[status_name]
+            counts[old_status] -= 1
+        child_statuses[status_name] = status
+        counts[status] = counts.get(status, 0) + 1
 
     def _prepare_new_child(self, origin, update_rollup_status=True, statuses=None):
         """
@@ -679,6 +734,8 @@ class StatusManager(object):
                           self._platform_id, origin)
                 return
 
+            for status_name, status in self.aparam_child_agg_status[origin].iteritems():
+                self._child_status_counts[status_name][status] -= 1
             del self.aparam_child_agg_status[origin]
 
             log.debug("%r: [TC] _remove_child: removed from aparam_child_agg_status: %r",
@@ -789,7 +846,7 @@ class StatusManager(object):
                 return
 
             # update the specific status
-            self.aparam_child_agg_status[child_origin][status_name] = child_status
+            self._set_child_status(child_origin, status_name, child_status)
 
             # TODO any need to pass child's alerts_list in the next call? See OOIION-1275
             new_rollup_status = self._update_rollup_status_and_publish(status_name, child_origin)
@@ -806,15 +863,10 @@ class StatusManager(object):
         @return (new_rollup_status, old_rollup_status)
         """
         with self._lock:
-            # get all status values for the status name, that is,
-            # all from the children ...
-            all_status_values = [s[status_name] for s in self.aparam_child_agg_status.values()]
-
-            # plus status from the platform itself ...
-            all_status_values.append(self.aparam_aggstatus[status_name])
-
-            # ... to calculate the new rollup_status:
-            new_rollup_status = _consolidate_status(all_status_values)
+            # consolidate the counts of the children's status values for the
+            # status name plus the status from the platform itself:
+            new_rollup_status = _consolidate_counts(self._child_status_counts[status_name],
+                                                    self.aparam_aggstatus[status_name])
 
             # see if we have a new rollup status:
             old_rollup_status = self.aparam_rollup_status[status_name]
@@ -844,7 +896,12 @@ class StatusManager(object):
 
         @return new_rollup_status
                              The new rollup status (also indicating that an event
-                             was published), or None if no publication was necessary
+                             was published or scheduled), or None if no
+                             publication was necessary
+
+        If the last event for the status category was published less than
+        the publish interval ago, the change is published when the interval
+        ends, together with any further changes until then.
         """
 
         ret = self._update_rollup_status(status_name)
@@ -853,7 +910,47 @@ class StatusManager(object):
 
         new_rollup_status, old_rollup_status = ret
 
-        # and publish event to notify all interested ancestors:
+        with self._lock:
+            pending = self._pending_publications.get(status_name)
+            if pending is not None:
+                # already waiting for the end of the interval; keep the status
+                # before the burst and the latest trigger:
+                self._pending_publications[status_name] = (pending[0], child_origin, alerts_list)
+                return new_rollup_status
+
+            wait = self._last_published.get(status_name, 0) + self._publish_interval - time.time()
+            if self._publish_interval and wait > 0:
+                self._pending_publications[status_name] = (old_rollup_status, child_origin, alerts_list)
+                spawn_later(wait, self._publish_pending_rollup_status, status_name)
+                return new_rollup_status
+
+        self._publish_rollup_status(status_name, new_rollup_status,
+                                    old_rollup_status, child_origin, alerts_list)
+        return new_rollup_status
+
+    def _publish_pending_rollup_status(self, status_name):
+        """
+        Publishes the coalesced rollup status change for the status name, if
+        the rollup status still differs from the one before the burst.
+        """
+        with self._lock:
+            if not self._active or status_name not in self._pending_publications:
+                return
+            old_rollup_status, child_origin, alerts_list = self._pending_publications.pop(status_name)
+            new_rollup_status = self.aparam_rollup_status[status_name]
+            if new_rollup_status == old_rollup_status:
+                return
+
+            self._publish_rollup_status(status_name, new_rollup_status,
+                                        old_rollup_status, child_origin, alerts_list)
+
+    def _publish_rollup_status(self, status_name, new_rollup_status,
+                               old_rollup_status, child_origin=None,
+                               alerts_list=None):
+        """
+        Publishes a DeviceAggregateStatusEvent to notify all interested
+        ancestors of a rollup status change.
+        """
         description = "event generated from platform_id=%r" % self._platform_id
         if child_origin:
             description += " triggered by event from child=%r" % child_origin
@@ -871,10 +968,9 @@ class StatusManager(object):
             evt_out['values'] = alerts_list   # OOIION-1275
 
         log.debug("%r: publishing event: %s", self._platform_id, evt_out)
+        self._last_published[status_name] = time.time()
         self._event_publisher.publish_event(**evt_out)
 
-        return new_rollup_status
-
     #----------------------------------
     # misc
     #----------------------------------
@@ -168,3 +168,31 @@ class Test(IonUnitTestCase):
             [(None, 9000),  (3000, 9001), (None, 9002)],
             MVPC_temperature
         )
+
+    def test_aligned_values(self):
+        platform_id = "LJ01D"
+        attrs = self._get_attrs(platform_id)
+
+        prm = PlatformResourceMonitor(
+            platform_id, attrs,
+            self._get_attribute_values_dummy, self.evt_recv)
+
+        prm._init_buffers()
+        bufs = prm._buffers
+        # out of order and repeated timestamps across attributes:
+        bufs["input_voltage"]     = [(1002, 9002), (1000, 9000)]
+        bufs["input_bus_current"] = [(2001, 9001), (2002, 9002)]
+
+        prm._dispatch_publication()
+        driver_event = self._driver_event
+
+        self.assertEquals([9000, 9001, 9002], driver_event.timestamps.tolist())
+        values = dict(zip(driver_event.attr_ids, driver_event.values.tolist()))
+        self.assertEquals([1000, None, 1002], values["input_voltage"])
+        self.assertEquals([None, 2001, 2002], values["input_bus_current"])
+        self.assertEquals([None, None, None], values["MVPC_temperature"])
+
+        # nothing buffered, nothing notified:
+        self._driver_event = None
+        prm._dispatch_publication()
+        self.assertIsNone(self._driver_event)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.platform.test.test_status_manager
+@file    ion/agents/platform/test/test_status_manager.py
+@brief   Unit test cases for the rollup status handling in StatusManager
+"""
+
+#
+# bin/nosetests -v ion/agents/platform/test/test_status_manager.py
+
+
+from pyon.util.containers import DotDict
+from nose.plugins.attrib import attr
+from pyon.util.unit_test import IonUnitTestCase
+
+from ion.agents.platform.status_manager import StatusManager
+from ion.agents.platform.status_manager import _consolidate_status
+
+from interface.objects import AggregateStatusType
+from interface.objects import DeviceStatusType
+
+from mock import Mock, patch
+import random
+
+
+STATUSES = [DeviceStatusType.STATUS_OK,
+            DeviceStatusType.STATUS_WARNING,
+            DeviceStatusType.STATUS_CRITICAL,
+            DeviceStatusType.STATUS_UNKNOWN]
+
+
+@attr('UNIT', group='sa')
+class Test(IonUnitTestCase):
+
+    def _create_manager(self, children, publish_interval=0):
+        pa = Mock()
+        pa._platform_id = 'platform'
+        pa.resource_id = 'platform_id'
+        pa._children_resource_ids = children
+        pa.aparam_child_agg_status = {}
+        pa.aparam_aggstatus = {}
+        pa.aparam_rollup_status = {}
+        pa.CFG = DotDict()
+        pa.CFG.status_manager.publish_interval = publish_interval
+        self._publish_event = pa._event_publisher.publish_event
+        return StatusManager(pa)
+
+    def _child_event(self, origin, status_name, status):
+        return Mock(type_="DeviceAggregateStatusEvent", origin=origin,
+                    status_name=status_name, status=status)
+
+    def test_rollup_matches_consolidation(self):
+        children = ['child_%d' % i for i in xrange(20)]
+        sm = self._create_manager(children)
+        rand = random.Random(0)
+        status_names = AggregateStatusType._str_map.keys()
+
+        for i in xrange(500):
+            status_name = rand.choice(status_names)
+            if i % 50 == 0:
+                sm.set_aggstatus(status_name, rand.choice(STATUSES))
+            else:
+                evt = self._child_event(rand.choice(children), status_name, rand.choice(STATUSES))
+                sm._got_device_aggregate_status_event(evt)
+
+            if i % 100 == 0:
+                sm._remove_child(children.pop())
+
+            expected = _consolidate_status(
+                [s[status_name] for s in sm.aparam_child_agg_status.values()] +
+                [sm.aparam_aggstatus[status_name]])
+            self.assertEquals(expected, sm.aparam_rollup_status[status_name])
+
+    def test_publications_are_coalesced(self):
+        status_name = AggregateStatusType._str_map.keys()[0]
+        children = ['child_%d' % i for i in xrange(5)]
+
+        with patch('ion.agents.platform.status_manager.spawn_later') as spawn_later:
+            sm = self._create_manager(children, publish_interval=60)
+            self._publish_event.reset_mock()
+
+            # a burst of changes: the first one is published right away
+            sm._got_device_aggregate_status_event(self._child_event('child_0', status_name, DeviceStatusType.STATUS_OK))
+            self.assertEquals(1, self._publish_event.call_count)
+
+            # the rest are held until the end of the interval
+            sm._got_device_aggregate_status_event(self._child_event('child_1', status_name, DeviceStatusType.STATUS_WARNING))
+            sm._got_device_aggregate_status_event(self._child_event('child_2', status_name, DeviceStatusType.STATUS_CRITICAL))
+            self.assertEquals(1, self._publish_event.call_count)
+            self.assertEquals(1, spawn_later.call_count)
+
+            _, callback, arg = spawn_later.call_args[0]
+            callback(arg)
+
+        self.assertEquals(2, self._publish_event.call_count)
+        evt = self._publish_event.call_args[1]
+        self.assertEquals(DeviceStatusType.STATUS_CRITICAL, evt['status'])
+        self.assertEquals(DeviceStatusType.STATUS_OK, evt['prev_status'])
@@ -39,47 +39,108 @@ def populate_rdt(rdt, vals):
          u'driver_timestamp': 3578927113.75216}]
     @retval A valid, filled RDT structure
     """
-    array_size = len(vals)
-    data_arrays = {}    
-        
-    # Populate the temporal parameter.
-    data_arrays[rdt.temporal_parameter] = [None] * array_size
-        
-    found_preferred_timestamp = False
+    columns = ParticleColumns(rdt)
+    columns.extend(vals)
+    return columns.fill(rdt)
 
-    for i, particle in enumerate(vals):
-        preferred_timestamp = DataParticleKey.DRIVER_TIMESTAMP
-        if DataParticleKey.PREFERRED_TIMESTAMP in particle:
-            preferred_timestamp = particle[DataParticleKey.PREFERRED_TIMESTAMP]
 
+class ParticleColumns(object):
+    """
+    Columnar accumulator of data particles for one stream. Particles are
+    unpacked into one column per RDT field as they arrive, so a granule is
+    filled straight from the buffered columns. Binary values are base64
+    decoded in one pass per column when the RDT is filled.
+    """
+    def __init__(self, rdt):
+        """
+        @param rdt A RecordDictionaryTool of the stream, only the fields it
+        contains are kept
+        """
+        self._fields = set(k for k in rdt.fields if k in rdt)
+        self._temporal_parameter = rdt.temporal_parameter
+        self.clear()
+
+    def clear(self):
+        self._count = 0
+        self._rows = {}      # field -> ascending indices of the particles that set it
+        self._values = {}    # field -> values, parallel to the rows
+        self._binary = {}    # field -> positions of base64 encoded values
+
+    def __len__(self):
+        return self._count
+
+    def _set(self, key, i, value, binary=False):
+        if key not in self._rows:
+            self._rows[key] = []
+            self._values[key] = []
+        rows, values = self._rows[key], self._values[key]
+        if rows and rows[-1] == i:
+            # Set twice by the same particle, the last value wins
+            rows.pop()
+            values.pop()
+            positions = self._binary.get(key)
+            if positions and positions[-1] == len(values):
+                positions.pop()
+        if binary:
+            self._binary.setdefault(key, []).append(len(values))
+        rows.append(i)
+        values.append(value)
+
+    def append(self, particle):
+        """
+        Adds a data particle dictionary, see populate_rdt
+        """
+        i = self._count
+        self._count += 1
+        fields = self._fields
         for k,v in particle.iteritems():
             if k == DataParticleKey.VALUES:
                 for value_dict in v:
                     value_id = value_dict[DataParticleKey.VALUE_ID]
-                    value = value_dict[DataParticleKey.VALUE]
-                    if value_id in rdt:
-                        if value_id not in data_arrays:
-                            data_arrays[value_id] = [None] * array_size
-                        if 'binary' in value_dict:
-                            value = base64.b64decode(value)
-                        data_arrays[value_id][i] = value
-            
-            elif k in rdt:
-                if k not in data_arrays:
-                    data_arrays[k] = [None] * array_size
-                data_arrays[k][i] = v
+                    if value_id in fields:
+                        self._set(value_id, i, value_dict[DataParticleKey.VALUE], 'binary' in value_dict)
+            elif k in fields:
+                self._set(k, i, v)
 
-            if k == preferred_timestamp:
-                data_arrays[rdt.temporal_parameter][i] = v
-                found_preferred_timestamp = True
+        preferred_timestamp = particle.get(DataParticleKey.PREFERRED_TIMESTAMP, DataParticleKey.DRIVER_TIMESTAMP)
+        if preferred_timestamp in particle:
+            self._set(self._temporal_parameter, i, particle[preferred_timestamp])
 
-    for k,v in data_arrays.iteritems():
-        try:
-            rdt[k] = numpy.array(v)
-        except ValueError:
-            log.error("Couldn't set %s as %s", k, repr(v))
-            raise
+    def extend(self, particles):
+        for particle in particles:
+            self.append(particle)
 
-    return rdt
+    def fill(self, rdt):
+        """
+        Sets the buffered columns on the RDT and empties the accumulator
+        @param rdt An empty/fresh RecordDictionaryTool for the stream
+        @retval The filled RDT
+        """
+        size = self._count
+        if self._temporal_parameter not in self._rows:
+            self._rows[self._temporal_parameter] = []
+            self._values[self._temporal_parameter] = []
+        try:
+            for k, rows in self._rows.iteritems():
+                values = self._values[k]
+                binary = self._binary.get(k)
+                if binary:
+                    if len(binary) == len(values):
+                        values = map(base64.b64decode, values)
+                    else:
+                        for j in binary:
+                            values[j] = base64.b64decode(values[j])
+                if len(rows) != size:
+                    column = [None] * size
+                    for i, value in zip(rows, values):
+                        column[i] = value
+                    values = column
+                try:
+                    rdt[k] = numpy.array(values)
+                except ValueError:
+                    log.error("Couldn't set %s as %s", k, repr(values))
+                    raise
+        finally:
+            self.clear()
 
-            
+        return rdt
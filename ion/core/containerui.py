@@ -764,8 +764,8 @@ def _process_cmd_sites(resource_id, res_obj=None):
     from ion.util.enhanced_resource_registry_client import EnhancedResourceRegistryClient
     from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
     from ion.processes.event.device_state import DeviceStateManager
-    RR2 = EnhancedResourceRegistryClient(ResourceRegistryServiceClient())
-    outil = ObservatoryUtil(container=Container.instance, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+    RR2 = EnhancedResourceRegistryClient(ResourceRegistryServiceClient(), shared_cache=True)
+    outil = ObservatoryUtil(container=Container.instance, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), shared_cache=True)
     statuses = outil.get_status_roll_ups(resource_id, include_structure=True)
     fragments = [
         "</pre><h3>Org, Site and Device Status</h3>",
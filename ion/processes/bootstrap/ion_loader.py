@@ -42,6 +42,8 @@
 
       debug= if True, allows shortcuts to perform faster loads (where possible)
       bulk= if True, uses RR bulk insert operations to load, not service calls
+      bulk_chunk= if set with bulk==True, writes new bulk objects every bulk_chunk objects instead of once per category
+      workers= number of rows of a category loaded concurrently (default is 1); rows referencing other rows wait for them
       exportui= if True, writes interface/ui_specs.json with UI object
       revert= if True (and debug==True) remove all new resources and associations created if preload fails
 
@@ -66,6 +68,7 @@ import re
 import requests
 import time
 import os
+from gevent.pool import Pool
 from udunitspy.udunits2 import UdunitsError
 
 from pyon.core.bootstrap import get_service_registry
@@ -199,6 +202,9 @@ ID_WEB_AUTH_ACTOR = "USER_WEB_AUTH"
 
 UUID_RE = '^[0-9a-fA-F]{32}$'
 
+# Tokens in a row value that may refer to the ID of another row
+ROW_REF_RE = '[^\\s,;:\'"{}\\[\\]()=]+'
+
 class IONLoader(ImmediateProcess):
 
     def __init__(self, *a, **b):
@@ -322,6 +328,8 @@ class IONLoader(ImmediateProcess):
             self.loadui = config.get("loadui", False)      # Import UI asset data
             self.update = config.get("update", False)      # Support update to existing resources
             self.bulk = config.get("bulk", False)          # Use bulk insert where available
+            self.bulk_chunk = int(config.get("bulk_chunk", 0))  # Number of new bulk objects per write, 0 for one per category
+            self.workers = int(config.get("workers", 1))   # Number of rows loaded concurrently
             self.revert = bool(config.get("revert", False)) and self.debug    # Revert to RR snapshot on failure
             self.clearcols = config.get("clearcols", None)          # Clear given columns in rows
             self.idmap = bool(config.get("idmap", False))           # Substitute column values in rows
@@ -557,10 +565,13 @@ class IONLoader(ImmediateProcess):
         # before you see an error
         self._read_and_parse(scenarios)
 
+        category_times = []
         for index, category in enumerate(self.categories):
             t = Timer() if stats.is_log_enabled() else None
+            start_time = time.time()
             self.bulk_objects = {}    # This keeps objects to be bulk inserted/updated at the end of a category
             self.bulk_existing = set()  # This keeps the ids of the bulk objects to update instead of delete
+            self.bulk_written = {}    # This keeps the new bulk objects already written in a chunk, for reference
             self.row_count, self.ext_count = 0, 0  # Counts all executions of row/ext for category
             self._category = category
 
@@ -580,19 +591,25 @@ class IONLoader(ImmediateProcess):
             if category not in self.object_definitions or not self.object_definitions[category]:
                 log.debug('no rows for category: %s', category)
 
-            for row in self.object_definitions.get(category, []):
-                if COL_ID in row:
-                    log.trace('handling %s row %s: %r', category, row[COL_ID], row)
+            rows = self.object_definitions.get(category, [])
+            if self.workers > 1 and category not in DEFINITION_CATEGORIES:
+                waves = self._get_row_waves(rows)
+            else:
+                waves = [[row] for row in rows]
+            pool = Pool(size=max(self.workers, 1))
+            for wave in waves:
+                if len(wave) == 1:
+                    self._load_category_row(category, wave[0])
                 else:
-                    log.trace('handling %s row: %r', category, row)
-
-                try:
-                    self.load_row(category, row)
-                except Exception:
-                    log.error('error loading %s row: %r', category, row, exc_info=True)
-                    raise
-
-            source_row_count = len(self.object_definitions.get(category, []))
+                    greenlets = [pool.spawn(self._load_category_row, category, row) for row in wave]
+                    pool.join()
+                    for greenlet in greenlets:
+                        if greenlet.exception is not None:
+                            raise greenlet.exception
+                if self.bulk and self.bulk_chunk and len(self.bulk_objects) - len(self.bulk_existing) >= self.bulk_chunk:
+                    self._flush_bulk()
+
+            source_row_count = len(rows)
             if t:
                 t.complete_step('preload.%s.load_row'%category)
             if self.bulk:
@@ -606,9 +623,63 @@ class IONLoader(ImmediateProcess):
                     t.complete_step('preload.%s.bulk_load' % category)
             else:
                 log.info("loaded category %s (%d/%d): %d rows (%s source, %s ext)", category, index+1, len(self.categories), self.row_count, source_row_count, self.ext_count)
+            category_times.append((category, time.time() - start_time, self.row_count, len(waves)))
             if t:
                 stats.add(t)
                 stats.add_value('preload.%s.row_count' % category, self.row_count)
+                stats.add_value('preload.%s.waves' % category, len(waves))
+
+        log.info("preload timing (workers=%s): %s", self.workers,
+                 ", ".join("%s: %.2fs (%d rows, %d waves)" % entry for entry in category_times))
+
+    def _load_category_row(self, category, row):
+        if COL_ID in row:
+            log.trace('handling %s row %s: %r', category, row[COL_ID], row)
+        else:
+            log.trace('handling %s row: %r', category, row)
+
+        try:
+            self.load_row(category, row)
+        except Exception:
+            log.error('error loading %s row: %r', category, row, exc_info=True)
+            raise
+
+    def _get_row_waves(self, rows):
+        """
+        Splits the rows of one category into waves of rows that can be loaded concurrently.
+        Two rows depend on each other if one of them refers to the ID of the other in any column
+        (e.g. parent_site_id). A row goes into the wave after the latest row it depends on, so rows
+        depending on each other keep their spreadsheet order. Rows without ID are loaded one by one.
+        """
+        if not all(row.get(COL_ID, None) for row in rows):
+            return [[row] for row in rows]
+
+        by_id = {}      # ID -> index of the rows with this ID
+        by_ref = {}     # ID -> index of the rows referring to this ID
+        for i, row in enumerate(rows):
+            by_id.setdefault(row[COL_ID], []).append(i)
+        row_refs = []
+        for i, row in enumerate(rows):
+            refs = {row[COL_ID]}
+            for key, value in row.iteritems():
+                if key != COL_ID and value and isinstance(value, basestring):
+                    refs.update(ref for ref in re.findall(ROW_REF_RE, value) if ref in by_id)
+            for ref in refs:
+                by_ref.setdefault(ref, []).append(i)
+            row_refs.append(refs)
+
+        levels = []
+        waves = []
+        for i, row in enumerate(rows):
+            related = set(by_ref[row[COL_ID]])
+            for ref in row_refs[i]:
+                related.update(by_id[ref])
+            level = max([levels[j] + 1 for j in related if j < i] or [0])
+            levels.append(level)
+            if level == len(waves):
+                waves.append([])
+            waves[level].append(row)
+        return waves
 
     def load_row(self, type, row):
         """ expose for use by utility function """
@@ -636,23 +707,37 @@ class IONLoader(ImmediateProcess):
 
         func(row)
 
+    def _flush_bulk(self):
+        """
+        Writes the new bulk objects collected so far. They remain available for reference
+        by the following rows of the category but are not written again.
+        """
+        obj_new = [obj for obj in self.bulk_objects.values() if obj["_id"] not in self.bulk_existing]
+        if obj_new:
+            self.resource_ds.create_mult(obj_new, allow_ids=True)
+        for obj in obj_new:
+            del self.bulk_objects[obj["_id"]]
+            self.bulk_written[obj["_id"]] = obj
+        log.debug("Bulk stored chunk of %d new objects", len(obj_new))
+
     def _finalize_bulk(self, category):
         # Perform the create for resources and associations - note: should do resources first then assoc but works OK.
-        obj_new = [obj for obj in self.bulk_objects.values() if obj["_id"] not in self.bulk_existing]
-        res = self.resource_ds.create_mult(obj_new, allow_ids=True)
+        self._flush_bulk()
 
         # Perform the update for resources
         obj_upd = [obj for obj in self.bulk_objects.values() if obj["_id"] in self.bulk_existing]
         res = self.resource_ds.update_mult(obj_upd)
 
-        num_objects = len([1 for obj in self.bulk_objects.values() if obj.type_ != "Association"])
-        num_assoc = len(self.bulk_objects) - num_objects
-        num_existing = len([1 for obj in self.bulk_objects.values() if hasattr(obj, "_rev")])
+        bulk_objects = self.bulk_written.values() + obj_upd
+        num_objects = len([1 for obj in bulk_objects if obj.type_ != "Association"])
+        num_assoc = len(bulk_objects) - num_objects
+        num_existing = len([1 for obj in bulk_objects if hasattr(obj, "_rev")])
 
         log.debug("Bulk stored %d resource objects, %d associations in resource registry (%s updates)", num_objects, num_assoc, num_existing)
 
         self.bulk_objects.clear()
         self.bulk_existing.clear()
+        self.bulk_written.clear()
         return num_objects
 
     def _create_object_from_row(self, objtype, row, prefix='',
@@ -770,6 +855,8 @@ class IONLoader(ImmediateProcess):
         """Returns a resource object from one of the memory locations for given preload or internal ID"""
         if self.bulk and res_id in self.bulk_objects:
             return self.bulk_objects[res_id]
+        elif self.bulk and res_id in self.bulk_written:
+            return self.bulk_written[res_id]
         elif res_id in self.resource_objs:
             return self.resource_objs[res_id]
         else:
@@ -4,12 +4,13 @@ __author__ = 'Michael Meisinger'
 
 from mock import Mock
 from nose.plugins.attrib import attr
+import gevent
 
 from pyon.util.int_test import IonIntegrationTestCase
 from pyon.util.unit_test import IonUnitTestCase
 from pyon.public import RT, PRED, OT, log, IonObject
 from ion.core.ooiref import OOIReferenceDesignator
-from ion.processes.bootstrap.ion_loader import TESTED_DOC, IONLoader, OOI_MAPPING_DOC
+from ion.processes.bootstrap.ion_loader import TESTED_DOC, IONLoader, OOI_MAPPING_DOC, COL_ID
 from ion.processes.bootstrap.ooi_loader import OOILoader
 
 from interface.services.dm.iingestion_management_service import IngestionManagementServiceClient
@@ -109,6 +110,68 @@ class TestLoaderAlgo(IonUnitTestCase):
             self.assertEquals(agent_id, expected_agent_id)
 
 
+    @attr('UNIT', group='loader')
+    def test_row_waves(self):
+        loader = IONLoader()
+        rows = [dict(ID='OBS', parent_site_id=''),
+                dict(ID='SS1', parent_site_id='OBS'),
+                dict(ID='SS2', parent_site_id='OBS'),
+                dict(ID='PS1', parent_site_id='SS1', org_ids='ORG_ION'),
+                dict(ID='PS2', parent_site_id='', platform_model_ids='PM1,PM2'),
+                dict(ID='PS3', parent_site_id='SS2, SS1')]
+        waves = loader._get_row_waves(rows)
+        self.assertEqual([[row['ID'] for row in wave] for wave in waves],
+                         [['OBS', 'PS2'], ['SS1', 'SS2'], ['PS1', 'PS3']])
+
+        # A reference to a later row keeps the spreadsheet order
+        waves = loader._get_row_waves([dict(ID='A', parent='B'), dict(ID='B', parent='')])
+        self.assertEqual([[row['ID'] for row in wave] for wave in waves], [['A'], ['B']])
+
+        # Rows without ID are loaded one by one
+        waves = loader._get_row_waves([dict(name='a'), dict(name='b')])
+        self.assertEqual(len(waves), 2)
+
+    @attr('UNIT', group='loader')
+    def test_parallel_bulk_load(self):
+        loader = IONLoader()
+        loader.container = Mock()
+        loader.resource_ds = Mock()
+        loader.prepare_loader = Mock()
+        loader.debug = loader.loadooi = loader.clearcols = loader.idmap = False
+        loader.excludecategories = []
+        loader.categories = ['Subsite']
+        loader.bulk = True
+        loader.bulk_chunk = 3
+        loader.workers = 4
+        # 4 independent chains of 5 sites each
+        rows = [dict(ID='SS%d' % i, parent_site_id='SS%d' % (i-1) if i % 5 else '') for i in xrange(20)]
+        loader.object_definitions = {'Subsite': rows}
+
+        active = []
+        concurrency = []
+        def load_subsite(row):
+            active.append(row[COL_ID])
+            concurrency.append(len(active))
+            gevent.sleep(0.01)
+            res_obj = IonObject(RT.Subsite, name=row[COL_ID])
+            loader._create_bulk_resource(res_obj, row[COL_ID])
+            if row['parent_site_id']:
+                loader._create_association(loader._get_resource_obj(row['parent_site_id']), PRED.hasSite, res_obj)
+            loader.row_count += 1
+            active.remove(row[COL_ID])
+        loader._load_Subsite = load_subsite
+
+        loader.load_ion([])
+        self.assertEqual(max(concurrency), 4)
+
+        # One write per wave, parents are referenced after they were written
+        create_mult = loader.resource_ds.create_mult
+        self.assertEqual(create_mult.call_count, 5)
+        objects = [obj for call in create_mult.call_args_list for obj in call[0][0]]
+        self.assertEqual(len([obj for obj in objects if obj.type_ == RT.Subsite]), 20)
+        self.assertEqual(len([obj for obj in objects if obj.type_ == 'Association']), 16)
+
+
 TEST_PATH = TESTED_DOC
 
 class TestLoader(IonIntegrationTestCase):
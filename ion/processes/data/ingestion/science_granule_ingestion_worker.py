@@ -8,11 +8,14 @@
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.services.dm.utility.granule_utils import time_series_domain
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
-from pyon.core.exception import CorruptionError, NotFound, BadRequest
+from pyon.core.exception import CorruptionError, NotFound, BadRequest, Conflict
 from pyon.ion.event import handle_stream_exception, EventPublisher
 from pyon.ion.event import EventSubscriber
 from pyon.public import log, RT, PRED, CFG, OT
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.services.dm.utility.tail_index import TailIndex
+from ion.services.dm.utility.coverage_pool import CoveragePool
+from ion.util.time_index import TimeIndex
 from interface.objects import Granule
 from ion.core.process.transform import TransformStreamListener, TransformStreamProcess
 from ion.util.time_utils import TimeUtils
@@ -43,6 +46,28 @@ numpy_walk = DatasetManagementService.numpy_walk
 
 REPORT_FREQUENCY=100
 MAX_RETRY_TIME=3600
+# Seconds a granule waits for its batch to fill when process.batch.interval isn't set
+DEFAULT_BATCH_INTERVAL=1.0
+
+class GranuleBatch(object):
+    '''
+    A set of granules received on a single stream that are persisted together.
+    Consumers that contributed a granule wait on done until the batch is durable.
+    '''
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.rdts      = []
+        self.records   = 0
+        self.created   = time.time()
+        self.timer     = None
+        self.done      = event.AsyncResult()
+
+    def add(self, rdt):
+        self.rdts.append(rdt)
+        self.records += len(rdt)
+
+    def __len__(self):
+        return len(self.rdts)
 
 class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker):
     CACHE_LIMIT=CFG.get_safe('container.ingestion_cache',5)
@@ -54,10 +79,11 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         #--------------------------------------------------------------------------------
         # Ingestion Cache
         # - Datasets
-        # - Coverage instances
+        # Coverage instances are shared through the container's CoveragePool
         #--------------------------------------------------------------------------------
         self._datasets  = collections.OrderedDict()
-        self._coverages = collections.OrderedDict()
+        self._tails     = collections.OrderedDict()
+        self._time_indexes = collections.OrderedDict()
 
         self._bad_coverages = {}
 
@@ -65,6 +91,20 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         # unique ID to identify this worker in log msgs
         self._id = uuid.uuid1()
 
+        #--------------------------------------------------------------------------------
+        # Micro-batching
+        # - Open batch per stream
+        # - Number of consumers currently blocked on a batch
+        #--------------------------------------------------------------------------------
+        self._batches = {}
+        self._pending = 0
+        self.flush_lock = RLock()
+        self.batch_records  = 0
+        self.batch_interval = 0
+        self.batch_consumers = 1
+        self.subscribers = []
+        self.subscriber_threads = []
+
 
 
     def on_start(self): #pragma no cover
@@ -78,7 +118,20 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         TransformStreamProcess.on_start(self)
         
         self.queue_name = self.CFG.get_safe('process.queue_name',self.id)
-        self.subscriber = StreamSubscriber(process=self, exchange_name=self.queue_name, callback=self.receive_callback)
+
+        #--------------------------------------------------------------------------------
+        # Batching is enabled by process.batch.records (max records per batch) and/or
+        # process.batch.interval (max milliseconds a granule waits before being written,
+        # DEFAULT_BATCH_INTERVAL if only process.batch.records is set).
+        # Granules are only ACK'd once their batch is persisted, so several consumers
+        # are needed on the queue for a batch to hold more than one granule.
+        #--------------------------------------------------------------------------------
+        self.batch_records   = self.CFG.get_safe('process.batch.records', 0)
+        self.batch_interval  = self.CFG.get_safe('process.batch.interval', 0) / 1000.
+        self.batch_consumers = self.CFG.get_safe('process.batch.consumers', 10) if self.batching else 1
+
+        self.subscribers = [StreamSubscriber(process=self, exchange_name=self.queue_name, callback=self.receive_callback) for i in xrange(self.batch_consumers)]
+        self.subscriber = self.subscribers[0]
         self.thread_lock = RLock()
         
         #--------------------------------------------------------------------------------
@@ -103,15 +156,10 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         self.start_listener()
 
     def on_quit(self): #pragma no cover
-        self.event_publisher.close()
         if self.subscriber_thread:
             self.stop_listener()
-        for stream, coverage in self._coverages.iteritems():
-            try:
-                coverage.close(timeout=5)
-            except:
-                log.exception('Problems closing the coverage')
-        self._coverages.clear()
+        self.event_publisher.close()
+        self.close_coverages()
         TransformStreamListener.on_quit(self)
         BaseIngestionWorker.on_quit(self)
 
@@ -119,20 +167,21 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
     def start_listener(self):
         # We use a lock here to prevent possible race conditions from starting multiple listeners and coverage clobbering
         with self.thread_lock:
-            self.subscriber_thread = self._process.thread_manager.spawn(self.subscriber.listen, thread_name='%s-subscriber' % self.id)
+            self.subscriber_threads = [self._process.thread_manager.spawn(subscriber.listen, thread_name='%s-subscriber-%s' % (self.id, i)) for i, subscriber in enumerate(self.subscribers)]
+            self.subscriber_thread = self.subscriber_threads[0]
 
     def stop_listener(self):
         # Avoid race conditions with coverage operations (Don't start a listener at the same time as closing one)
         with self.thread_lock:
-            self.subscriber.close()
-            self.subscriber_thread.join(timeout=10)
-            for stream, coverage in self._coverages.iteritems():
-                try:
-                    coverage.close(timeout=5)
-                except:
-                    log.exception('Problems closing the coverage')
-            self._coverages.clear()
+            # Release any consumers waiting on a batch before the subscribers go away
+            self.flush_batches()
+            for subscriber in self.subscribers:
+                subscriber.close()
+            for thread in self.subscriber_threads:
+                thread.join(timeout=10)
+            self.close_coverages()
             self.subscriber_thread = None
+            self.subscriber_threads = []
 
     def pause(self):
         if self.subscriber_thread is not None:
@@ -237,6 +286,73 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         doc = numpy_walk(doc)
         object_store.update_doc(doc)
 
+    def update_tail(self, dataset_id, rdt):
+        '''
+        Adds the records to the dataset's tail index, which serves the last
+        values of the dataset without reading the coverage.
+        '''
+        object_store = self.container.object_store
+        try:
+            tail = self._tails.pop(dataset_id)
+        except KeyError:
+            tail = TailIndex.read(object_store, dataset_id)
+            if tail is None:
+                # The index is only complete if it starts with the dataset
+                try:
+                    object_store.read_doc(dataset_id)
+                    complete = False
+                except NotFound:
+                    complete = True
+                tail = TailIndex(dataset_id, rdt.temporal_parameter, complete=complete)
+            if len(self._tails) >= self.CACHE_LIMIT:
+                self._tails.popitem(0)
+        self._tails[dataset_id] = tail
+        try:
+            tail.extend(rdt)
+            tail.persist(object_store)
+        except Exception:
+            # The tail is an optimization, don't fail ingestion over it
+            log.exception('Failed to update the tail index for dataset %s', dataset_id)
+            self._tails.pop(dataset_id, None)
+
+    def update_time_index(self, dataset_id, coverage, rdt):
+        '''
+        Appends the granule's time values to the dataset's time index. The index
+        is rebuilt from the coverage when there isn't one yet or when it's out of
+        step with the coverage, e.g. another worker ingested into the dataset.
+        '''
+        if self.sparse_only(rdt):
+            return # No new records were added
+        object_store = self.container.object_store
+        try:
+            index = self._time_indexes.pop(dataset_id, None)
+            if index is None:
+                index = TimeIndex.read(object_store, dataset_id)
+            if len(self._time_indexes) >= self.CACHE_LIMIT:
+                self._time_indexes.popitem(0)
+            if index is not None:
+                index.extend(rdt[rdt.temporal_parameter])
+            if index is None or len(index) != coverage.num_timesteps():
+                rev = index._rev if index is not None else None
+                index = TimeIndex(dataset_id)
+                index._rev = rev
+                tname = coverage.temporal_parameter_name
+                # The coverage already holds this granule
+                index.extend(coverage.get_parameter_values([tname], fill_empty_params=True).get_data()[tname])
+            index.persist(object_store)
+            self._time_indexes[dataset_id] = index
+        except Conflict:
+            # Another worker updated the index, our offsets can't be trusted
+            # anymore. The next granule re-reads it and checks it against the coverage.
+            log.info('Time index for dataset %s was updated by another worker', dataset_id)
+        except Exception:
+            log.exception('Failed to update the time index for dataset %s', dataset_id)
+            # A stale index would give wrong offsets, it gets rebuilt from the coverage
+            try:
+                object_store.delete_doc(TimeIndex.doc_key(dataset_id))
+            except NotFound:
+                pass
+
     def update_data_product_metadata(self, dataset_id, rdt):
         data_products = self._get_data_products(dataset_id)
         for data_product in data_products:
@@ -349,22 +465,19 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
 
     def get_coverage(self, stream_id):
         '''
-        Memoization (LRU) of _get_coverage
+        Acquires the stream's coverage from the pool, the caller releases it
         '''
-        try:
-            result = self._coverages.pop(stream_id)
-        except KeyError:
-            dataset_id = self.get_dataset(stream_id)
-            if dataset_id is None:
-                return None
-            result = DatasetManagementService._get_simplex_coverage(dataset_id, mode='a')
-            if result is None:
-                return None
-            if len(self._coverages) >= self.CACHE_LIMIT:
-                k, coverage = self._coverages.popitem(0)
-                coverage.close(timeout=5)
-        self._coverages[stream_id] = result
-        return result
+        dataset_id = self.get_dataset(stream_id)
+        if dataset_id is None:
+            return None
+        return CoveragePool.acquire(dataset_id, mode='a', kind='simplex')
+
+    def close_coverages(self):
+        '''
+        Closes the idle coverages this worker appended to
+        '''
+        for dataset_id in self._datasets.itervalues():
+            CoveragePool.invalidate(dataset_id, modes=('a',))
 
 
     #--------------------------------------------------------------------------------
@@ -397,7 +510,120 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
             log.debug('Empty granule for stream %s', stream_id)
             return
 
-        self.persist_or_timeout(stream_id, rdt)
+        if self.batching:
+            self.batch_granule(stream_id, rdt)
+        else:
+            self.persist_or_timeout(stream_id, rdt)
+
+    #--------------------------------------------------------------------------------
+    # Micro-batching
+    #--------------------------------------------------------------------------------
+
+    @property
+    def batching(self):
+        return self.batch_records > 1 or self.batch_interval > 0
+
+    def batch_granule(self, stream_id, rdt):
+        '''
+        Adds the granule to the open batch for the stream and blocks until the
+        batch has been persisted, so the message is only ACK'd once it's durable.
+        '''
+        batch = self._batches.get(stream_id)
+        if batch is None:
+            batch = GranuleBatch(stream_id)
+            self._batches[stream_id] = batch
+            # A batch on a slow stream must not hold its granules un-ACK'd indefinitely
+            batch.timer = gevent.spawn_later(self.batch_interval or DEFAULT_BATCH_INTERVAL, self.flush_batch, batch)
+        batch.add(rdt)
+
+        self._pending += 1
+        try:
+            if self.batch_records and batch.records >= self.batch_records:
+                self.flush_batch(batch)
+            elif self._pending >= self.batch_consumers:
+                # Every consumer is waiting on a batch, nothing else can arrive
+                self.flush_batches()
+            batch.done.get()
+        finally:
+            self._pending -= 1
+
+    def flush_batches(self):
+        for batch in self._batches.values():
+            self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        '''
+        Persists every granule in the batch with a single coverage write, flush,
+        metadata update and DatasetModified event per contiguous segment.
+        '''
+        if self._batches.get(batch.stream_id) is batch:
+            del self._batches[batch.stream_id]
+        if batch.timer is not None and batch.timer is not gevent.getcurrent():
+            batch.timer.kill(block=False)
+        if batch.done.ready():
+            return
+
+        with self.flush_lock:
+            t = Timer()
+            try:
+                for segment in self.segment_batch(batch.rdts):
+                    self.persist_or_timeout(batch.stream_id, self.merge_granules(segment))
+            except Exception as e:
+                log.exception('Failed to persist batch of %s granules for stream %s', len(batch), batch.stream_id)
+                batch.done.set_exception(e)
+                return
+            t.complete_step('ingestion.batch.persist')
+            self.time_stats.add(t)
+            self.time_stats.add_value('ingestion.batch.granules', len(batch))
+            self.time_stats.add_value('ingestion.batch.records', batch.records)
+            self.time_stats.add_value('ingestion.batch.latency', time.time() - batch.created)
+            batch.done.set(True)
+
+    def segment_batch(self, rdts):
+        '''
+        Splits a batch into runs of granules that can be merged: the same set of
+        parameters is present and the sparse constant values don't change.
+        '''
+        segment = []
+        for rdt in rdts:
+            if segment and not self.mergeable(segment[-1], rdt):
+                yield segment
+                segment = []
+            segment.append(rdt)
+        if segment:
+            yield segment
+
+    def mergeable(self, a, b):
+        keys = set(a.iterkeys())
+        if keys != set(b.iterkeys()):
+            return False
+        for k in keys:
+            if isinstance(a.param_type(k), SparseConstantType):
+                if not np.atleast_1d(np.atleast_1d(a._rd[k])[0] == np.atleast_1d(b._rd[k])[0]).all():
+                    return False
+        return True
+
+    def merge_granules(self, rdts):
+        '''
+        Concatenates the values of several granules into a single record dictionary
+        '''
+        if len(rdts) == 1:
+            return rdts[0]
+        first = rdts[0]
+        merged = RecordDictionaryTool(param_dictionary=first._pdict)
+        merged._stream_def       = first._stream_def
+        merged._available_fields = first._available_fields
+        merged._layout           = first._layout
+        merged._stream_config    = first._stream_config
+        merged.connection_id     = rdts[-1].connection_id
+        merged.connection_index  = rdts[-1].connection_index
+        merged._shp = (sum(len(rdt) for rdt in rdts),)
+        for k in first.iterkeys():
+            if isinstance(first.param_type(k), SparseConstantType):
+                merged._rd[k] = first._rd[k]
+            else:
+                merged._rd[k] = np.concatenate([np.atleast_1d(rdt._rd[k]) for rdt in rdts])
+        return merged
 
     def persist_or_timeout(self, stream_id, rdt):
         '''
@@ -416,9 +642,10 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
                 log.error("We're giving up, the coverage needs to be inspected %s", DatasetManagementService._get_coverage_path(dataset_id))
                 raise
 
-            if stream_id in self._coverages:
+            dataset_id = self.get_dataset(stream_id)
+            if dataset_id is not None:
                 log.info('Popping coverage for stream %s', stream_id)
-                self._coverages.pop(stream_id)
+                CoveragePool.invalidate(dataset_id, modes=('a',))
 
             gevent.sleep(timeout)
 
@@ -490,7 +717,7 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
             log.error("Couldn't insert values for coverage: %s",
                       coverage.persistence_dir, exc_info=True)
             try:
-                coverage.close()
+                CoveragePool.discard(coverage)
             finally:
                 self._bad_coverages[stream_id] = 1
                 raise CorruptionError(e.message)
@@ -531,16 +758,21 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         # Actual persistence
         #--------------------------------------------------------------------------------
 
-        if rdt[rdt.temporal_parameter] is None:
-            log.warning("Empty granule received")
-            return
+        try:
+            if rdt[rdt.temporal_parameter] is None:
+                log.warning("Empty granule received")
+                return
 
-        # Parse the RDT and set hte values in the coverage
-        self.insert_values(coverage, rdt, stream_id)
-        
-        # Force the data to be flushed
-        DatasetManagementService._save_coverage(coverage)
+            # Parse the RDT and set hte values in the coverage
+            self.insert_values(coverage, rdt, stream_id)
+
+            # Force the data to be flushed
+            DatasetManagementService._save_coverage(coverage)
 
+            self.update_time_index(dataset_id, coverage, rdt)
+        finally:
+            CoveragePool.release(coverage)
+        self.update_tail(dataset_id, rdt)
         self.update_metadata(dataset_id, rdt)
 
         try:
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/ingestion/test/test_science_granule_ingestion_worker.py
+@description Unit tests for the ingestion worker's micro-batching
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.ingestion.science_granule_ingestion_worker import ScienceGranuleIngestionWorker, GranuleBatch
+from mock import Mock, patch
+from nose.plugins.attrib import attr
+
+import gevent
+
+@attr('UNIT', group='dm')
+class TestIngestionBatching(PyonTestCase):
+    def setUp(self):
+        self.worker = ScienceGranuleIngestionWorker()
+        self.worker.persist_or_timeout = Mock()
+        self.worker.merge_granules = Mock(side_effect=lambda rdts : rdts)
+        self.worker.mergeable = Mock(return_value=True)
+
+    def granule(self, records):
+        rdt = Mock()
+        rdt.__len__ = Mock(return_value=records)
+        return rdt
+
+    def test_flush_on_record_limit(self):
+        self.worker.batch_records = 10
+        self.worker.batch_consumers = 3
+
+        a, b = self.granule(4), self.granule(6)
+        g = gevent.spawn(self.worker.batch_granule, 'stream', a)
+        gevent.sleep(0)
+        self.assertFalse(self.worker.persist_or_timeout.called)
+
+        self.worker.batch_granule('stream', b)
+        g.join(timeout=1)
+        self.assertTrue(g.successful())
+
+        # A single write for both granules
+        self.worker.persist_or_timeout.assert_called_once_with('stream', [a, b])
+        self.assertEquals(self.worker._batches, {})
+        self.assertEquals(self.worker._pending, 0)
+
+    def test_flush_on_interval(self):
+        self.worker.batch_interval = 0.05
+        self.worker.batch_consumers = 3
+
+        a = self.granule(1)
+        self.worker.batch_granule('stream', a)
+        self.worker.persist_or_timeout.assert_called_once_with('stream', [a])
+
+    def test_flush_on_default_interval(self):
+        self.worker.batch_records = 100
+        self.worker.batch_consumers = 3
+
+        # Records never reach the limit: the batch is written after the default interval
+        a = self.granule(1)
+        with patch('ion.processes.data.ingestion.science_granule_ingestion_worker.DEFAULT_BATCH_INTERVAL', 0.05):
+            g = gevent.spawn(self.worker.batch_granule, 'stream', a)
+            g.join(timeout=1)
+        self.assertTrue(g.successful())
+        self.worker.persist_or_timeout.assert_called_once_with('stream', [a])
+
+    def test_flush_when_consumers_exhausted(self):
+        self.worker.batch_records = 100
+        self.worker.batch_consumers = 2
+
+        a, b = self.granule(1), self.granule(1)
+        g = gevent.spawn(self.worker.batch_granule, 'stream_a', a)
+        gevent.sleep(0)
+        self.worker.batch_granule('stream_b', b)
+        g.join(timeout=1)
+        self.assertEquals(self.worker.persist_or_timeout.call_count, 2)
+
+    def test_failed_batch_is_not_acked(self):
+        self.worker.batch_records = 1
+        self.worker.persist_or_timeout.side_effect = IOError('bad disk')
+        with self.assertRaises(IOError):
+            self.worker.batch_granule('stream', self.granule(1))
+
+    def test_segment_batch(self):
+        self.worker.mergeable = Mock(side_effect=[True, False, True])
+        batch = GranuleBatch('stream')
+        rdts = [self.granule(1) for i in xrange(4)]
+        for rdt in rdts:
+            batch.add(rdt)
+        self.assertEquals(batch.records, 4)
+        segments = list(self.worker.segment_batch(batch.rdts))
+        self.assertEquals(segments, [rdts[:2], rdts[2:]])
@@ -14,6 +14,7 @@ from pyon.util.log import log
 
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.tail_index import TailIndex
 from ion.util.time_utils import TimeUtils
 
 from coverage_model import utils
@@ -33,6 +34,8 @@ import numpy as np
 from datetime import datetime
 import calendar
 from pyon.util.breakpoint import debug_wrapper
+from pyon.container.cc import Container
+from pyon.core.exception import NotFound
 
 class ReplayProcess(BaseReplayProcess):
 
@@ -48,11 +51,13 @@ class ReplayProcess(BaseReplayProcess):
         start_time: 0         # Start time (index value) to be replayed
         end_time:   0         # End time (index value) to be replayed
         parameters: []        # List of parameters to form in the granule
+        max_bytes:  0         # Upper bound on the data read from the coverage at once
       
 
     '''
     process_type  = 'standalone'
     publish_limit = 10
+    max_bytes     = 32 * 1024 * 1024
     dataset_id    = None
     delivery_format = {}
     start_time      = None
@@ -87,6 +92,7 @@ class ReplayProcess(BaseReplayProcess):
         self.parameters      = self.CFG.get_safe('process.query.parameters',None)
         self.publish_limit   = self.CFG.get_safe('process.query.publish_limit', 10)
         self.tdoa            = self.CFG.get_safe('process.query.tdoa',None)
+        self.max_bytes       = self.CFG.get_safe('process.query.max_bytes', ReplayProcess.max_bytes)
         self.stream_id       = self.CFG.get_safe('process.publish_streams.output', '')
         self.stream_def      = pubsub.read_stream_definition(stream_id=self.stream_id)
         self.stream_def_id   = self.stream_def._id
@@ -132,10 +138,13 @@ class ReplayProcess(BaseReplayProcess):
             log.warning('Retrieve returning empty set')
             return rdt
 
+        return cls._fill_rdt(rdt, data_dict, coverage.temporal_parameter_name)
 
-        rdt[coverage.temporal_parameter_name] = data_dict[coverage.temporal_parameter_name]
+    @classmethod
+    def _fill_rdt(cls, rdt, data_dict, temporal_parameter):
+        rdt[temporal_parameter] = data_dict[temporal_parameter]
         for field in rdt.fields:
-            if field == coverage.temporal_parameter_name:
+            if field == temporal_parameter:
                 continue
             # The values have already been inside a coverage so we know they're safe and they exist, so they can be inserted directly.
             if field in data_dict:
@@ -165,6 +174,106 @@ class ReplayProcess(BaseReplayProcess):
             raise TypeError("tdoa is incorrect type: %s" % type(tdoa))
 
         return cls._data_dict_to_rdt(data_dict, stream_def_id, coverage)
+
+    @classmethod
+    def _cov2granules(cls, coverage, start_time=None, end_time=None, stride_time=None, stream_def_id=None, parameters=None, tdoa=None, sort_parameter=None, max_bytes=None, dataset_id=None):
+        '''
+        Generator form of _cov2granule, it walks the coverage in bounded time
+        windows and yields a record dictionary per window. The window is resized
+        from the density of the data so that no read exceeds max_bytes.
+        '''
+        if tdoa is not None:
+            # Index slices can't be mapped onto time windows without the time axis
+            yield cls._cov2granule(coverage, start_time, end_time, stride_time, stream_def_id, parameters, tdoa, sort_parameter)
+            return
+
+        if start_time:
+            start_time += 2208988800
+        if end_time:
+            end_time += 2208988800
+
+        tname = coverage.temporal_parameter_name
+        max_records = max(1, int((max_bytes or cls.max_bytes) / cls._record_size(coverage, parameters)))
+        # The time index counts the records in a window from at most two blocks
+        # of time values, so dense windows get shrunk before they're read
+        index = TimeUtils.get_time_index(dataset_id)
+        read_block = TimeUtils._block_reader(coverage)
+
+        if start_time is None or end_time is None:
+            time_bounds = cls._time_bounds(coverage, dataset_id, index)
+            if time_bounds is None:
+                return # Empty coverage
+            if start_time is None:
+                start_time = time_bounds[0]
+            if end_time is None:
+                end_time = time_bounds[1]
+        span = float(end_time - start_time)
+
+        # Start with a window that would fit max_records if the data were one record per second
+        step = min(max(span, 1.), float(max_records))
+        lower = start_time
+        while lower <= end_time:
+            upper = min(lower + step, end_time)
+            bounds = index.range(lower, upper, read_block) if index is not None and upper > lower else None
+            if bounds is not None:
+                records = (bounds[1] - bounds[0]) / (stride_time or 1)
+                if records > max_records:
+                    step = (upper - lower) * max_records / float(records) * 0.9
+                    continue
+            data_dict = coverage.get_parameter_values(param_names=parameters, time_segment=(lower, upper), stride_length=stride_time, fill_empty_params=True, sort_parameter=sort_parameter).get_data()
+            records = len(data_dict[tname]) if data_dict and tname in data_dict else 0
+
+            if records > max_records and upper > lower:
+                # Too dense, shrink the window and read it again
+                step = (upper - lower) * max_records / float(records) * 0.9
+                del data_dict
+                continue
+
+            if records:
+                yield cls._data_dict_to_rdt(data_dict, stream_def_id, coverage)
+            del data_dict
+
+            if records < max_records / 4:
+                step *= 2
+            # time_segment is inclusive of both ends
+            lower = np.nextafter(upper, np.inf)
+
+    @classmethod
+    def _record_size(cls, coverage, parameters=None):
+        '''
+        Estimates the number of bytes per record for the parameters
+        '''
+        size = 0
+        for name in (parameters or coverage.list_parameters()):
+            try:
+                size += np.dtype(coverage.get_parameter_context(name).param_type.value_encoding).itemsize
+            except (TypeError, AttributeError, KeyError):
+                size += 8
+        return max(size, 1)
+
+    @classmethod
+    def _time_bounds(cls, coverage, dataset_id=None, index=None):
+        '''
+        Returns the (min, max) of the coverage's temporal parameter. The dataset
+        metadata document or the time index is used when available, to avoid
+        reading the time axis.
+        '''
+        tname = coverage.temporal_parameter_name
+        if dataset_id and Container.instance is not None:
+            try:
+                doc = Container.instance.object_store.read_doc(dataset_id)
+                if tname in doc['bounds']:
+                    return tuple(doc['bounds'][tname])
+            except NotFound:
+                pass
+        if index is None:
+            index = TimeUtils.get_time_index(dataset_id)
+        if index is not None and index.blocks:
+            return (min(b[2] for b in index.blocks), max(b[3] for b in index.blocks))
+        times = coverage.get_parameter_values([tname], fill_empty_params=True).get_data()[tname]
+        if not len(times):
+            return None
+        return (np.min(times), np.max(times))
        
 
 
@@ -196,6 +305,10 @@ class ReplayProcess(BaseReplayProcess):
     @classmethod
     def get_last_values(cls, dataset_id, number_of_points=100, delivery_format=''):
         stream_def_id = delivery_format
+        rdt = cls._get_tail_values(dataset_id, number_of_points, stream_def_id)
+        if rdt is not None:
+            return rdt
+        cov = None
         try:
             cov = DatasetManagementService._get_coverage(dataset_id, mode='r')
             if cov.is_empty():
@@ -217,6 +330,31 @@ class ReplayProcess(BaseReplayProcess):
                 cov.close(timeout=5)
         return rdt
 
+    @classmethod
+    def _get_tail_values(cls, dataset_id, number_of_points, stream_def_id):
+        '''
+        Serves the last values from the dataset's tail index if it holds enough
+        records, returns None otherwise.
+        '''
+        if Container.instance is None:
+            return None
+        try:
+            tail = TailIndex.read(Container.instance.object_store, dataset_id)
+        except Exception:
+            log.exception('Problems reading the tail index for dataset %s', dataset_id)
+            return None
+        if tail is None or not tail.covers(number_of_points) or not len(tail):
+            return None
+
+        data_dict = tail.last(number_of_points)
+        if stream_def_id:
+            return cls._fill_rdt(RecordDictionaryTool(stream_definition_id=stream_def_id), data_dict, tail.temporal_parameter)
+        cov = DatasetManagementService._get_coverage(dataset_id, mode='r')
+        try:
+            return cls._data_dict_to_rdt(data_dict, None, cov)
+        finally:
+            cov.close(timeout=5)
+
 
     def execute_replay(self):
         '''
@@ -249,19 +387,20 @@ class ReplayProcess(BaseReplayProcess):
 
     def _replay(self):
         coverage = DatasetManagementService._get_coverage(self.dataset_id,mode='r')
-        rdt = self._cov2granule(coverage=coverage, start_time=self.start_time, end_time=self.end_time, stride_time=self.stride_time, parameters=self.parameters, stream_def_id=self.stream_def_id)
-        elements = len(rdt)
-        
-        for i in xrange(elements / self.publish_limit):
-            outgoing = RecordDictionaryTool(stream_definition_id=self.stream_def_id)
-            fields = self.parameters or outgoing.fields
-            for field in fields:
-                v = rdt[field]
-                if v is not None:
-                    outgoing[field] = v[(i*self.publish_limit) : ((i+1)*self.publish_limit)]
-            yield outgoing
-        coverage.close(timeout=5)
-        return 
+        try:
+            chunks = self._cov2granules(coverage=coverage, start_time=self.start_time, end_time=self.end_time, stride_time=self.stride_time, parameters=self.parameters, stream_def_id=self.stream_def_id, max_bytes=self.max_bytes, dataset_id=self.dataset_id)
+            for rdt in chunks:
+                elements = len(rdt)
+                for i in xrange(0, elements, self.publish_limit):
+                    outgoing = RecordDictionaryTool(stream_definition_id=self.stream_def_id)
+                    fields = self.parameters or outgoing.fields
+                    for field in fields:
+                        v = rdt[field]
+                        if v is not None:
+                            outgoing[field] = v[i : i + self.publish_limit]
+                    yield outgoing
+        finally:
+            coverage.close(timeout=5)
 
 class RetrieveProcess:
     '''
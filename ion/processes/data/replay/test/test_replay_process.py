@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/replay/test/test_replay_process.py
+@description Unit tests for chunked retrieval in the replay process
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.replay.replay_process import ReplayProcess
+
+from mock import Mock, patch
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+class MockCoverage(object):
+    temporal_parameter_name = 'time'
+
+    def __init__(self, times):
+        self.times = np.asarray(times, dtype='float64')
+        self.reads = []
+
+    def list_parameters(self):
+        return ['time', 'temp']
+
+    def get_parameter_context(self, name):
+        context = Mock()
+        context.param_type.value_encoding = 'float64'
+        return context
+
+    def get_parameter_values(self, param_names=None, time_segment=None, **kwargs):
+        self.reads.append(time_segment)
+        times = self.times
+        if time_segment is not None:
+            lower, upper = time_segment
+            times = times[(times >= lower) & (times <= upper)]
+        pv = Mock()
+        pv.get_data.return_value = {'time': times, 'temp': times * 2}
+        return pv
+
+@attr('UNIT', group='dm')
+class TestChunkedRetrieval(PyonTestCase):
+    def setUp(self):
+        patcher = patch.object(ReplayProcess, '_data_dict_to_rdt', Mock(side_effect=lambda data_dict, stream_def_id, coverage : data_dict))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_chunks_are_bounded(self):
+        # Irregular density: a sparse hour, then 10 Hz data
+        times = np.concatenate([np.arange(0, 3600, 60), np.arange(3600, 4600, 0.1)])
+        coverage = MockCoverage(times)
+        max_bytes = 500 * 16 # 500 records of (time, temp)
+
+        chunks = list(ReplayProcess._cov2granules(coverage, max_bytes=max_bytes))
+
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk['time']), 500)
+        # Every record is returned exactly once and in order
+        np.testing.assert_array_equal(np.concatenate([c['time'] for c in chunks]), times)
+
+    def test_time_window(self):
+        coverage = MockCoverage(np.arange(2208988800, 2208988800 + 1000, dtype='float64'))
+        chunks = list(ReplayProcess._cov2granules(coverage, start_time=100, end_time=199, max_bytes=16 * 10))
+        result = np.concatenate([c['time'] for c in chunks])
+        np.testing.assert_array_equal(result, np.arange(2208988900, 2208989000))
+
+    def test_empty_coverage(self):
+        coverage = MockCoverage([])
+        self.assertEquals(list(ReplayProcess._cov2granules(coverage)), [])
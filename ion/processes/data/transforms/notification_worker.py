@@ -11,13 +11,14 @@ from datetime import datetime
 from email.mime.text import MIMEText
 import smtplib
 
+from pyon.core.exception import NotFound
 from pyon.event.event import EventPublisher, EventSubscriber
 from pyon.public import log, RT, OT, PRED, CFG
 
 from interface.objects import DeliveryModeEnum, NotificationFrequencyEnum
 
 from ion.core.process.transform import TransformEventListener
-from ion.services.dm.utility.uns_utility_methods import load_notifications
+from ion.services.dm.utility.uns_utility_methods import NotificationIndex, notification_keys
 
 from jinja2 import Environment, FileSystemLoader
 
@@ -47,18 +48,13 @@ class NotificationWorker(TransformEventListener):
 
         super(NotificationWorker,self).on_start()
 
-        self.notifications = load_notifications()
-
-        def _load_notifications_callback(msg, headers):
-            """ local callback method so this can be used as callback in EventSubscribers """
-            self.notifications = load_notifications() # from uns_utility_methods
-
+        self.notifications = NotificationIndex.load() # from uns_utility_methods
 
         # the subscriber for the ReloadUserInfoEvent (new subscriber, subscription deleted, notifications changed, etc)
         self.reload_user_info_subscriber = EventSubscriber(
             event_type=OT.ReloadUserInfoEvent,
             #origin='UserNotificationService',
-            callback=_load_notifications_callback
+            callback=self._reload_notifications_callback
         )
         self.add_endpoint(self.reload_user_info_subscriber)
 
@@ -67,10 +63,37 @@ class NotificationWorker(TransformEventListener):
             event_type=OT.ResourceModifiedEvent,
             sub_type="UPDATE",
             origin_type="UserInfo",
-            callback=_load_notifications_callback
+            callback=self._user_info_modified_callback
         )
         self.add_endpoint(self.userinfo_rsc_mod_subscriber)
 
+    def _reload_notifications_callback(self, event, headers):
+        """ updates the NotificationRequest named by the event, or reloads all of them if there isn't one """
+        notification_id = getattr(event, 'notification_id', None)
+        if notification_id:
+            self.update_notification(notification_id)
+        else:
+            self.notifications = NotificationIndex.load()
+
+    def _user_info_modified_callback(self, event, headers):
+        """ reindexes the NotificationRequests of the modified UserInfo """
+        for notification_id in self.notifications.notification_ids(event.origin):
+            self.update_notification(notification_id)
+
+    def update_notification(self, notification_id):
+        """ replaces a NotificationRequest in the index with its current version and users """
+        self.notifications.remove(notification_id)
+        try:
+            notification = self.resource_registry.read(notification_id)
+        except NotFound:
+            return
+        users, _ = self.resource_registry.find_subjects(RT.UserInfo, PRED.hasNotification, notification_id, id_only=False)
+        if not users:
+            return
+        keys = notification_keys(notification, self.resource_registry)
+        for user in users:
+            self.notifications.add(notification, user, keys)
+
     def process_event(self, event, headers):
         """
         callback for the subscriber listening for all events
@@ -86,15 +109,12 @@ class NotificationWorker(TransformEventListener):
 
         # users to notify with a list of the notifications that have been triggered by this Event
         users = {} # users to be notified
-        # loop the combinations of keys (see _key_combinations below for explanation)
-        # set() to eliminate duplicates when '' values exist in tuple
-        for k in set(self._key_combinations(key)):
-            if k in self.notifications:
-                for (notification, user) in self.notifications.get(k, []):
-                    # notification has been triggered
-                    if user not in users:
-                        users[user] = []
-                    users[user].append(notification)
+        # the index matches the key against notifications keyed by the same tuple, or with '' in any of its positions
+        for (notification, user) in self.notifications.match(*key):
+            # notification has been triggered
+            if user not in users:
+                users[user] = []
+            users[user].append(notification)
         # we now have a dict, keyed by users that will be notified, each user has a list of notifications triggered by this event
         
         # send email
@@ -174,42 +194,6 @@ class NotificationWorker(TransformEventListener):
         """ class method so user/pass/etc can be added """
         return smtplib.SMTP(self.smtp_host, self.smtp_port)
 
-    def _key_combinations(self, key):
-        """
-        creates a list of all possible combinations of the tuple elements, from 1 member to len(key) members
-
-        only the elements of each combination are set, '' elsewhere, all therefore have same length as key
-        eg. ('a', 'b', 'c') -> (a) becomes ('a', '', '') and (b) becomes ('', 'b', '')
-
-        extension of https://docs.python.org/2/library/itertools.html#itertools.combinations (Equivalent to section)
-            differences:
-            - loops all r from 1 to n
-            - returns tuple of same length as n with '' as filler
-        """
-        n = len(key)
-        # want all combinations of 1 to n
-        for r in range(1,n+1):
-            indices = range(r)
-            # first combination is the first r values
-            combination = ['']*n # creates a list of n ''s
-            for i in indices: 
-                combination[i] = key[i]
-            yield tuple(combination)
-            # remaining combinations
-            while True:
-                for i in reversed(range(r)):
-                    if indices[i] != i + n - r:
-                        break
-                else:
-                    break
-                indices[i] += 1
-                for j in range(i+1, r):
-                    indices[j] = indices[j-1] + 1
-                combination = ['']*n
-                for i in indices:
-                    combination[i] = key[i]
-                yield tuple(combination)
-
     # TODO: REMOVE AND REPLACE WITHIN NotificationRequest
     #       this is a temporary hack so we're using UX (ion-ux) defined labels in the email
     #       see https://github.com/ooici/ion-ux/blob/master/static/js/ux-views-notifications.js#L1-L70
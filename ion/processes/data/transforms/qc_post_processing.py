@@ -7,9 +7,10 @@
 
 from pyon.core.exception import BadRequest, NotFound
 from pyon.ion.process import ImmediateProcess, SimpleProcess
-from interface.services.dm.idata_retriever_service import DataRetrieverServiceProcessClient
-from ion.services.dm.utility.granule import RecordDictionaryTool
-from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.services.dm.utility.coverage_pool import CoveragePool
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.util.time_utils import TimeUtils
+from ion.util.time_index import time_windows
 import time
 from pyon.ion.event import EventPublisher
 from pyon.public import OT, RT,PRED
@@ -19,9 +20,14 @@ from pyon.util.log import log
 from gevent.event import Event
 import gevent
 from gevent.queue import Queue
+from gevent.pool import Pool
+from ooi.timer import Accumulator
+from coverage_model import NumpyParameterData
+from collections import namedtuple
 import numpy as np
 import re
 import threading
+import zlib
 
 class QCPostProcessing(SimpleProcess):
     '''
@@ -38,12 +44,16 @@ class QCPostProcessing(SimpleProcess):
         - qc_params: a list of qc functions to evaluate, currently supported functions are: ['glblrng_qc',
           'spketst_qc', 'stuckvl_qc'], defaults to all
 
+    The span is read straight from the coverage in windows of about
+    service.qc_processing.window_records records, one window at a time.
+    Alerts are published per data product, QC field and hour of the span,
+    each ParameterQCEvent holds the failed times in temporal_values.
+
     '''
 
     qc_suffixes = ['glblrng_qc', 'spketst_qc', 'stuckvl_qc']
     def on_start(self):
         SimpleProcess.on_start(self)
-        self.data_retriever = DataRetrieverServiceProcessClient(process=self)
         self.interval_key = self.CFG.get_safe('process.interval_key',None)
         self.qc_params    = self.CFG.get_safe('process.qc_params',[])
         validate_is_not_none(self.interval_key, 'An interval key is necessary to paunch this process')
@@ -51,10 +61,14 @@ class QCPostProcessing(SimpleProcess):
         self.add_endpoint(self.event_subscriber)
         self.resource_registry = self.container.resource_registry
         self.run_interval = self.CFG.get_safe('service.qc_processing.run_interval', 24)
+        self.window_records = int(self.CFG.get_safe('service.qc_processing.window_records', 100000))
+        # dataset_id -> data product ids
+        self._data_products = {}
     
     def _event_callback(self, *args, **kwargs):
         log.info('QC Post Processing Triggered')
         dataset_ids, _ = self.resource_registry.find_resources(restype=RT.Dataset, id_only=True)
+        self._data_products = {}
         for dataset_id in dataset_ids:
             log.info('QC Post Processing for dataset %s', dataset_id)
             try:
@@ -75,40 +89,98 @@ class QCPostProcessing(SimpleProcess):
         self.qc_publisher = EventPublisher(event_type=OT.ParameterQCEvent)
         log.debug('Iterating over the data blocks')
 
-        for st,et in self.chop(int(start_time),int(end_time)):
-            log.debug('Chopping %s:%s', st, et)
-            log.debug("Retrieving data: data_retriever.retrieve('%s', query={'start_time':%s, 'end_time':%s')", dataset_id, st, et)
-            try:
-                granule = self.data_retriever.retrieve(dataset_id, query={'start_time':st, 'end_time':et})
-            except BadRequest:
-                data_products, _ = self.container.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct)
-                for data_product in data_products:
-                    log.exception('Failed to perform QC Post Processing on %s', data_product.name)
-                    log.error('Calculated Start Time: %s', st)
-                    log.error('Calculated End Time:   %s', et)
-                raise
-            log.debug('Retrieved Data')
-            rdt = RecordDictionaryTool.load_from_granule(granule)
-            qc_fields = [i for i in rdt.fields if any([i.endswith(j) for j in qc_params])]
+        with CoveragePool.checkout(dataset_id, mode='r', kind='nonview') as coverage:
+            qc_fields = [i for i in coverage.list_parameters() if any([i.endswith(j) for j in qc_params])]
             log.debug('QC Fields: %s', qc_fields)
-            for field in qc_fields:
-                val = rdt[field]
-                if val is None:
-                    continue
-                if not np.all(val):
-                    log.debug('Found QC Alerts')
-                    indexes = np.where(val==0)
-                    timestamps = rdt[rdt.temporal_parameter][indexes[0]]
-                    self.flag_qc_parameter(dataset_id, field, timestamps.tolist(),{})
+            if not qc_fields:
+                return
+            # Deal with the NTP
+            start_time += 2208988800
+            end_time += 2208988800
+            # field, hour -> failed times not published yet
+            pending = {}
+            for st, et in self.windows(coverage, dataset_id, start_time, end_time):
+                alerts = self.evaluate_window(coverage, dataset_id, qc_fields, (st, et))
+                if alerts:
+                    log.debug('Found QC Alerts in %s:%s', st, et)
+                for field, times in alerts.iteritems():
+                    for hour, hour_times in self.chop_times(start_time, times):
+                        pending.setdefault((field, hour), []).extend(hour_times)
+                # Later windows can't add to the hours before this window's end
+                self.flag_pending(dataset_id, pending, self.hour_of(start_time, et))
+            self.flag_pending(dataset_id, pending)
+
+    def windows(self, coverage, dataset_id, start_time, end_time):
+        '''
+        Splits [start_time, end_time] into time segments of roughly
+        window_records records
+        '''
+        index = TimeUtils.get_time_index(dataset_id)
+        return time_windows(index, start_time, end_time, self.window_records, coverage.num_timesteps(), lambda: ReplayProcess._time_bounds(coverage, dataset_id))
 
+    @classmethod
+    def hour_of(cls, start_time, t):
+        return int((t - start_time) // 3600)
+
+    @classmethod
+    def chop_times(cls, start_time, times):
+        '''
+        Groups sorted times by the hour of the span they fall in
+        '''
+        times = np.asanyarray(times)
+        hours = ((times - start_time) // 3600).astype('int64')
+        for hour in np.unique(hours):
+            yield int(hour), times[hours == hour].tolist()
+
+    def evaluate_window(self, coverage, dataset_id, qc_fields, window):
+        '''
+        Returns { qc field : [time of each failed record] } for the records in
+        the time window
+        '''
+        log.debug('Reading %s:%s', *window)
+        tname = coverage.temporal_parameter_name
+        try:
+            data_dict = coverage.get_parameter_values(param_names=[tname] + qc_fields, time_segment=window, fill_empty_params=True).get_data()
+        except Exception as e:
+            for data_product_id in self.get_data_products(dataset_id):
+                log.exception('Failed to perform QC Post Processing on %s', data_product_id)
+                log.error('Calculated Start Time: %s', window[0])
+                log.error('Calculated End Time:   %s', window[1])
+            raise BadRequest('Problems reading from the coverage: %s' % e.message)
+
+        alerts = {}
+        for field in qc_fields:
+            val = data_dict.get(field)
+            if val is None or not len(val):
+                continue
+            if not np.all(val):
+                indexes = np.where(val==0)
+                alerts[field] = data_dict[tname][indexes[0]].tolist()
+        return alerts
 
+    def flag_pending(self, dataset_id, pending, before=None):
+        '''
+        Flags the pending alerts of the hours before the given one, or all of them
+        '''
+        for field, hour in sorted(pending):
+            if before is None or hour < before:
+                self.flag_qc_parameter(dataset_id, field, pending.pop((field, hour)), {})
 
     def flag_qc_parameter(self, dataset_id, parameter, temporal_values, configuration):
         log.info('Flagging QC for %s', parameter)
-        data_product_ids, _ = self.resource_registry.find_subjects(object=dataset_id, subject_type=RT.DataProduct, predicate=PRED.hasDataset, id_only=True)
-        for data_product_id in data_product_ids:
+        for data_product_id in self.get_data_products(dataset_id):
             self.qc_publisher.publish_event(origin=data_product_id, qc_parameter=parameter, temporal_values=temporal_values, configuration=configuration)
 
+    def get_data_products(self, dataset_id):
+        '''
+        Returns the ids of the data products of a dataset, cached for the
+        duration of a run
+        '''
+        if dataset_id not in self._data_products:
+            data_product_ids, _ = self.resource_registry.find_subjects(object=dataset_id, subject_type=RT.DataProduct, predicate=PRED.hasDataset, id_only=True)
+            self._data_products[dataset_id] = data_product_ids
+        return self._data_products[dataset_id]
+
     @classmethod
     def chop(cls, start_time, end_time):
         while start_time < end_time:
@@ -116,10 +188,48 @@ class QCPostProcessing(SimpleProcess):
             start_time = min(start_time+3600, end_time)
         return
 
+QCResult = namedtuple('QCResult', ['times', 'qc', 'context'])
+
 class QCProcessor(SimpleProcess):
+    '''
+    Evaluates the QC parameters of every data product with a reference
+    designator, in sweeps over the data products.
+
+    Data products are sharded over the QC processors by a hash of their id:
+    launch shard_count processors, each configured with its own shard_index.
+    Within a processor up to service.qc_processing.workers data products are
+    evaluated at a time. Reference designators, datasets and QC lookup
+    documents are cached between sweeps for service.qc_processing.cache_ttl
+    seconds.
+    '''
     def __init__(self):
         self.event = Event() # Synchronizes the thread
         self.timeout = 10
+        # (dataset_id, qc parameter) -> time of the last evaluated record
+        self.high_water_marks = {}
+        # (dataset_id, qc parameter) -> (times, values) of the input preceding the high-water mark
+        self.contexts = {}
+        # (dataset_id, qc parameter) -> time of the last full scan for unevaluated records
+        self._last_scans = {}
+        self.rescan_interval = 3600
+        # reference designator -> datasets evaluated for it
+        self._rd_datasets = {}
+        self.trend_lookback = 1000
+        # data_product_id -> (reference designator or None, time cached)
+        self._reference_designators = {}
+        # data_product_id -> dataset_id
+        self._datasets = {}
+        # reference designator -> (lookup document or None, time cached)
+        self._lookup_docs = {}
+        self.cache_ttl = 300
+        self.workers = 4
+        self.shard_index = 0
+        self.shard_count = 1
+        # (dataset_id, qc parameter) evaluated in the current sweep
+        self._sweep_parameters = set()
+        # Sweep duration, data products, records evaluated and backlog
+        self.time_stats = Accumulator(format='%3f')
+        self.last_sweep = {}
 
     def on_start(self):
         '''
@@ -129,6 +239,12 @@ class QCProcessor(SimpleProcess):
         self._event_subscriber = EventSubscriber(event_type=OT.ResetQCEvent, callback=self.receive_event, auto_delete=True) # TODO Correct event types
         self._event_subscriber.start()
         self.timeout = self.CFG.get_safe('endpoint.receive.timeout', 10)
+        self.trend_lookback = self.CFG.get_safe('service.qc_processing.trend_lookback', 1000)
+        self.cache_ttl = self.CFG.get_safe('service.qc_processing.cache_ttl', 300)
+        self.rescan_interval = self.CFG.get_safe('service.qc_processing.rescan_interval', 3600)
+        self.workers = int(self.CFG.get_safe('service.qc_processing.workers', 4))
+        self.shard_index = int(self.CFG.get_safe('process.qc_processing.shard_index', 0))
+        self.shard_count = int(self.CFG.get_safe('process.qc_processing.shard_count', 1))
         self.resource_registry = self.container.resource_registry
         self.event_queue = Queue()
 
@@ -160,15 +276,52 @@ class QCProcessor(SimpleProcess):
 
     def qc_processing_loop(self):
         '''
-        Iterates through available data products and evaluates QC
+        Iterates through this processor's share of the data products and
+        evaluates QC, workers data products at a time
         '''
+        start = time.time()
         data_products, _ = self.container.resource_registry.find_resources(restype=RT.DataProduct, id_only=False)
+        data_products = [dp for dp in data_products if self.in_shard(dp._id)]
+        self._sweep_parameters = set()
+        pool = Pool(size=self.workers)
+        records = []
+        processed = 0
         for data_product in data_products:
+            # Break early if we can
+            if self.event.is_set():
+                break
+            pool.spawn(self.process_data_product, data_product, records)
+            processed += 1
+        pool.join()
+
+        self.last_sweep = {
+            'duration'      : time.time() - start,
+            'data_products' : processed,
+            'records'       : sum(records),
+            'backlog'       : len(data_products) - processed,
+        }
+        for name, value in self.last_sweep.iteritems():
+            self.time_stats.add_value('qc_processor.sweep.%s' % name, value)
+        log.debug("QC sweep: %s", self.last_sweep)
+
+    def in_shard(self, data_product_id):
+        '''
+        True if the data product is evaluated by this processor
+        '''
+        if self.shard_count <= 1:
+            return True
+        return (zlib.crc32(data_product_id) & 0xffffffff) % self.shard_count == self.shard_index
+
+    def process_data_product(self, data_product, records):
+        '''
+        Evaluates the QC parameters of a data product, appends the number of
+        records evaluated to records
+        '''
+        try:
             # Get the reference designator
-            try:
-                rd = self.get_reference_designator(data_product._id)
-            except BadRequest:
-                continue
+            rd = self.get_cached_reference_designator(data_product._id)
+            if rd is None:
+                return
             parameters = self.get_parameters(data_product)
             # Create a mapping of inputs to QC
             qc_mapping = {}
@@ -182,14 +335,12 @@ class QCProcessor(SimpleProcess):
                         sname = g.groups()[0]
                     qc_mapping[sname] = p.name
 
-            for p in parameters:
-                # for each parameter, if the name ends in _qc run the qc
-                if p.name.endswith('_qc'):
-                    self.run_qc(data_product,rd, p, qc_mapping, parameters)
-
-            # Break early if we can
-            if self.event.is_set(): 
-                break
+            # for each parameter, if the name ends in _qc run the qc
+            qc_parameters = [p for p in parameters if p.name.endswith('_qc')]
+            if qc_parameters:
+                records.append(self.run_qc_parameters(data_product, rd, qc_parameters, qc_mapping, parameters))
+        except:
+            log.error("Error evaluating QC for data product %s", data_product._id, exc_info=True)
 
     def event_processing_loop(self):
         '''
@@ -199,6 +350,10 @@ class QCProcessor(SimpleProcess):
         self.event_queue.put(StopIteration)
         for event in self.event_queue:
             log.error("My event's reference designator: %s", event.origin)
+            # Re-evaluate the QC of the reference designator's datasets from scratch
+            for dataset_id in self._rd_datasets.get(event.origin, ()):
+                self.reset(dataset_id)
+            self._lookup_docs.pop(event.origin, None)
 
     def suspend(self):
         '''
@@ -209,6 +364,40 @@ class QCProcessor(SimpleProcess):
         log.info("QC Thread Suspended")
 
 
+    def get_cached_reference_designator(self, data_product_id):
+        '''
+        Returns the reference designator for a data product or None if it has
+        none, answers from the cache for cache_ttl seconds
+        '''
+        now = time.time()
+        if data_product_id in self._reference_designators:
+            rd, cached = self._reference_designators[data_product_id]
+            if now - cached < self.cache_ttl:
+                return rd
+        try:
+            rd = self.get_reference_designator(data_product_id)
+        except BadRequest:
+            rd = None
+        self._reference_designators[data_product_id] = (rd, now)
+        return rd
+
+    def get_lookup_doc(self, reference_designator):
+        '''
+        Returns the QC lookup document of a reference designator or None if
+        there is none, answers from the cache for cache_ttl seconds
+        '''
+        now = time.time()
+        if reference_designator in self._lookup_docs:
+            doc, cached = self._lookup_docs[reference_designator]
+            if now - cached < self.cache_ttl:
+                return doc
+        try:
+            doc = self.container.object_store.read_doc(reference_designator)
+        except NotFound:
+            doc = None
+        self._lookup_docs[reference_designator] = (doc, now)
+        return doc
+
     def get_reference_designator(self, data_product_id=''):
         '''
         Returns the reference designator for a data product if it has one
@@ -259,7 +448,36 @@ class QCProcessor(SimpleProcess):
         else:
             return input_name
 
-    def run_qc(self, data_product, reference_designator, parameter, qc_mapping, parameters):
+    def run_qc_parameters(self, data_product, reference_designator, qc_parameters, qc_mapping, parameters):
+        '''
+        Evaluates the QC parameters of a data product over the records ingested
+        since each parameter's high-water mark, and writes the results back to
+        the coverage in one batch. Returns the number of records evaluated
+        '''
+        dataset_id = self.get_dataset(data_product)
+        # Data products of the same dataset can expose different QC parameters
+        # and input mappings, only the parameters already evaluated through
+        # another data product are skipped
+        qc_parameters = [p for p in qc_parameters if (dataset_id, p.name) not in self._sweep_parameters]
+        if not qc_parameters:
+            return 0
+        self._sweep_parameters.update((dataset_id, p.name) for p in qc_parameters)
+        coverage = self.get_coverage(dataset_id)
+        try:
+            if not coverage.num_timesteps(): # No data = no qc
+                return 0
+            self._rd_datasets.setdefault(reference_designator, set()).add(dataset_id)
+            results = {}
+            for parameter in qc_parameters:
+                result = self.run_qc(data_product, reference_designator, parameter, qc_mapping, parameters, coverage, dataset_id)
+                if result is not None:
+                    results[parameter.name] = result
+            self.write_results(coverage, dataset_id, results)
+            return sum(len(result.times) for result in results.itervalues())
+        finally:
+            CoveragePool.release(coverage)
+
+    def run_qc(self, data_product, reference_designator, parameter, qc_mapping, parameters, coverage, dataset_id):
         '''
         Determines which algorithm the parameter should run, then evaluates the QC
 
@@ -267,6 +485,10 @@ class QCProcessor(SimpleProcess):
         reference_designator - reference designator string
         parameter            - parameter context resource
         qc_mapping           - a dictionary of { data_product_name : parameter_name }
+        coverage             - the data product's coverage
+        dataset_id           - the data product's dataset
+
+        Returns a QCResult or None if there was nothing to evaluate
         '''
 
         # We key off of the OOI Short Name
@@ -276,9 +498,8 @@ class QCProcessor(SimpleProcess):
             return # No input!
         input_name = self.calibrated_candidates(data_product, parameter, qc_mapping, parameters)
 
-        try:
-            doc = self.container.object_store.read_doc(reference_designator)
-        except NotFound:
+        doc = self.get_lookup_doc(reference_designator)
+        if doc is None:
             return # NO QC lookups found
         if dp_ident not in doc:
             log.critical("Data product %s not in doc", dp_ident)
@@ -286,39 +507,32 @@ class QCProcessor(SimpleProcess):
         # Lookup table has the rows for the QC inputs
         lookup_table = doc[dp_ident]
 
-        # An instance of the coverage is loaded if we need to run an algorithm
-        dataset_id = self.get_dataset(data_product)
-        coverage = self.get_coverage(dataset_id)
-        if not coverage.num_timesteps: # No data = no qc
-            coverage.close()
-            return
-
         try:
             # Get the lookup table info then run
             if alg.lower() == 'glblrng':
                 row = self.recent_row(lookup_table['global_range'])
                 min_value = row['min_value']
                 max_value = row['max_value']
-                self.process_glblrng(coverage, parameter, input_name, min_value, max_value)
+                return self.process_glblrng(coverage, dataset_id, parameter, input_name, min_value, max_value)
 
             elif alg.lower() == 'stuckvl':
                 row = self.recent_row(lookup_table['stuck_value'])
                 resolution = row['resolution']
                 N = row['consecutive_values']
-                self.process_stuck_value(coverage, parameter,input_name, resolution, N)
+                return self.process_stuck_value(coverage, dataset_id, parameter, input_name, resolution, N)
 
             elif alg.lower() == 'trndtst':
                 row = self.recent_row(lookup_table['trend_test'])
                 ord_n = row['polynomial_order']
                 nstd = row['standard_deviation']
-                self.process_trend_test(coverage, parameter, input_name, ord_n, nstd)
+                return self.process_trend_test(coverage, dataset_id, parameter, input_name, ord_n, nstd)
 
             elif alg.lower() == 'spketst':
                 row = self.recent_row(lookup_table['spike_test'])
                 acc = row['accuracy']
                 N = row['range_multiplier']
                 L = row['window_length']
-                self.process_spike_test(coverage, parameter, input_name, acc, N, L)
+                return self.process_spike_test(coverage, dataset_id, parameter, input_name, acc, N, L)
 
             elif alg.lower() == "gradtst":
                 row = self.recent_row(lookup_table["gradient_test"])
@@ -330,7 +544,7 @@ class QCProcessor(SimpleProcess):
                 if isinstance(mindx, basestring) and not mindx:
                     mindx = np.nan
                 toldat = row["toldat"]
-                self.process_gradient_test(coverage, parameter, input_name, ddatdx, mindx, startdat, toldat)
+                return self.process_gradient_test(coverage, dataset_id, parameter, input_name, ddatdx, mindx, startdat, toldat)
 
             elif alg.lower() == 'loclrng':
                 row = self.recent_row(lookup_table["local_range"])
@@ -346,16 +560,12 @@ class QCProcessor(SimpleProcess):
 
                 datlimz = np.column_stack(datlimz)
                 datlim = np.column_stack([table['datlim1'], table['datlim2']])
-                self.process_local_range_test(coverage, parameter, input_name, datlim, datlimz, dims)
+                return self.process_local_range_test(coverage, dataset_id, parameter, input_name, datlim, datlimz, dims)
 
 
         except KeyError: # No lookup table
             self.set_error(coverage, parameter)
 
-
-        finally:
-            coverage.close()
-
     def set_error(self, coverage, parameter):
         log.error("setting coverage parameter %s to -99", parameter.name)
 
@@ -363,144 +573,157 @@ class QCProcessor(SimpleProcess):
         array = coverage.get_parameter_values([name], fill_empty_params=True).get_data()[name]
         return array
 
+    #--------------------------------------------------------------------------------
+    # Incremental evaluation
+    #--------------------------------------------------------------------------------
 
-    def process_glblrng(self, coverage, parameter, input_name, min_value, max_value):
+    def evaluate(self, coverage, dataset_id, parameter, input_name, lookback, qc_function):
         '''
-        Evaluates the QC for global range for all data values that equal -88 (not yet evaluated)
-        '''
-        log.error("input name: %s", input_name)
-        log.info("Num timesteps: %s", coverage.num_timesteps)
-
-        # Get all of the QC values, and find where -88 is set (uninitialized)
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where( qc_array == -88 )[0]
+        Evaluates qc_function(values, times) over the records ingested since the
+        parameter's high-water mark. Windowed tests get the lookback records that
+        precede the new ones as context, the result only covers the new records.
 
-        # Now build a variable, but I need to keep track of the time where the data goes
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
+        The first time a parameter is seen, and every rescan_interval seconds
+        after that, its column is scanned for the first record that is not yet
+        evaluated (-88) so records backfilled behind the mark are picked up.
+        '''
+        key = (dataset_id, parameter.name)
+        time_name = coverage.temporal_parameter_name
+        mark = self.high_water_marks.get(key)
+        now = time.time()
+        if mark is not None and now - self._last_scans.get(key, now) > self.rescan_interval:
+            mark = None
+        if mark is None:
+            self._last_scans[key] = now
+            data = coverage.get_parameter_values([time_name, parameter.name, input_name], fill_empty_params=True).get_data()
+            times, values = data[time_name], data[input_name]
+            pending = np.where(data[parameter.name] == -88)[0]
+            if not len(pending):
+                # Everything has been evaluated
+                self.high_water_marks[key] = times[-1] if len(times) else None
+                self.contexts[key] = (times[len(times)-lookback:], values[len(values)-lookback:])
+                return None
+            start = max(0, pending[0] - lookback)
+            first_new = pending[0] - start
+            times, values = times[start:], values[start:]
+        else:
+            data = coverage.get_parameter_values([time_name, input_name], time_segment=(np.nextafter(mark, np.inf), None), fill_empty_params=True).get_data()
+            if not len(data[time_name]):
+                return None
+            context_times, context_values = self.contexts.get(key, ([], []))
+            first_new = len(context_times)
+            times = np.concatenate([context_times, data[time_name]]) if first_new else data[time_name]
+            values = np.concatenate([context_values, data[input_name]]) if first_new else data[input_name]
+
+        qc_array = np.asanyarray(qc_function(values, times))
+        return QCResult(times[first_new:], qc_array[first_new:], (times[len(times)-lookback:], values[len(values)-lookback:]))
+
+    def write_results(self, coverage, dataset_id, results):
+        '''
+        Writes the QC results of a coverage in one call, then advances the
+        high-water marks
+        '''
+        if not results:
+            return
+        np_dict = {}
+        for name, result in results.iteritems():
+            np_dict[name] = NumpyParameterData(name, result.qc, result.times)
+        coverage.set_parameter_values(np_dict)
+        for name, result in results.iteritems():
+            self.high_water_marks[(dataset_id, name)] = result.times[-1]
+            self.contexts[(dataset_id, name)] = result.context
+
+    def reset(self, dataset_id):
+        '''
+        Forgets the high-water marks of a dataset, the QC parameters are
+        rescanned on the next cycle
+        '''
+        for key in self.high_water_marks.keys():
+            if key[0] == dataset_id:
+                self.high_water_marks.pop(key)
+                self.contexts.pop(key, None)
+                self._last_scans.pop(key, None)
 
+    def process_glblrng(self, coverage, dataset_id, parameter, input_name, min_value, max_value):
+        '''
+        Evaluates the QC for global range for the data values that have not been evaluated
+        '''
         from ion_functions.qc.qc_functions import dataqc_globalrangetest
-        qc = dataqc_globalrangetest(value_array, [min_value, max_value])
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc
-        }
+        def qc_function(values, times):
+            return dataqc_globalrangetest(values, [min_value, max_value])
+        return self.evaluate(coverage, dataset_id, parameter, input_name, 0, qc_function)
 
-
-    def process_stuck_value(self, coverage, parameter, input_name, resolution, N):
+    def process_stuck_value(self, coverage, dataset_id, parameter, input_name, resolution, N):
         '''
-        Evaluates the QC for stuck value for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for stuck value for the data values that have not been evaluated,
+        with the N preceding values as context
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
-        # Horribly inefficient...
         from ion_functions.qc.qc_functions import dataqc_stuckvaluetest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        qc_array = dataqc_stuckvaluetest_wrapper(value_array, resolution, N)
-        qc_array = qc_array[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
+        def qc_function(values, times):
+            return dataqc_stuckvaluetest_wrapper(values, resolution, N)
+        return self.evaluate(coverage, dataset_id, parameter, input_name, int(N), qc_function)
 
-
-    def process_trend_test(self, coverage, parameter, input_name, ord_n, nstd):
+    def process_trend_test(self, coverage, dataset_id, parameter, input_name, ord_n, nstd):
         '''
-        Evaluates the QC for trend test for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for trend test for the data values that have not been evaluated,
+        the trend is fit over trend_lookback preceding values as well
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
         from ion_functions.qc.qc_functions import dataqc_polytrendtest_wrapper
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-
-        qc_array = dataqc_polytrendtest_wrapper(value_array, time_array, ord_n, nstd)
-        qc_array = qc_array[indexes]
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
+        def qc_function(values, times):
+            return dataqc_polytrendtest_wrapper(values, times, ord_n, nstd)
+        return self.evaluate(coverage, dataset_id, parameter, input_name, self.trend_lookback, qc_function)
 
-    def process_spike_test(self, coverage, parameter, input_name, acc, N, L):
+    def process_spike_test(self, coverage, dataset_id, parameter, input_name, acc, N, L):
         '''
-        Evaluates the QC for spike test for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for spike test for the data values that have not been evaluated,
+        with a window length L of preceding values as context
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
         from ion_functions.qc.qc_functions import dataqc_spiketest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        qc_array = dataqc_spiketest_wrapper(value_array, acc, N, L)
-        qc_array = qc_array[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
-
-    def process_gradient_test(self, coverage, parameter, input_name, ddatdx, mindx, startdat, toldat):
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
+        def qc_function(values, times):
+            return dataqc_spiketest_wrapper(values, acc, N, L)
+        return self.evaluate(coverage, dataset_id, parameter, input_name, int(L), qc_function)
 
+    def process_gradient_test(self, coverage, dataset_id, parameter, input_name, ddatdx, mindx, startdat, toldat):
+        '''
+        Evaluates the QC for gradient test for the data values that have not been evaluated,
+        with the preceding value as context
+        '''
         from ion_functions.qc.qc_functions import dataqc_gradienttest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        
-        qc_array = dataqc_gradienttest_wrapper(value_array, time_array, ddatdx, mindx, startdat, toldat)
+        def qc_function(values, times):
+            return dataqc_gradienttest_wrapper(values, times, ddatdx, mindx, startdat, toldat)
+        return self.evaluate(coverage, dataset_id, parameter, input_name, 1, qc_function)
 
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array[indexes],
-                parameter.name : qc_array[indexes]
-        }
-
-
-    def process_local_range_test(self, coverage, parameter, input_name, datlim, datlimz, dims):
+    def process_local_range_test(self, coverage, dataset_id, parameter, input_name, datlim, datlimz, dims):
         return # Not ready
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
-        from ion_functions.qc.qc_functions import dataqc_localrangetest_wrapper
-        # dat
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-
         # datlim is an argument and comes from the lookup table
         # datlimz is an argument and comes from the lookup table
         # dims is an argument and is created using the column headings
         # pval_callback, well as for that...
         # TODO: slice_ is the window of the site data product, but for 
         # now we'll just use a global slice
+        from ion_functions.qc.qc_functions import dataqc_localrangetest_wrapper
         slice_ = slice(None)
         def parameter_callback(param_name):
             return coverage.get_parameter_values(param_name, slice_)
-
-
-        qc_array = dataqc_localrangetest_wrapper(value_array, datlim, datlimz, dims, parameter_callback)
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array[indexes],
-                parameter.name : qc_array[indexes]
-        }
-        log.error("Here's what it would look like\n%s", return_dictionary)
+        def qc_function(values, times):
+            return dataqc_localrangetest_wrapper(values, datlim, datlimz, dims, parameter_callback)
+        return self.evaluate(coverage, dataset_id, parameter, input_name, 0, qc_function)
 
 
 
 
     def get_dataset(self, data_product):
+        if data_product._id in self._datasets:
+            return self._datasets[data_product._id]
         dataset_ids, _ = self.resource_registry.find_objects(data_product, PRED.hasDataset, id_only=True)
         if not dataset_ids:
             raise BadRequest("No Dataset")
         dataset_id = dataset_ids[0]
+        self._datasets[data_product._id] = dataset_id
         return dataset_id
 
     def get_coverage(self, dataset_id):
-        cov = DatasetManagementService._get_coverage(dataset_id, mode='r+')
+        cov = CoveragePool.acquire(dataset_id, mode='r+')
         return cov
 
     def recent_row(self, rows):
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_qc_processor.py
+@description Unit tests for the QC processor and QC post processing
+'''
+
+from pyon.core.exception import BadRequest
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.transforms.qc_post_processing import QCProcessor, QCPostProcessing
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.util.time_utils import TimeUtils
+
+from mock import Mock, patch
+from nose.plugins.attrib import attr
+
+from contextlib import contextmanager
+import numpy as np
+
+class MockCoverage(object):
+    temporal_parameter_name = 'time'
+
+    def __init__(self, times, values):
+        self.data = {
+            'time' : np.asarray(times, dtype='float64'),
+            'temp' : np.asarray(values, dtype='float64'),
+            'temp_qc' : np.ones(len(times), dtype='int8') * -88,
+        }
+        self.reads = []
+
+    def append(self, times, values):
+        self.data['time'] = np.concatenate([self.data['time'], times])
+        self.data['temp'] = np.concatenate([self.data['temp'], values])
+        self.data['temp_qc'] = np.concatenate([self.data['temp_qc'], np.ones(len(times), dtype='int8') * -88])
+
+    def get_parameter_values(self, param_names, time_segment=None, **kwargs):
+        times = self.data['time']
+        mask = np.ones(len(times), dtype=bool)
+        if time_segment is not None and time_segment[0] is not None:
+            mask &= times >= time_segment[0]
+        self.reads.append(mask.sum())
+        pv = Mock()
+        pv.get_data.return_value = {name : self.data[name][mask] for name in param_names}
+        return pv
+
+    def set_parameter_values(self, values):
+        for name, data in values.iteritems():
+            index = np.searchsorted(self.data['time'], data.get_data()['time'])
+            self.data[name][index] = data.get_data()[name]
+
+
+def windowed_sum(values, times):
+    # A windowed test: each flag depends on the 3 preceding values
+    return np.array([np.sum(values[max(0, i-3):i+1]) for i in xrange(len(values))])
+
+@attr('UNIT', group='dm')
+class TestQCProcessor(PyonTestCase):
+    def setUp(self):
+        self.processor = QCProcessor()
+        self.parameter = Mock()
+        self.parameter.name = 'temp_qc'
+
+        def parameter_data(name, values, times):
+            return Mock(get_data=Mock(return_value={name:values, 'time':times}))
+        patcher = patch('ion.processes.data.transforms.qc_post_processing.NumpyParameterData', Mock(side_effect=parameter_data))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_cycle(self, coverage):
+        result = self.processor.evaluate(coverage, 'dataset', self.parameter, 'temp', 3, windowed_sum)
+        if result is not None:
+            self.processor.write_results(coverage, 'dataset', {'temp_qc' : result})
+        return result
+
+    def test_incremental(self):
+        coverage = MockCoverage(np.arange(10), np.arange(10))
+        result = self.run_cycle(coverage)
+        np.testing.assert_array_equal(result.times, np.arange(10))
+        self.assertEquals(self.processor.high_water_marks[('dataset', 'temp_qc')], 9)
+
+        # Only the new records are read and evaluated, with the preceding values as context
+        coverage.append(np.arange(10, 15), np.arange(10, 15))
+        result = self.run_cycle(coverage)
+        self.assertEquals(coverage.reads[-1], 5)
+        np.testing.assert_array_equal(result.times, np.arange(10, 15))
+        np.testing.assert_array_equal(coverage.data['temp_qc'], windowed_sum(np.arange(15), None))
+
+        # Nothing new, nothing written
+        self.assertIsNone(self.run_cycle(coverage))
+
+    def test_resume_from_coverage(self):
+        # Without a high-water mark evaluation starts at the first unevaluated record
+        coverage = MockCoverage(np.arange(10), np.arange(10))
+        coverage.data['temp_qc'][:6] = 1
+        result = self.run_cycle(coverage)
+        np.testing.assert_array_equal(result.times, np.arange(6, 10))
+        np.testing.assert_array_equal(result.qc, windowed_sum(np.arange(10), None)[6:])
+
+        self.processor.reset('dataset')
+        self.assertEquals(self.processor.high_water_marks, {})
+
+    def test_rescan(self):
+        coverage = MockCoverage(np.arange(10), np.arange(10))
+        self.processor.rescan_interval = 60
+        with patch('ion.processes.data.transforms.qc_post_processing.time') as time_mock:
+            time_mock.time.return_value = 1000
+            self.run_cycle(coverage)
+            # Records behind the high-water mark that were never evaluated
+            coverage.data['temp_qc'][4:6] = -88
+            self.assertIsNone(self.run_cycle(coverage))
+
+            # The periodic full scan evaluates them again
+            time_mock.time.return_value = 1061
+            result = self.run_cycle(coverage)
+            np.testing.assert_array_equal(result.times, np.arange(4, 10))
+            np.testing.assert_array_equal(coverage.data['temp_qc'], windowed_sum(np.arange(10), None))
+            self.assertIsNone(self.run_cycle(coverage))
+
+    def test_sweep(self):
+        data_products = [Mock(_id='data_product_%d' % i) for i in xrange(10)]
+        self.processor.container = Mock()
+        self.processor.container.resource_registry.find_resources.return_value = (data_products, None)
+        def get_reference_designator(data_product_id):
+            if data_product_id.endswith(('0', '5')):
+                return 'rd'
+            raise BadRequest("No instrument device associated with this data product")
+        self.processor.get_reference_designator = Mock(side_effect=get_reference_designator)
+        self.processor.get_parameters = Mock(return_value=[])
+
+        self.processor.qc_processing_loop()
+        self.processor.qc_processing_loop()
+        # Reference designators are resolved once across sweeps
+        self.assertEquals(self.processor.get_reference_designator.call_count, 10)
+        self.assertEquals(self.processor.get_parameters.call_count, 4)
+        self.assertEquals(self.processor.last_sweep['data_products'], 10)
+        self.assertEquals(self.processor.last_sweep['backlog'], 0)
+
+    def test_shared_dataset(self):
+        # Two data products of one dataset with overlapping QC parameters
+        self.processor.get_dataset = Mock(return_value='dataset')
+        self.processor.get_coverage = Mock(return_value=Mock(num_timesteps=Mock(return_value=10)))
+        self.processor.run_qc = Mock(return_value=None)
+        self.processor.write_results = Mock()
+        glblrng, spketst = Mock(), Mock()
+        glblrng.name, spketst.name = 'temp_glblrng_qc', 'temp_spketst_qc'
+        with patch('ion.processes.data.transforms.qc_post_processing.CoveragePool'):
+            self.processor.run_qc_parameters(Mock(), 'rd', [glblrng], {}, [])
+            self.processor.run_qc_parameters(Mock(), 'rd', [glblrng, spketst], {}, [])
+            self.processor.run_qc_parameters(Mock(), 'rd', [spketst], {}, [])
+        evaluated = [call[0][2] for call in self.processor.run_qc.call_args_list]
+        self.assertEquals(evaluated, [glblrng, spketst])
+
+    def test_shards(self):
+        data_product_ids = ['data_product_%d' % i for i in xrange(100)]
+        self.processor.shard_count = 3
+        shards = []
+        for shard_index in xrange(3):
+            self.processor.shard_index = shard_index
+            shards.append(set(filter(self.processor.in_shard, data_product_ids)))
+        self.assertEquals(set.union(*shards), set(data_product_ids))
+        self.assertEquals(sum(len(shard) for shard in shards), 100)
+
+
+@attr('UNIT', group='dm')
+class TestQCPostProcessing(PyonTestCase):
+    def setUp(self):
+        # A record every 10 seconds
+        self.times = np.arange(0, 10000, 10, dtype='float64') + 2208988800
+        qc = np.ones(1000, dtype='int8')
+        qc[[10, 550, 551]] = 0
+        self.coverage = MockCoverage(self.times, np.zeros(1000))
+        self.coverage.data['temp_glblrng_qc'] = qc
+        self.coverage.list_parameters = Mock(return_value=['time', 'temp', 'temp_glblrng_qc'])
+        self.coverage.num_timesteps = Mock(return_value=1000)
+        segments = []
+        get_parameter_values = self.coverage.get_parameter_values
+        def windowed(param_names, time_segment=None, **kwargs):
+            # Upper bound of the time segment, the mock only applies the lower bound
+            segments.append(time_segment)
+            data = get_parameter_values(param_names, time_segment, **kwargs).get_data()
+            mask = data['time'] <= time_segment[1]
+            return Mock(get_data=Mock(return_value={k : v[mask] for k,v in data.iteritems()}))
+        self.coverage.get_parameter_values = windowed
+        self.segments = segments
+
+        self.process = QCPostProcessing()
+        self.process.qc_params = []
+        self.process.window_records = 100
+        self.process.run_interval = 24
+        self.process._data_products = {}
+        self.process.resource_registry = Mock()
+        self.process.resource_registry.find_subjects.return_value = (['data_product'], None)
+
+        @contextmanager
+        def checkout(dataset_id, mode='r', kind='coverage'):
+            yield self.coverage
+        for target, value in [
+                ('ion.processes.data.transforms.qc_post_processing.CoveragePool.checkout', checkout),
+                ('ion.processes.data.transforms.qc_post_processing.EventPublisher', Mock()),
+                ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(TimeUtils, 'get_time_index', Mock(return_value=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(ReplayProcess, '_time_bounds', Mock(return_value=(self.times[0], self.times[-1])))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_windows(self):
+        self.process.process('dataset', start_time=1, end_time=20000)
+        # Windows of about window_records records
+        self.assertEquals(len(self.segments), 10)
+        for lower, upper in self.segments:
+            self.assertLessEqual(upper - lower, 1000)
+
+        # One event per QC field and hour of the span
+        publish = self.process.qc_publisher.publish_event
+        self.assertEquals(publish.call_count, 2)
+        events = [call[1] for call in publish.call_args_list]
+        self.assertEquals(events[0]['qc_parameter'], 'temp_glblrng_qc')
+        self.assertEquals(events[0]['temporal_values'], [self.times[10]])
+        self.assertEquals(events[1]['qc_parameter'], 'temp_glblrng_qc')
+        self.assertEquals(events[1]['temporal_values'], [self.times[550], self.times[551]])
+
+        # The data products of the dataset are looked up once
+        self.assertEquals(self.process.resource_registry.find_subjects.call_count, 1)
@@ -123,7 +123,6 @@ class TransformWorker(TransformStreamListener):
             function, argument_list, context = self.retrieve_function_and_define_args(stream_id, dp_id)
 
             args = []
-            rdt = RecordDictionaryTool.load_from_granule(msg)
 
             #create the input arguments list
             #todo: this logic is tied to the example function, generalize
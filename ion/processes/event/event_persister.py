@@ -3,6 +3,9 @@
 """Process that subscribes to ALL events and persists them efficiently in bulk into the events datastore"""
 
 import pprint
+import time
+import gevent
+from gevent.pool import Pool
 from gevent.queue import Queue
 from gevent.event import Event
 
@@ -12,6 +15,8 @@ from pyon.util.async import spawn
 from pyon.util.containers import named_any
 from pyon.public import log
 
+from ooi.timer import Accumulator
+
 PROCESS_PLUGINS = [("DeviceStateManager", "ion.processes.event.device_state.DeviceStateManager", {}),
                    ("NotificationSentScanner","ion.processes.event.notification_sent_scanner.NotificationSentScanner", {})]
 
@@ -24,23 +29,32 @@ class EventPersister(StandaloneProcess):
 
         self.persist_blacklist = self.CFG.get_safe("process.event_persister.persist_blacklist", {})
 
-        self._event_type_blacklist = [entry['event_type'] for entry in self.persist_blacklist if entry.get('event_type', None) and len(entry) == 1]
+        self._event_type_blacklist = set(entry['event_type'] for entry in self.persist_blacklist if entry.get('event_type', None) and len(entry) == 1)
         self._complex_blacklist = [entry for entry in self.persist_blacklist if not (entry.get('event_type', None) and len(entry) == 1)]
         if self._complex_blacklist:
             log.warn("EventPersister does not yet support complex blacklist expressions: %s", self._complex_blacklist)
 
+        # Blacklist decision per event type, over the type and its base types
+        self._blacklisted_types = {}
+
         # Time in between view refreshs
         self.refresh_interval = float(self.CFG.get_safe("process.event_persister.refresh_interval", 60.0))
 
+        # Largest bulk write, number of bulk writes in flight and attempts before a failing batch is split
+        self.max_batch_size = int(self.CFG.get_safe("process.event_persister.max_batch_size", 500))
+        self.max_inflight = int(self.CFG.get_safe("process.event_persister.max_inflight", 4))
+        self.retry_limit = int(self.CFG.get_safe("process.event_persister.retry_limit", 3))
+
         # Holds received events FIFO in syncronized queue
         self.event_queue = Queue()
 
-        # Temporarily holds list of events to persist while datastore operation are not yet completed
-        # This is where events to persist will remain if datastore operation fails occasionally.
-        self.events_to_persist = None
+        # Bulk writes in flight
+        self._write_pool = Pool(size=self.max_inflight)
 
-        # Number of unsuccessful attempts to persist in a row
-        self.failure_count = 0
+        # Queue depth, batch size, write latency and throughput
+        self.time_stats = Accumulator(format='%3f')
+        self.persisted_count = 0
+        self.discarded_count = 0
 
         # bookkeeping for greenlet
         self._persist_greenlet = None
@@ -89,19 +103,20 @@ class EventPersister(StandaloneProcess):
         # wait on the greenlets to finish cleanly
         self._persist_greenlet.join(timeout=5)
         self._refresh_greenlet.join(timeout=5)
+        self._write_pool.join(timeout=5)
 
     def _on_event(self, event, *args, **kwargs):
         self.event_queue.put(event)
 
     def _in_blacklist(self, event):
-        if event.type_ in self._event_type_blacklist:
-            return True
-        if event.base_types:
-            for base_type in event.base_types:
-                if base_type in self._event_type_blacklist:
-                    return True
+        try:
+            return self._blacklisted_types[event.type_]
+        except KeyError:
+            types = [event.type_] + list(event.base_types or [])
+            blacklisted = not self._event_type_blacklist.isdisjoint(types)
             # TODO: Complex event blacklist
-        return False
+            self._blacklisted_types[event.type_] = blacklisted
+            return blacklisted
 
     def _persister_loop(self, persist_interval):
         log.debug('Starting event persister thread with persist_interval=%s', persist_interval)
@@ -109,49 +124,77 @@ class EventPersister(StandaloneProcess):
         # Event.wait returns False on timeout (and True when set in on_quit), so we use this to both exit cleanly and do our timeout in a loop
         while not self._terminate_persist.wait(timeout=persist_interval):
             try:
-                # leftover events_to_persist indicate previous attempt did not succeed
-                if self.events_to_persist and self.failure_count > 2:
-                    bad_events = []
-                    log.warn("Attempting to persist %s events individually" % (len(self.events_to_persist)))
-                    for event in self.events_to_persist:
-                        try:
-                            self.container.event_repository.put_event(event)
-                        except Exception:
-                            bad_events.append(event)
-
-                    if len(self.events_to_persist) != len(bad_events):
-                        log.warn("Succeeded to persist some of the events - rest must be bad")
-                        self._log_events(bad_events)
-                    elif bad_events:
-                        log.error("Discarding %s events after %s attempts!!" % (len(bad_events), self.failure_count))
-                        self._log_events(bad_events)
-
-                    self.events_to_persist = None
-                    self.failure_count = 0
-
-                elif self.events_to_persist:
-                    # There was an error last time and we need to retry
-                    log.info("Retry persisting %s events" % len(self.events_to_persist))
-                    self._persist_events(self.events_to_persist)
-                    self.events_to_persist = None
-
-                # process ALL events (not retried on fail like peristing is)
-                events_to_process = [self.event_queue.get() for x in xrange(self.event_queue.qsize())]
-                # only persist events not in blacklist
-                self.events_to_persist = [x for x in events_to_process if not self._in_blacklist(x)]
-
-                try:
-                    self._persist_events(self.events_to_persist)
-                finally:
-                    self._process_events(events_to_process)
-                self.events_to_persist = None
-                self.failure_count = 0
+                self._persist_cycle()
             except Exception as ex:
+                log.exception("Failed to process received events")
+
+    def _persist_cycle(self):
+        """
+        Drains the queue and hands the events to the write pool in batches of at
+        most max_batch_size. Spawning blocks while max_inflight writes are
+        outstanding, which applies backpressure on the next cycle.
+        """
+        queue_depth = self.event_queue.qsize()
+        self.time_stats.add_value('event_persister.queue_depth', queue_depth)
+
+        # process ALL events (not retried on fail like peristing is)
+        events_to_process = [self.event_queue.get() for x in xrange(queue_depth)]
+        # only persist events not in blacklist
+        events_to_persist = [x for x in events_to_process if not self._in_blacklist(x)]
+
+        try:
+            for i in xrange(0, len(events_to_persist), self.max_batch_size):
+                self._write_pool.spawn(self._persist_batch, events_to_persist[i:i + self.max_batch_size])
+        finally:
+            self._process_events(events_to_process)
+
+    def _persist_batch(self, events):
+        """
+        Persists a batch of events, retrying retry_limit times with backoff
+        before the batch is split to isolate the events that can't be persisted.
+        """
+        start = time.time()
+        discarded = 0
+        for attempt in xrange(self.retry_limit):
+            try:
+                self._persist_events(events)
+                break
+            except Exception:
                 # Note: Persisting events may fail occasionally during test runs (when the "events" datastore is force
-                # deleted and recreated). We'll log and keep retrying forever.
-                log.exception("Failed to persist %s received events. Will retry next cycle" % len(self.events_to_persist))
-                self.failure_count += 1
-                self._log_events(self.events_to_persist)
+                # deleted and recreated).
+                log.exception("Failed to persist %s events (attempt %s)", len(events), attempt + 1)
+                if attempt + 1 < self.retry_limit:
+                    gevent.sleep(min(self.persist_interval * 2 ** attempt, 30))
+        else:
+            log.warn("Splitting %s events to isolate the bad ones", len(events))
+            discarded = self._persist_split(events)
+
+        elapsed = time.time() - start
+        self.persisted_count += len(events) - discarded
+        self.discarded_count += discarded
+        self.time_stats.add_value('event_persister.batch.size', len(events))
+        self.time_stats.add_value('event_persister.batch.latency', elapsed)
+        if elapsed > 0:
+            self.time_stats.add_value('event_persister.batch.throughput', len(events) / elapsed)
+
+    def _persist_split(self, events):
+        """
+        Binary split retry for events that failed to persist together: persists
+        each half in one write and splits the halves that fail further, down to
+        single events which are discarded. Returns the number of discarded events.
+        """
+        if len(events) == 1:
+            log.error("Discarding event after %s attempts!!", self.retry_limit)
+            self._log_events(events)
+            return 1
+        discarded = 0
+        middle = len(events) / 2
+        for half in (events[:middle], events[middle:]):
+            try:
+                self._persist_events(half)
+            except Exception:
+                discarded += self._persist_split(half)
+        return discarded
 
     def _persist_events(self, event_list):
         if event_list:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+'''
+@file ion/processes/event/test/test_event_persister.py
+@description Unit tests for the pipelined EventPersister
+'''
+
+from mock import Mock
+from nose.plugins.attrib import attr
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+from pyon.util.unit_test import IonUnitTestCase
+from ion.processes.event.event_persister import EventPersister
+
+from ooi.timer import Accumulator
+
+
+class MockEvent(object):
+    def __init__(self, type_, base_types=None, bad=False):
+        self.type_ = type_
+        self.base_types = base_types or []
+        self.bad = bad
+
+
+@attr('UNIT', group='event')
+class TestEventPersister(IonUnitTestCase):
+
+    def setUp(self):
+        self.persister = EventPersister()
+        self.persister.persist_interval = 0
+        self.persister.max_batch_size = 4
+        self.persister.retry_limit = 2
+        self.persister._event_type_blacklist = set(['DeviceStatusEvent'])
+        self.persister._blacklisted_types = {}
+        self.persister.event_queue = Queue()
+        self.persister._write_pool = Pool(size=2)
+        self.persister.time_stats = Accumulator(format='%3f')
+        self.persister.persisted_count = 0
+        self.persister.discarded_count = 0
+        self.persister.process_plugins = {}
+
+        self.writes = []
+        def put_events(events):
+            self.writes.append(len(events))
+            if any(event.bad for event in events):
+                raise Exception('bad event')
+        self.persister.container = Mock()
+        self.persister.container.event_repository.put_events.side_effect = put_events
+
+    def test_blacklist_over_base_types(self):
+        self.assertTrue(self.persister._in_blacklist(MockEvent('DeviceStatusEvent')))
+        self.assertTrue(self.persister._in_blacklist(MockEvent('DeviceAggregateStatusEvent', ['DeviceStatusEvent', 'Event'])))
+        self.assertFalse(self.persister._in_blacklist(MockEvent('ResourceEvent', ['Event'])))
+        self.assertEqual(len(self.persister._blacklisted_types), 3)
+
+    def test_bounded_batches(self):
+        for i in xrange(10):
+            self.persister._on_event(MockEvent('ResourceEvent'))
+        self.persister._on_event(MockEvent('DeviceStatusEvent'))
+        self.persister._persist_cycle()
+        self.persister._write_pool.join()
+
+        self.assertEqual(sorted(self.writes), [2, 4, 4])
+        self.assertEqual(self.persister.persisted_count, 10)
+
+    def test_split_isolates_bad_events(self):
+        events = [MockEvent('ResourceEvent') for i in xrange(8)]
+        events[5].bad = True
+        self.persister._persist_batch(events)
+
+        self.assertEqual(self.persister.persisted_count, 7)
+        self.assertEqual(self.persister.discarded_count, 1)
+        # Two full attempts, then halves down to the bad event
+        self.assertEqual(self.writes, [8, 8, 4, 4, 2, 1, 1, 2])
@@ -23,6 +23,8 @@ except ImportError as ie:
 from pyon.public import log, iex, StandaloneProcess, RT
 
 from ooi.timer import Timer,Accumulator
+from ion.services.dm.utility.granule.record_dictionary import StreamDefinitionCache
+from ion.services.dm.utility.coverage_pool import CoveragePool
 
 stats = Accumulator(persist=True)
 
@@ -109,4 +111,8 @@ class ContainerProfiler(StandaloneProcess):
             proc_cpu = proc.get_cpu_percent(),
             proc_mem = proc.get_memory_info(),
         )
+        for k, v in StreamDefinitionCache.stats().iteritems():
+            profile['sdef_cache_%s' % k] = v
+        for k, v in CoveragePool.stats().iteritems():
+            profile['coverage_pool_%s' % k] = v
         return profile
@@ -10,20 +10,38 @@ from interface.services.cei.ischeduler_service import BaseSchedulerService
 from interface.objects import IntervalTimer, TimeOfDayTimer
 
 from datetime import datetime, timedelta
+from gevent.event import Event
 from math import ceil
+import itertools
 import time
+import heapq
 import gevent
 import calendar
 
 
 class SchedulerService(BaseSchedulerService):
+    """
+    Timers are kept in a single priority queue of (expire time, sequence, timer id, index) entries served by one
+    timer loop greenlet. All timers due in the same tick are published in one pass of the loop. Entries of
+    cancelled or rescheduled timers stay in the queue and are skipped when they come up.
+    """
     schedule_entries = {}
     _no_reschedule = False
+    _timer_loop = None
+
+    def on_init(self):
+        # Timers due within this many seconds of each other fire in the same pass of the timer loop
+        self.tick = CFG.get_safe("service.scheduler.tick", 0.01)
+        self._timer_heap = []
+        self._timer_seq = itertools.count()
+        self._timer_wakeup = Event()
+        self._timer_loop_running = False
 
     def on_start(self):
         if CFG.get_safe("process.start_mode") == "RESTART" or CFG.get_safe("bootmode") == "restart":
             self.on_system_restart()
         self.pub = EventPublisher(event_type="TimerEvent")
+        self._start_timer_loop()
 
     def on_quit(self):
         self.pub.close()
@@ -31,8 +49,55 @@ class SchedulerService(BaseSchedulerService):
         # throw killswitch on future reschedules
         self._no_reschedule = True
 
-        # terminate any pending spawns
+        # terminate any pending timers and the loop
         self._stop_pending_timers()
+        self._stop_timer_loop()
+
+    def _start_timer_loop(self):
+        self._timer_loop_running = True
+        self._timer_loop = gevent.spawn(self._run_timer_loop)
+
+    def _stop_timer_loop(self):
+        self._timer_loop_running = False
+        self._timer_wakeup.set()
+        if self._timer_loop is not None:
+            # let a pass in progress finish publishing
+            self._timer_loop.join(timeout=10)
+            self._timer_loop.kill()
+            self._timer_loop = None
+
+    def _run_timer_loop(self):
+        while self._timer_loop_running:
+            self._timer_wakeup.clear()
+            due_timers = []
+            deadline = time.time() + self.tick
+            while self._timer_heap and self._timer_heap[0][0] <= deadline:
+                due_timers.append(heapq.heappop(self._timer_heap))
+            if due_timers:
+                self._fire_timers(due_timers)
+                continue
+
+            timeout = max(self._timer_heap[0][0] - time.time(), 0) if self._timer_heap else None
+            self._timer_wakeup.wait(timeout)
+
+    def _fire_timers(self, due_timers):
+        for expire_at, _, id_, index in due_timers:
+            entry = self.schedule_entries.get(id_, None)
+            if entry is None or entry["expire_at"][index] != expire_at:
+                # cancelled or rescheduled since this entry was queued
+                continue
+            try:
+                self._expire_callback(id_, index, expire_at)
+            except Exception:
+                log.exception("SchedulerService:_fire_timers: error firing timer %s index %s", id_, index)
+
+    def _push_timer(self, id_, index, expire_at):
+        self.schedule_entries[id_]["expire_at"][index] = expire_at
+        seq = next(self._timer_seq)
+        heapq.heappush(self._timer_heap, (expire_at, seq, id_, index))
+        if self._timer_heap[0][1] == seq:
+            # new earliest timer, wake the loop up to wait for it instead
+            self._timer_wakeup.set()
 
     def _notify(self, task, id_, index):
         log.debug("SchedulerService:_notify: - " + task.event_origin + " - Time: " + str(self._now()) + " - id_: " + id_ + " -Index:" + str(index))
@@ -44,10 +109,10 @@ class SchedulerService(BaseSchedulerService):
     def _convert_to_posix_time(self, t):
         return calendar.timegm(t.timetuple())
 
-    def _expire_callback(self, id_, index):
+    def _expire_callback(self, id_, index, expire_at=None):
         task = self._get_entry(id_)
         self._notify(task, id_, index)
-        if not self._reschedule(id_, index):
+        if not self._reschedule(id_, index, expire_at):
             self._delete(id_, index)
 
     def _calculate_next_interval(self, task, current_time):
@@ -114,7 +179,6 @@ class SchedulerService(BaseSchedulerService):
 
     def _schedule(self, scheduler_entry, id_=False):
         # if "id_" is set, it means scheduler_entry is already in Resource Registry. This can occur during a system restart
-        spawns = []
         task = scheduler_entry.entry
         expire_times = self._get_expire_time(task)
         if not self._validate_expire_times(expire_times):
@@ -123,15 +187,14 @@ class SchedulerService(BaseSchedulerService):
 
         if not id_:
             id_, _ = self.clients.resource_registry.create(scheduler_entry)
-        self._create_entry(task, spawns, id_)
+        self._create_entry(task, [None] * len(expire_times), id_)
+        now = time.time()
         for index, expire_time in enumerate(expire_times):
-            log.debug("SchedulerService:_schedule: scheduling: - " + task.event_origin + " - Now: " + str(self._now()) +
-                      " - Expire: " + str(expire_time) + " - ID: " + id_ + " - Index:" + str(index))
-            spawn = gevent.spawn_later(expire_time, self._expire_callback, id_, index)
-            spawns.append(spawn)
+            log.debug("SchedulerService:_schedule: scheduling: - %s - Expire: %s - ID: %s - Index: %s", task.event_origin, expire_time, id_, index)
+            self._push_timer(id_, index, now + expire_time)
         return id_
 
-    def _reschedule(self, id_, index):
+    def _reschedule(self, id_, index, expire_at=None):
         if self._no_reschedule:
             log.debug("SchedulerService:_reschedule: process quitting, refusing to reschedule %s", id_)
             return False
@@ -139,10 +202,14 @@ class SchedulerService(BaseSchedulerService):
         task = self._get_entry(id_)
         expire_time = self._get_reschedule_expire_time(task, index)
         if expire_time:
-            log.debug("SchedulerService:_reschedule: rescheduling: - " + task.event_origin + " - Now: " + str(self._now()) +
-                      " - Expire: " + str(expire_time) + " - ID: " + id_ + " -Index:" + str(index))
-            spawn = gevent.spawn_later(expire_time, self._expire_callback, id_, index)
-            self._update_entry(id_=id_, index=index, spawn=spawn)
+            log.debug("SchedulerService:_reschedule: rescheduling: - %s - Expire: %s - ID: %s - Index: %s", task.event_origin, expire_time, id_, index)
+            # Interval timers count from their previous expire time so late firings don't accumulate drift,
+            # unless the next expire time has passed already
+            now = time.time()
+            if type(task) == IntervalTimer and expire_at is not None and expire_at + expire_time > now:
+                self._push_timer(id_, index, expire_at + expire_time)
+            else:
+                self._push_timer(id_, index, now + expire_time)
 
             return True
         else:
@@ -150,21 +217,16 @@ class SchedulerService(BaseSchedulerService):
                       " - Expire: " + str(expire_time) + " - ID: " + id_ + " -Index:" + str(index))
         return False
 
-    def _create_entry(self, task, spawns, id_):
-        self.schedule_entries[id_] = {"task": task, "spawns": spawns}
+    def _create_entry(self, task, expire_at, id_):
+        self.schedule_entries[id_] = {"task": task, "expire_at": expire_at}
 
-    def _update_entry(self, id_, index, spawn=None, interval=None):
-        if spawn is not None:
-            self.schedule_entries[id_]["spawns"][index] = spawn
+    def _update_entry(self, id_, index, interval=None):
         if interval is not None:
             self.schedule_entries[id_]["task"].interval = interval
 
     def _get_entry_all(self, id_):
         return self.schedule_entries[id_]
 
-    def _get_spawns(self, id_):
-        return self.schedule_entries[id_]["spawns"]
-
     def _get_entry(self, id_):
         return self.schedule_entries[id_]["task"]
 
@@ -224,28 +286,15 @@ class SchedulerService(BaseSchedulerService):
         """
         Safely stops all pending and active timers.
 
-        For all timers still waiting to run, calls kill on them. For active timers, let
-        them exit naturally and prevent the reschedule by setting the _no_reschedule flag.
+        Drops all queued timers. A pass of the timer loop in progress skips the remaining
+        timers and the reschedule is prevented by setting the _no_reschedule flag.
         """
         # prevent reschedules
         self._no_reschedule = True
 
-        gls = []
-        for timer_id in self.schedule_entries:
-            spawns = self._get_spawns(timer_id)
-
-            for spawn in spawns:
-                gls.append(spawn)
-                # only kill spawns that haven't started yet
-                if spawn._start_event is not None:
-                    spawn.kill()
-
-            log.debug("_stop_pending_timers: timer %s deleted", timer_id)
-
+        log.debug("_stop_pending_timers: %s timers deleted", len(self.schedule_entries))
         self.schedule_entries.clear()
-
-        # wait for running gls to finish up
-        gevent.joinall(gls, timeout=10)
+        del self._timer_heap[:]
 
         # allow reschedules from here on out
         self._no_reschedule = False
@@ -297,9 +346,8 @@ class SchedulerService(BaseSchedulerService):
         """
         #try:
         try:
-            spawns = self._get_spawns(timer_id)
-            for spawn in spawns:
-                spawn.kill()
+            # queued entries of the timer are skipped once it's deleted
+            self._get_entry_all(timer_id)
             log.debug("SchedulerService: cancel_timer: id_: " + str(timer_id))
             self._delete(id_=timer_id, index=None, force=True)
         except:
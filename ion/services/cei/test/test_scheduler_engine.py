@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+@file ion/services/cei/test/test_scheduler_engine.py
+@brief Unit tests and benchmark for the scheduler timer loop
+'''
+
+from pyon.public import IonObject, RT, OT
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.services.cei.scheduler_service import SchedulerService
+
+from mock import Mock
+from nose.plugins.attrib import attr
+
+import itertools
+import gevent
+import gc
+import os
+import time
+
+
+def interval_entry(origin, interval=1):
+    timer = IonObject(OT.IntervalTimer, start_time=time.time() - 10, interval=interval, end_time=-1, event_origin=origin)
+    return IonObject(RT.SchedulerEntry, entry=timer)
+
+
+@attr('UNIT', group='cei')
+class TestSchedulerTimerLoop(PyonTestCase):
+    def setUp(self):
+        self.scheduler = SchedulerService()
+        self.scheduler.on_init()
+        # Keep the entries of this test off the class-level dict
+        self.scheduler.schedule_entries = {}
+        self.scheduler.clients = Mock()
+        timer_ids = itertools.count()
+        self.scheduler.clients.resource_registry.create.side_effect = lambda se: ('timer_%d' % next(timer_ids), None)
+        self.scheduler.pub = Mock()
+        self.scheduler._start_timer_loop()
+        self.addCleanup(self.scheduler._stop_timer_loop)
+
+    def published_origins(self):
+        return [call[1]['origin'] for call in self.scheduler.pub.publish_event.call_args_list]
+
+    def test_timers_share_one_loop(self):
+        greenlets = len([o for o in gc.get_objects() if isinstance(o, gevent.Greenlet)])
+        for i in xrange(200):
+            self.scheduler.create_timer(interval_entry('origin_%d' % i))
+        self.assertLessEqual(len([o for o in gc.get_objects() if isinstance(o, gevent.Greenlet)]), greenlets)
+
+        gevent.sleep(2.2)
+        origins = self.published_origins()
+        # Each timer fires within its first interval and once per interval after that
+        self.assertEquals(set(origins), set('origin_%d' % i for i in xrange(200)))
+        self.assertGreaterEqual(len(origins), 400)
+        self.assertLessEqual(len(origins), 600)
+        # One queued entry per live timer
+        self.assertEquals(len(self.scheduler._timer_heap), 200)
+
+    def test_cancel(self):
+        timer_ids = [self.scheduler.create_timer(interval_entry('origin_%d' % i)) for i in xrange(10)]
+        for timer_id in timer_ids[:5]:
+            self.scheduler.cancel_timer(timer_id)
+        self.assertEquals(self.scheduler.clients.resource_registry.delete.call_count, 5)
+
+        gevent.sleep(1.2)
+        self.assertEquals(set(self.published_origins()), set('origin_%d' % i for i in xrange(5, 10)))
+
+    def test_stop_pending_timers(self):
+        for i in xrange(10):
+            self.scheduler.create_timer(interval_entry('origin_%d' % i))
+        self.scheduler._stop_pending_timers()
+        self.assertEquals(self.scheduler._timer_heap, [])
+
+        gevent.sleep(1.2)
+        self.assertEquals(self.scheduler.pub.publish_event.call_count, 0)
+
+
+def resident_memory():
+    '''
+    Resident set size of this process in bytes (Linux)
+    '''
+    gc.collect()
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@attr('BENCHMARK', group='cei')
+class SchedulerBenchmark(PyonTestCase):
+    '''
+    Compares memory and firing jitter of the timer loop against one spawn_later greenlet per timer
+    '''
+    spread = 2.0
+
+    def due_times(self, count):
+        start = time.time() + 3
+        return [start + self.spread * i / count for i in xrange(count)]
+
+    def wait_for(self, fired, count):
+        deadline = time.time() + 60
+        while len(fired) < count and time.time() < deadline:
+            gevent.sleep(0.1)
+
+    def run_timer_loop(self, count):
+        scheduler = SchedulerService()
+        scheduler.on_init()
+        scheduler.schedule_entries = {}
+        fired = []
+        scheduler._expire_callback = lambda id_, index, expire_at: fired.append(time.time() - expire_at)
+
+        baseline = resident_memory()
+        for i, due in enumerate(self.due_times(count)):
+            scheduler._create_entry(None, [None], i)
+            scheduler._push_timer(i, 0, due)
+        memory = resident_memory() - baseline
+
+        scheduler._start_timer_loop()
+        self.wait_for(fired, count)
+        scheduler._stop_timer_loop()
+        return memory, fired
+
+    def run_spawns(self, count):
+        fired = []
+        def expire(due):
+            fired.append(time.time() - due)
+
+        baseline = resident_memory()
+        now = time.time()
+        spawns = [gevent.spawn_later(due - now, expire, due) for due in self.due_times(count)]
+        memory = resident_memory() - baseline
+
+        self.wait_for(fired, count)
+        del spawns
+        return memory, fired
+
+    def test_memory_and_jitter(self):
+        for count in (10000, 100000):
+            for name, run in (('timer loop', self.run_timer_loop), ('spawn_later', self.run_spawns)):
+                memory, fired = run(count)
+                self.assertEquals(len(fired), count)
+                fired.sort()
+                log.info('%6d timers, %-11s: %7.1f MB, jitter mean %.1fms p99 %.1fms max %.1fms', count, name,
+                         memory / 1e6, 1e3 * sum(fired) / count, 1e3 * fired[int(count * 0.99)], 1e3 * fired[-1])
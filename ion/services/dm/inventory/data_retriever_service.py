@@ -6,8 +6,8 @@
 
 from ion.core.function.transform_function import TransformFunction
 from ion.processes.data.replay.replay_process import ReplayProcess
-from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.coverage_pool import CoveragePool
 
 from pyon.core.exception import BadRequest 
 from pyon.container.cc import Container
@@ -21,29 +21,17 @@ from interface.objects import Replay, CoverageTypeEnum
 from interface.services.dm.idata_retriever_service import BaseDataRetrieverService
 from coverage_model import SimplexCoverage
 
-import collections
-import time
-import gevent
 
 class DataRetrieverService(BaseDataRetrieverService):
     REPLAY_PROCESS = 'replay_process'
 
-    _refresh_interval = 10
-    _cache_limit      = 5
-    _retrieve_cache   = collections.OrderedDict()
-    _cache_lock       = gevent.coros.RLock()
-
     def on_start(self):
         self.event_subscriber = EventSubscriber(event_type='DatasetModified', callback=lambda event,m : self._eject_cache(event.origin), auto_delete=True)
         self.add_endpoint(self.event_subscriber)
 
     @classmethod
     def _eject_cache(cls, dataset_id):
-        with cls._cache_lock:
-            try:
-                cls._retrieve_cache.pop(dataset_id)
-            except KeyError:
-                pass
+        CoveragePool.invalidate(dataset_id, modes=('r',))
     
     def define_replay(self, dataset_id='', query=None, delivery_format='', stream_id=''):
         ''' Define the stream that will contain the data from data store by streaming to an exchange name.
@@ -123,23 +111,10 @@ class DataRetrieverService(BaseDataRetrieverService):
     @classmethod
     def _get_coverage(cls,dataset_id):
         '''
-        Memoized coverage instantiation and management
+        Acquires a read-only coverage from the container's pool, the caller
+        releases it with CoveragePool.release
         '''
-        # Cached get
-        retval = None
-        with cls._cache_lock:
-            try:
-                retval, age = cls._retrieve_cache.pop(dataset_id)
-                if (time.time() - age) > cls._refresh_interval:
-                    raise KeyError(dataset_id)
-            except KeyError: # Cache miss
-                #@TODO: Add in LRU logic (maybe some mem checking too!)
-                if len(cls._retrieve_cache) > cls._cache_limit:
-                    cls._retrieve_cache.popitem(0)
-                retval = DatasetManagementService._get_nonview_coverage(dataset_id, mode='r') 
-            age = time.time()
-            cls._retrieve_cache[dataset_id] = (retval, age)
-        return retval
+        return CoveragePool.acquire(dataset_id, mode='r', kind='nonview')
 
     @classmethod
     def retrieve_oob(cls, dataset_id='', query=None, delivery_format=''):
@@ -170,8 +145,41 @@ class DataRetrieverService(BaseDataRetrieverService):
                 log.error("Data Product %s (%s) had issues reading from the coverage model\nretrieve_oob(dataset_id='%s', query=%s, delivery_format=%s)", data_product.name, data_product._id, dataset_id, query, delivery_format)
             log.error("Problems reading from the coverage", exc_info=True)
             raise BadRequest('Problems reading from the coverage')
+        finally:
+            CoveragePool.release(coverage)
         return rdt.to_granule()
 
+    @classmethod
+    def retrieve_oob_chunks(cls, dataset_id='', query=None, delivery_format='', max_bytes=None):
+        '''
+        Generator form of retrieve_oob, yields the result as a sequence of
+        granules so that no more than max_bytes (query.max_bytes) of the
+        coverage is held in memory at once.
+        '''
+        query = query or {}
+        coverage = cls._get_coverage(dataset_id)
+        if coverage is None:
+            raise BadRequest('no such coverage')
+        try:
+            if isinstance(coverage, SimplexCoverage) and coverage.is_empty():
+                log.info('Reading from an empty coverage')
+                return
+            args = {
+                'start_time'     : query.get('start_time', None),
+                'end_time'       : query.get('end_time', None),
+                'stride_time'    : query.get('stride_time', None),
+                'parameters'     : query.get('parameters', None),
+                'stream_def_id'  : delivery_format,
+                'tdoa'           : query.get('tdoa', None),
+                'sort_parameter' : query.get('sort_parameter', None),
+                'max_bytes'      : max_bytes or query.get('max_bytes', None),
+                'dataset_id'     : dataset_id
+            }
+            for rdt in ReplayProcess._cov2granules(coverage=coverage, **args):
+                yield rdt.to_granule()
+        finally:
+            CoveragePool.release(coverage)
+
   
     def retrieve(self, dataset_id='', query=None, delivery_format='', module='', cls='', kwargs=None):
         '''
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/coverage_pool.py
+@description Container-wide pool of open coverage handles
+'''
+
+from pyon.public import CFG
+from pyon.util.log import log
+
+from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+
+from contextlib import contextmanager
+from gevent.coros import RLock
+from gevent.event import Event
+
+import collections
+import time
+
+class PooledCoverage(object):
+    '''
+    An open coverage handle and its bookkeeping
+    '''
+    __slots__ = ('key', 'coverage', 'refs', 'opened', 'last_used', 'stale')
+
+    def __init__(self, key, coverage):
+        self.key       = key
+        self.coverage  = coverage
+        self.refs      = 0
+        self.opened    = time.time()
+        self.last_used = self.opened
+        self.stale     = False
+
+
+class CoveragePool(object):
+    '''
+    Container-wide pool of open coverage handles shared by ingestion,
+    retrieval, the DAP handler and QC. Handles are keyed by dataset, mode and
+    the kind of coverage loaded (as is, simplex or non-view) and reference
+    counted; a handle is only closed once nobody holds it.
+
+    Idle handles are closed when the pool grows past SIZE or after
+    IDLE_TIMEOUT seconds. Handles that aren't opened for appending don't see
+    data appended by other handles, so they are reopened once they are
+    READ_REFRESH seconds old.
+    '''
+    SIZE         = CFG.get_safe('container.coverage_pool.size', 10)
+    IDLE_TIMEOUT = CFG.get_safe('container.coverage_pool.idle_timeout', 60)
+    READ_REFRESH = CFG.get_safe('container.coverage_pool.read_refresh', 10)
+
+    loaders = {
+        'coverage' : '_get_coverage',
+        'simplex'  : '_get_simplex_coverage',
+        'nonview'  : '_get_nonview_coverage',
+    }
+
+    _entries  = collections.OrderedDict() # key -> entry, least recently used first
+    _handles  = {} # id(coverage) -> entry
+    _loading  = {} # key -> event set once the handle being opened for it is pooled
+    _lock     = RLock()
+    hits      = 0
+    misses    = 0
+    evictions = 0
+
+    @classmethod
+    def acquire(cls, dataset_id, mode='r', kind='coverage'):
+        '''
+        Returns an open coverage for the dataset, the caller must release it
+        '''
+        key = (dataset_id, mode, kind)
+        while True:
+            with cls._lock:
+                cls.reap()
+                entry = cls._entries.get(key)
+                if entry is not None and not entry.refs and cls._expired(entry):
+                    cls._close(entry)
+                    entry = None
+                if entry is not None:
+                    cls.hits += 1
+                    return cls._checkout(entry)
+                loading = cls._loading.get(key)
+                if loading is None:
+                    cls.misses += 1
+                    loading = cls._loading[key] = Event()
+                    break
+            # Somebody else is opening the same handle
+            loading.wait()
+
+        # Coverages are opened outside the lock so they don't hold up every other dataset
+        coverage = None
+        try:
+            coverage = getattr(DatasetManagementService, cls.loaders[kind])(dataset_id, mode=mode)
+        finally:
+            with cls._lock:
+                del cls._loading[key]
+                if coverage is not None:
+                    entry = PooledCoverage(key, coverage)
+                    cls._handles[id(coverage)] = entry
+                    cls._checkout(entry)
+            loading.set()
+        return coverage
+
+    @classmethod
+    def release(cls, coverage):
+        '''
+        Returns a coverage to the pool
+        '''
+        if coverage is None:
+            return
+        with cls._lock:
+            entry = cls._handles.get(id(coverage))
+            if entry is None:
+                # Not pooled, or evicted while in use
+                cls._close_coverage(coverage)
+                return
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_used = time.time()
+            if not entry.refs and entry.stale:
+                cls._close(entry)
+            cls.reap()
+
+    @classmethod
+    def retain(cls, coverage):
+        '''
+        Takes another reference to a coverage acquired from the pool, it is
+        returned with release like any other
+        '''
+        with cls._lock:
+            entry = cls._handles.get(id(coverage))
+            if entry is not None:
+                entry.refs += 1
+
+    @classmethod
+    @contextmanager
+    def checkout(cls, dataset_id, mode='r', kind='coverage'):
+        coverage = cls.acquire(dataset_id, mode, kind)
+        try:
+            yield coverage
+        finally:
+            cls.release(coverage)
+
+    @classmethod
+    def discard(cls, coverage):
+        '''
+        Drops a coverage that is suspected to be broken, it is closed once the
+        last holder releases it
+        '''
+        with cls._lock:
+            entry = cls._handles.get(id(coverage))
+            if entry is None:
+                return
+            if cls._entries.get(entry.key) is entry:
+                cls._entries.pop(entry.key)
+            entry.stale = True
+            if not entry.refs:
+                cls._close(entry)
+
+    @classmethod
+    def invalidate(cls, dataset_id=None, modes=None):
+        '''
+        Discards the handles of the dataset (every dataset if no id is given),
+        optionally only those opened in one of modes
+        '''
+        with cls._lock:
+            for entry in cls._entries.values():
+                key_dataset_id, mode, kind = entry.key
+                if dataset_id is not None and key_dataset_id != dataset_id:
+                    continue
+                if modes is not None and mode not in modes:
+                    continue
+                cls.discard(entry.coverage)
+
+    @classmethod
+    def reap(cls):
+        '''
+        Closes the idle handles that timed out, and the least recently used
+        idle handles while the pool is over SIZE
+        '''
+        with cls._lock:
+            now = time.time()
+            for entry in cls._entries.values():
+                if not entry.refs and (now - entry.last_used) > cls.IDLE_TIMEOUT:
+                    cls._evict(entry)
+            for entry in cls._entries.values():
+                if len(cls._entries) <= cls.SIZE:
+                    break
+                if not entry.refs:
+                    cls._evict(entry)
+
+    @classmethod
+    def stats(cls):
+        in_use = sum(1 for entry in cls._handles.itervalues() if entry.refs)
+        return {'hits':cls.hits, 'misses':cls.misses, 'evictions':cls.evictions, 'size':len(cls._handles), 'in_use':in_use}
+
+    @classmethod
+    def _checkout(cls, entry):
+        entry.refs += 1
+        entry.last_used = time.time()
+        cls._entries.pop(entry.key, None)
+        cls._entries[entry.key] = entry
+        return entry.coverage
+
+    @classmethod
+    def _expired(cls, entry):
+        return entry.key[1] != 'a' and (time.time() - entry.opened) > cls.READ_REFRESH
+
+    @classmethod
+    def _evict(cls, entry):
+        cls.evictions += 1
+        cls._close(entry)
+
+    @classmethod
+    def _close(cls, entry):
+        if cls._entries.get(entry.key) is entry:
+            cls._entries.pop(entry.key)
+        cls._handles.pop(id(entry.coverage), None)
+        cls._close_coverage(entry.coverage)
+
+    @classmethod
+    def _close_coverage(cls, coverage):
+        try:
+            coverage.close(timeout=5)
+        except:
+            log.exception('Problems closing the coverage')
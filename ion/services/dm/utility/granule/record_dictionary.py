@@ -10,6 +10,8 @@
 
 from pyon.container.cc import Container
 from pyon.core.exception import BadRequest, NotFound
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT, RT
 from pyon.core.object import IonObjectSerializer
 from pyon.core.interceptor.encode import encode_ion
 from pyon.util.arg_check import validate_equal
@@ -29,9 +31,114 @@ from coverage_model import PythonFunction, NumexprFunction
 
 import numpy as np
 import numexpr as ne
-from copy import copy
 import msgpack
 import time
+import collections
+
+class RecordDictionaryLayout(object):
+    """
+    The precomputed, immutable layout of a parameter dictionary that every record dictionary built from the same
+    parameter dictionary (and available fields) shares: the sorted ordinal index used to encode granules, the fields
+    exposed to the stream definition and the temporal parameter. Layouts are cached so a record dictionary never
+    re-sorts or re-intersects the parameter names.
+    """
+    __slots__ = ('params', 'ordinals', 'fields', 'field_set', 'available', 'temporal_parameter')
+
+    CACHE_LIMIT = 256
+    _cache = {}
+
+    def __init__(self, keys, temporal_parameter=None, available_fields=None):
+        self.params             = tuple(sorted(keys))
+        self.ordinals           = dict((k,i) for i,k in enumerate(self.params))
+        self.temporal_parameter = temporal_parameter
+        if available_fields is not None:
+            self.available = frozenset(available_fields)
+            self.fields    = tuple(k for k in keys if k in self.available)
+        else:
+            self.available = None
+            self.fields    = tuple(keys)
+        self.field_set = frozenset(self.fields)
+
+    @classmethod
+    def get(cls, pdict, available_fields=None):
+        keys = tuple(pdict.keys())
+        temporal_parameter = pdict.temporal_parameter_name
+        available = tuple(available_fields) if available_fields is not None else None
+        cache_key = (keys, temporal_parameter, available)
+        try:
+            return cls._cache[cache_key]
+        except KeyError:
+            pass
+        layout = cls(keys, temporal_parameter, available)
+        if len(cls._cache) >= cls.CACHE_LIMIT:
+            cls._cache.clear()
+        cls._cache[cache_key] = layout
+        return layout
+
+
+class StreamDefinitionCache(object):
+    """
+    Container-wide cache of stream definitions and their parsed parameter dictionaries, keyed by stream definition id,
+    so a granule can be decoded without a Pubsub RPC or re-parsing the dumped parameter dictionary. Entries are
+    invalidated when the stream definition resource is updated or deleted.
+    """
+    CACHE_LIMIT = CFG.get_safe('container.stream_definition_cache', 100)
+
+    _entries      = collections.OrderedDict()
+    _subscriber   = None
+    hits          = 0
+    misses        = 0
+    invalidations = 0
+
+    @classmethod
+    def get(cls, stream_definition_id):
+        """
+        Returns the (StreamDefinition, ParameterDictionary) pair for the stream definition
+        """
+        try:
+            entry = cls._entries.pop(stream_definition_id)
+            cls.hits += 1
+        except KeyError:
+            cls.misses += 1
+            cls._start_listener()
+            stream_def_obj = RecordDictionaryTool.read_stream_def(stream_definition_id)
+            entry = stream_def_obj, ParameterDictionary.load(stream_def_obj.parameter_dictionary)
+            if len(cls._entries) >= cls.CACHE_LIMIT:
+                cls._entries.popitem(0)
+        cls._entries[stream_definition_id] = entry
+        return entry
+
+    @classmethod
+    def invalidate(cls, stream_definition_id=None):
+        """
+        Drops the entry for the stream definition, or every entry if no id is given
+        """
+        if stream_definition_id is None:
+            cls.invalidations += len(cls._entries)
+            cls._entries.clear()
+        elif cls._entries.pop(stream_definition_id, None) is not None:
+            cls.invalidations += 1
+
+    @classmethod
+    def stats(cls):
+        return {'hits':cls.hits, 'misses':cls.misses, 'invalidations':cls.invalidations, 'size':len(cls._entries)}
+
+    @classmethod
+    def _on_resource_modified(cls, event, *args, **kwargs):
+        if event.sub_type != 'CREATE':
+            log.debug('Invalidating cached stream definition %s (%s)', event.origin, event.sub_type)
+            cls.invalidate(event.origin)
+
+    @classmethod
+    def _start_listener(cls):
+        if cls._subscriber is not None or Container.instance is None:
+            return
+        cls._subscriber = EventSubscriber(event_type=OT.ResourceModifiedEvent,
+                                          origin_type=RT.StreamDefinition,
+                                          callback=cls._on_resource_modified,
+                                          auto_delete=True)
+        cls._subscriber.start()
+
 
 class RecordDictionaryTool(object):
     """
@@ -51,23 +158,22 @@ class RecordDictionaryTool(object):
     to use stream definitions in lieu of parameter dictionaries directly.
     """
 
-    _rd                 = None
-    _pdict              = None
-    _shp                = None
-    _locator            = None
-    _stream_def         = None
-    _dirty_shape        = False
-    _available_fields   = None
-    _creation_timestamp = None
-    _stream_config      = {}
-    _definition         = None
-    connection_id       = ''
-    connection_index    = ''
-
+    __slots__ = ('_rd', '_pdict', '_shp', '_locator', '_stream_def', '_dirty_shape', '_available_fields',
+                 '_creation_timestamp', '_stream_config', '_definition', '_layout', 'connection_id', 'connection_index')
 
     def __init__(self,param_dictionary=None, stream_definition_id='', locator=None, stream_definition=None):
         """
         """
+        self._pdict              = None
+        self._stream_def         = None
+        self._dirty_shape        = False
+        self._available_fields   = None
+        self._creation_timestamp = None
+        self._stream_config      = {}
+        self._definition         = None
+        self.connection_id       = ''
+        self.connection_index    = ''
+
         if type(param_dictionary) == dict:
             self._pdict = ParameterDictionary.load(param_dictionary)
         
@@ -79,12 +185,13 @@ class RecordDictionaryTool(object):
                 if not isinstance(stream_definition,StreamDefinition):
                     raise BadRequest('Improper StreamDefinition object')
                 self._definition = stream_definition
+                stream_def_obj = stream_definition
+                self._pdict = ParameterDictionary.load(stream_def_obj.parameter_dictionary)
+            else:
+                stream_def_obj, self._pdict = StreamDefinitionCache.get(stream_definition_id)
 
-            stream_def_obj = stream_definition or RecordDictionaryTool.read_stream_def(stream_definition_id)
-            pdict = stream_def_obj.parameter_dictionary
             self._available_fields = stream_def_obj.available_fields or None
             self._stream_config = stream_def_obj.stream_configuration
-            self._pdict = ParameterDictionary.load(pdict)
             self._stream_def = stream_definition_id
 
         else:
@@ -94,8 +201,8 @@ class RecordDictionaryTool(object):
             self._stream_def=stream_definition_id
         
         self._shp = None
-        self._rd = {}
         self._locator = locator
+        self._layout = RecordDictionaryLayout.get(self._pdict, self._available_fields)
 
         self._setup_params()
 
@@ -122,7 +229,7 @@ class RecordDictionaryTool(object):
 
     def _lookup_values(self):
         lookup_values = []
-        for field in self.fields:
+        for field in self._layout.fields:
             if hasattr(self.context(field), 'lookup_value'):
                 lookup_values.append(field)
         return lookup_values
@@ -235,14 +342,22 @@ class RecordDictionaryTool(object):
 
 
     def _setup_params(self):
-        for param in self._pdict.keys():
-            self._rd[param] = None
+        self._rd = dict.fromkeys(self._layout.params)
+
+    def copy(self):
+        """
+        Returns a record dictionary for the same parameter dictionary holding the values (and shape) set so far. A
+        record dictionary with the values common to several granules can be used as a template for each of them.
+        """
+        rdt = object.__new__(type(self))
+        for attr in self.__slots__:
+            setattr(rdt, attr, getattr(self, attr))
+        rdt._rd = self._rd.copy()
+        return rdt
 
     @property
     def fields(self):
-        if self._available_fields is not None:
-            return list(set(self._available_fields).intersection(self._pdict.keys()))
-        return self._pdict.keys()
+        return list(self._layout.fields)
 
     @property
     def domain(self):
@@ -251,7 +366,7 @@ class RecordDictionaryTool(object):
 
     @property
     def temporal_parameter(self):
-        return self._pdict.temporal_parameter_name
+        return self._layout.temporal_parameter
 
     def fill_value(self,name):
         return self._pdict.get_context(name).fill_value
@@ -283,7 +398,7 @@ class RecordDictionaryTool(object):
         """
         Set a parameter
         """
-        if name not in self.fields:
+        if name not in self._layout.field_set:
             raise KeyError(name)
 
         if vals is None:
@@ -320,17 +435,17 @@ class RecordDictionaryTool(object):
         self._rd[name] = vals
 
     def param_type(self, name):
-        if name in self.fields:
+        if name in self._layout.field_set:
             return self._pdict.get_context(name).param_type
         raise KeyError(name)
 
     def context(self, name):
-        if name in self.fields:
+        if name in self._layout.field_set:
             return self._pdict.get_context(name)
         raise KeyError(name)
 
     def _reshape_const(self):
-        for k in self.fields:
+        for k in self._layout.fields:
             if isinstance(self._rd[k], ConstantValue):
                 self._rd[k].domain_set = self.domain
 
@@ -340,7 +455,7 @@ class RecordDictionaryTool(object):
         """
         if not self._shp:
             return None
-        if self._available_fields and name not in self._available_fields:
+        if self._layout.available and name not in self._layout.available:
             raise KeyError(name)
         ptype = self._pdict.get_context(name).param_type
 
@@ -410,8 +525,9 @@ class RecordDictionaryTool(object):
 
     def iteritems(self):
         """ D.iteritems() -> an iterator over the (key, value) items of D """
+        available = self._layout.available
         for k,v in self._rd.iteritems():
-            if self._available_fields and k not in self._available_fields:
+            if available and k not in available:
                 continue
             if v is not None:
                 yield k,v
@@ -430,8 +546,8 @@ class RecordDictionaryTool(object):
 
     def __contains__(self, key):
         """ D.__contains__(k) -> True if D has a key k, else False """
-        if self._available_fields:
-            return key in self._rd and key in self._available_fields
+        if self._layout.available:
+            return key in self._rd and key in self._layout.available
         return key in self._rd
 
     def __delitem__(self, y):
@@ -466,7 +582,7 @@ class RecordDictionaryTool(object):
         """
         from pprint import pformat
         repr_dict = {}
-        for field in self.fields:
+        for field in self._layout.fields:
             if self[field] is not None:
                 repr_dict[field] = self[field][:]
         return pformat(repr_dict)
@@ -485,17 +601,10 @@ class RecordDictionaryTool(object):
 
     
     def to_ordinal(self, key):
-        params = copy(self._rd.keys())
-        params.sort()
-        try:
-            return params.index(key)
-        except ValueError:
-            raise KeyError(key)
+        return self._layout.ordinals[key]
         
     def from_ordinal(self, ordinal):
-        params = copy(self._rd.keys())
-        params.sort()
-        return params[ordinal]
+        return self._layout.params[ordinal]
 
 
     @staticmethod
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/tail_index.py
+@description A bounded buffer of the most recent records of a dataset
+'''
+
+from pyon.core.exception import NotFound, Conflict
+from pyon.public import CFG
+from pyon.util.log import log
+
+from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+
+import numpy as np
+
+numpy_walk = DatasetManagementService.numpy_walk
+
+class TailIndex(object):
+    '''
+    Keeps the last N records (by time) of a dataset so the latest values can be
+    served without reading the time axis of the coverage. The ingestion worker
+    extends it with every granule it persists and stores it in the object store
+    next to the dataset's metadata document.
+
+    The index is complete when it was started with the dataset, otherwise it
+    only covers the records ingested since it was created.
+    '''
+    SIZE = CFG.get_safe('service.ingestion_management.tail_size', 100)
+
+    def __init__(self, dataset_id, temporal_parameter, size=None, complete=False):
+        self.dataset_id         = dataset_id
+        self.temporal_parameter = temporal_parameter
+        self.size               = size or self.SIZE
+        self.complete           = complete
+        self.values             = {}
+        self.dtypes             = {}
+        self.fill_values        = {}
+        self._rev               = None
+
+    @classmethod
+    def doc_key(cls, dataset_id):
+        return '%s_tail' % dataset_id
+
+    def __len__(self):
+        if self.temporal_parameter not in self.values:
+            return 0
+        return len(self.values[self.temporal_parameter])
+
+    def covers(self, number_of_points):
+        return self.complete or len(self) >= number_of_points
+
+    def extend(self, rdt):
+        '''
+        Merges the records of a record dictionary into the index, keeping the
+        last SIZE records sorted by time. Records with a time already in the
+        index are skipped, so a granule persisted again on a retry isn't
+        duplicated.
+        '''
+        time_array = rdt[rdt.temporal_parameter]
+        if time_array is None or not len(time_array):
+            return
+        new_len = len(time_array)
+        params = set(self.values)
+        params.update(k for k,v in rdt.iteritems())
+
+        new_values = {}
+        for k in params:
+            if k not in self.fill_values:
+                try:
+                    self.fill_values[k] = rdt.fill_value(k)
+                except (KeyError, AttributeError):
+                    self.fill_values[k] = None
+            new = rdt._rd[k] if k in rdt._rd else None
+            if new is not None:
+                new = np.atleast_1d(new)
+                if len(new) != new_len: # Sparse and constant values
+                    new = np.resize(new, new_len)
+                new_values[k] = new
+        mask = self._unseen(new_values[self.temporal_parameter])
+        self._append({k: v[mask] for k,v in new_values.iteritems()}, int(mask.sum()))
+
+    def merge(self, other):
+        '''
+        Merges the records of another index of the same dataset, such as one
+        written concurrently by another worker, into this one. Records of the
+        other index with a time already in this one are skipped.
+        '''
+        for k,v in other.fill_values.iteritems():
+            self.fill_values.setdefault(k, v)
+        if len(other):
+            times = other.values[other.temporal_parameter]
+            mask = self._unseen(times)
+            self._append({k: v[mask] for k,v in other.values.iteritems()}, int(mask.sum()))
+        self.complete = self.complete and other.complete
+
+    def _unseen(self, times):
+        if not len(self):
+            return np.ones(len(times), dtype=bool)
+        return ~np.in1d(times, self.values[self.temporal_parameter])
+
+    def _append(self, new_values, new_len):
+        if not new_len:
+            return
+        old_len = len(self)
+        params = set(self.values)
+        params.update(new_values)
+
+        merged = {}
+        for k in params:
+            old = self.values.get(k)
+            new = new_values.get(k)
+            # Keep the widest string seen, astype to the first dtype would truncate longer ones
+            dtype = self.dtypes.get(k)
+            new_dtype = new.dtype if new is not None else None
+            if dtype is None:
+                dtype = new_dtype
+            elif new_dtype is not None and dtype.kind in 'SU' and new_dtype.kind in 'SU':
+                dtype = np.promote_types(dtype, new_dtype)
+            if old is None:
+                old = self._fill(k, old_len)
+            if new is None:
+                new = self._fill(k, new_len)
+            if dtype is None:
+                dtype = old.dtype
+            self.dtypes[k] = dtype
+            merged[k] = np.concatenate([old.astype(dtype), new.astype(dtype)]) if old_len else new.astype(dtype)
+
+        # Most granules are in order, avoid the sort when they are
+        times = merged[self.temporal_parameter]
+        new_times = times[old_len:]
+        in_order = (np.diff(new_times) >= 0).all() and (not old_len or new_times[0] >= times[old_len-1])
+        if len(times) > self.size:
+            # The oldest records are dropped, the index no longer holds the whole dataset
+            self.complete = False
+        if not in_order:
+            order = np.argsort(times, kind='mergesort')[-self.size:]
+            self.values = {k: v[order] for k,v in merged.iteritems()}
+        else:
+            self.values = {k: v[-self.size:] for k,v in merged.iteritems()}
+
+    def _fill(self, name, length):
+        fill_value = self.fill_values.get(name)
+        dtype = self.dtypes.get(name, np.dtype('object') if fill_value is None else None)
+        return np.array([fill_value] * length, dtype=dtype)
+
+    def last(self, number_of_points):
+        '''
+        Returns a data dictionary of the last number_of_points records
+        '''
+        return {k: v[-number_of_points:] for k,v in self.values.iteritems()}
+
+    #--------------------------------------------------------------------------------
+    # Persistence
+    #--------------------------------------------------------------------------------
+
+    def to_doc(self):
+        doc = {
+            'temporal_parameter' : self.temporal_parameter,
+            'size'               : self.size,
+            'complete'           : self.complete,
+            'values'             : {k: v.tolist() for k,v in self.values.iteritems()},
+            'dtypes'             : {k: v.str for k,v in self.dtypes.iteritems()},
+            'fill_values'        : self.fill_values
+        }
+        return numpy_walk(doc)
+
+    @classmethod
+    def from_doc(cls, dataset_id, doc):
+        doc = numpy_walk(doc)
+        tail = cls(dataset_id, doc['temporal_parameter'], size=doc['size'], complete=doc['complete'])
+        tail.dtypes = {k: np.dtype(str(v)) for k,v in doc['dtypes'].iteritems()}
+        tail.values = {k: np.array(v, dtype=tail.dtypes.get(k)) for k,v in doc['values'].iteritems()}
+        tail.fill_values = doc.get('fill_values', {})
+        tail._rev = doc.get('_rev')
+        return tail
+
+    @classmethod
+    def read(cls, object_store, dataset_id):
+        try:
+            doc = object_store.read_doc(cls.doc_key(dataset_id))
+        except NotFound:
+            return None
+        return cls.from_doc(dataset_id, doc)
+
+    def persist(self, object_store):
+        doc = self.to_doc()
+        if self._rev is None:
+            _, self._rev = object_store.create_doc(doc, object_id=self.doc_key(self.dataset_id))
+            return
+        doc['_id'] = self.doc_key(self.dataset_id)
+        doc['_rev'] = self._rev
+        try:
+            _, self._rev = object_store.update_doc(doc)
+        except Conflict:
+            # Another writer updated the index: keep their records too
+            log.debug('Tail index for dataset %s was modified concurrently', self.dataset_id)
+            current = self.read(object_store, self.dataset_id)
+            if current is None:
+                self._rev = None
+            else:
+                self.merge(current)
+                self._rev = current._rev
+            self.persist(object_store)
+
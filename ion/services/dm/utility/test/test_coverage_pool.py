@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_coverage_pool.py
+@description Unit tests for the container-wide coverage pool
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.services.dm.utility.coverage_pool import CoveragePool
+
+from mock import Mock, patch
+from gevent.event import Event
+from nose.plugins.attrib import attr
+
+import collections
+import gevent
+
+@attr('UNIT', group='dm')
+class TestCoveragePool(PyonTestCase):
+    def setUp(self):
+        self.opened = []
+        def load(dataset_id, mode='r'):
+            coverage = Mock()
+            coverage.dataset_id = dataset_id
+            self.opened.append(coverage)
+            return coverage
+
+        patcher = patch.object(DatasetManagementService, '_get_coverage', Mock(side_effect=load))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.multiple(CoveragePool, _entries=collections.OrderedDict(), _handles={}, _loading={}, hits=0, misses=0, evictions=0, SIZE=2, IDLE_TIMEOUT=60, READ_REFRESH=60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_handle(self):
+        a = CoveragePool.acquire('dataset', mode='a')
+        b = CoveragePool.acquire('dataset', mode='a')
+        self.assertIs(a, b)
+        self.assertEquals(len(self.opened), 1)
+
+        # Modes don't share handles
+        r = CoveragePool.acquire('dataset', mode='r')
+        self.assertIsNot(a, r)
+
+        CoveragePool.release(a)
+        CoveragePool.release(b)
+        CoveragePool.release(r)
+        self.assertFalse(a.close.called)
+        self.assertEquals(CoveragePool.stats(), {'hits':1, 'misses':2, 'evictions':0, 'size':2, 'in_use':0})
+
+    def test_size_eviction(self):
+        held = CoveragePool.acquire('held')
+        for dataset_id in ('a', 'b', 'c'):
+            CoveragePool.release(CoveragePool.acquire(dataset_id))
+
+        # Handles in use are never evicted
+        self.assertFalse(held.close.called)
+        self.assertLessEqual(len(CoveragePool._entries), 2)
+        closed = [c.dataset_id for c in self.opened if c.close.called]
+        self.assertEquals(closed, ['a', 'b'])
+
+    def test_idle_eviction(self):
+        coverage = CoveragePool.acquire('dataset')
+        CoveragePool.release(coverage)
+        CoveragePool.IDLE_TIMEOUT = -1
+        CoveragePool.reap()
+        self.assertTrue(coverage.close.called)
+        self.assertEquals(CoveragePool.stats()['size'], 0)
+
+    def test_read_refresh(self):
+        reader = CoveragePool.acquire('dataset', mode='r')
+        CoveragePool.release(reader)
+        CoveragePool.READ_REFRESH = -1
+        self.assertIsNot(CoveragePool.acquire('dataset', mode='r'), reader)
+        self.assertTrue(reader.close.called)
+
+    def test_refresh_non_appending(self):
+        writer = CoveragePool.acquire('dataset', mode='r+')
+        appender = CoveragePool.acquire('dataset', mode='a')
+        CoveragePool.release(writer)
+        CoveragePool.release(appender)
+        CoveragePool.READ_REFRESH = -1
+        # Only appending handles see the data appended through them
+        self.assertIsNot(CoveragePool.acquire('dataset', mode='r+'), writer)
+        self.assertIs(CoveragePool.acquire('dataset', mode='a'), appender)
+
+    def test_open_outside_lock(self):
+        opening = Event()
+        def load(dataset_id, mode='r'):
+            if dataset_id == 'slow':
+                opening.wait()
+            coverage = Mock()
+            self.opened.append(coverage)
+            return coverage
+
+        with patch.object(DatasetManagementService, '_get_coverage', Mock(side_effect=load)):
+            slow = [gevent.spawn(CoveragePool.acquire, 'slow') for i in xrange(2)]
+            gevent.sleep(0)
+            # Other datasets open while one is loading
+            CoveragePool.acquire('fast')
+            self.assertEquals(len(self.opened), 1)
+            opening.set()
+            gevent.joinall(slow)
+
+        # Callers waiting on the same handle share it
+        self.assertIs(slow[0].value, slow[1].value)
+        self.assertEquals(len(self.opened), 2)
+
+    def test_discard_in_use(self):
+        coverage = CoveragePool.acquire('dataset', mode='a')
+        CoveragePool.invalidate('dataset')
+        self.assertFalse(coverage.close.called)
+
+        # New callers get a fresh handle, the old one closes on release
+        self.assertIsNot(CoveragePool.acquire('dataset', mode='a'), coverage)
+        CoveragePool.release(coverage)
+        self.assertTrue(coverage.close.called)
+
+    def test_retain(self):
+        coverage = CoveragePool.acquire('dataset')
+        CoveragePool.retain(coverage)
+        CoveragePool.release(coverage)
+        CoveragePool.invalidate('dataset')
+        self.assertFalse(coverage.close.called)
+        CoveragePool.release(coverage)
+        self.assertTrue(coverage.close.called)
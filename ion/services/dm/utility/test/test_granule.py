@@ -162,7 +162,25 @@ class RecordDictionaryIntegrationTest(IonIntegrationTestCase):
         self.assertEquals(rdt.fields, rdt2.fields)
         for k,v in rdt.iteritems():
             self.assertTrue(np.array_equal(rdt[k], rdt2[k]))
-        
+
+    def test_copy(self):
+        pdict_id = self.dataset_management.read_parameter_dictionary_by_name('ctd_parsed_param_dict', id_only=True)
+        stream_def_id = self.pubsub_management.create_stream_definition('ctd', parameter_dictionary_id=pdict_id)
+        self.addCleanup(self.pubsub_management.delete_stream_definition, stream_def_id)
+        template = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        template['lat'] = [40.]
+
+        for size in (10, 20):
+            rdt = template.copy()
+            rdt['time'] = np.arange(size)
+            rdt['temp'] = np.arange(size)
+            rdt2 = RecordDictionaryTool.load_from_granule(rdt.to_granule())
+            np.testing.assert_array_equal(rdt2['time'], np.arange(size))
+            self.assertEquals(rdt2['lat'][0], 40.)
+
+        self.assertIsNone(template['time'])
+        np.testing.assert_array_equal(template['lat'], [40.])
+
 
 
     def test_rdt_param_funcs(self):
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_notification_index.py
+@brief Matching of events against the compiled notification index
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.services.dm.utility.uns_utility_methods import NotificationIndex
+
+from mock import Mock
+from nose.plugins.attrib import attr
+
+import itertools
+import random
+import time
+
+def combinations(key):
+    '''
+    Every combination of the key's values with '' filler, the keys the notification worker used to probe
+    '''
+    n = len(key)
+    for r in xrange(1, n + 1):
+        for indices in itertools.combinations(xrange(n), r):
+            yield tuple(key[i] if i in indices else '' for i in xrange(n))
+
+def brute_force(notifications, key):
+    matched = set()
+    for k in set(combinations(key)):
+        matched.update(notifications.get(k, ()))
+    return matched
+
+def build_notifications(count, seed=0):
+    '''
+    Returns the notification index and the equivalent dictionary of keys to (notification, user) values
+    '''
+    rand = random.Random(seed)
+    origins = ['origin_%d' % i for i in xrange(count / 10 + 1)]
+    origin_types = ['', 'InstrumentDevice', 'PlatformDevice', 'DataProduct']
+    event_types = ['', 'ResourceAgentStateEvent', 'DeviceStatusAlertEvent', 'ResourceLifecycleEvent', 'ParameterQCEvent']
+    sub_types = ['', '', 'UPDATE', 'CREATE']
+    users = [Mock(_id='user_%d' % i) for i in xrange(count / 100 + 1)]
+
+    index = NotificationIndex()
+    notifications = {}
+    for i in xrange(count):
+        notification = Mock(_id='notification_%d' % i)
+        user = rand.choice(users)
+        key = (rand.choice(origins + [''] * 10), rand.choice(origin_types), rand.choice(event_types), rand.choice(sub_types))
+        index.add(notification, user, [key])
+        notifications.setdefault(key, set()).add((notification, user))
+    return index, notifications, origins, origin_types, event_types, sub_types
+
+
+@attr('UNIT', group='dm')
+class TestNotificationIndex(PyonTestCase):
+    def test_matches_key_combinations(self):
+        index, notifications, origins, origin_types, event_types, sub_types = build_notifications(2000)
+        for key in itertools.product(origins[:20] + [''], origin_types, event_types, sub_types):
+            self.assertEquals(index.match(*key), brute_force(notifications, key))
+
+    def test_wildcard_only_key(self):
+        # A key of only '' matches events with an empty field, as the combinations did
+        notification, user = Mock(_id='n'), Mock(_id='u')
+        index = NotificationIndex()
+        index.add(notification, user, [('', '', '', '')])
+        self.assertEquals(index.match('origin', 'type', 'event', ''), set([(notification, user)]))
+        self.assertEquals(index.match('origin', 'type', 'event', 'UPDATE'), set())
+
+    def test_remove(self):
+        notification, user = Mock(_id='n'), Mock(_id='u')
+        index = NotificationIndex()
+        index.add(notification, user, [('origin', '', 'ResourceLifecycleEvent', ''), ('child', '', 'ResourceLifecycleEvent', '')])
+        self.assertEquals(index.notification_ids('u'), set(['n']))
+        self.assertEquals(len(index), 1)
+
+        index.remove('n')
+        self.assertEquals(index.match('origin', 'InstrumentDevice', 'ResourceLifecycleEvent', ''), set())
+        self.assertEquals(index._root, {})
+        self.assertEquals(index.notification_ids('u'), set())
+        self.assertEquals(len(index), 0)
+
+
+@attr('BENCHMARK', group='dm')
+class NotificationIndexBenchmark(PyonTestCase):
+    '''
+    Measures the per-event matching cost against the number of active notification requests
+    '''
+    events = 10000
+
+    def test_match_by_notification_count(self):
+        rand = random.Random(1)
+        for count in (1000, 10000, 50000):
+            index, notifications, origins, origin_types, event_types, sub_types = build_notifications(count)
+            keys = [(rand.choice(origins), rand.choice(origin_types[1:]), rand.choice(event_types[1:]), rand.choice(sub_types)) for i in xrange(self.events)]
+
+            t0 = time.time()
+            for key in keys:
+                brute_force(notifications, key)
+            combination_cost = (time.time() - t0) / self.events
+
+            t0 = time.time()
+            for key in keys:
+                index.match(*key)
+            index_cost = (time.time() - t0) / self.events
+
+            log.info('%6d notifications: %.2fus per event (index), %.2fus per event (combinations)', count, index_cost * 1e6, combination_cost * 1e6)
+            self.assertLess(index_cost, combination_cost)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_rdt_benchmark.py
+@brief Microbenchmarks for the record dictionary granule round trip
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool, RecordDictionaryLayout
+
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType
+from nose.plugins.attrib import attr
+
+import numpy as np
+import time
+
+@attr('UNIT', group='dm')
+class TestRecordDictionaryLayout(PyonTestCase):
+    def test_layout_shared(self):
+        pdict = build_pdict(10)
+        rdt_a = RecordDictionaryTool(param_dictionary=pdict)
+        rdt_b = RecordDictionaryTool(param_dictionary=pdict)
+        self.assertIs(rdt_a._layout, rdt_b._layout)
+
+        params = sorted(pdict.keys())
+        for i, param in enumerate(params):
+            self.assertEquals(rdt_a.to_ordinal(param), i)
+            self.assertEquals(rdt_a.from_ordinal(i), param)
+        with self.assertRaises(KeyError):
+            rdt_a.to_ordinal('not_a_param')
+
+    def test_available_fields(self):
+        pdict = build_pdict(10)
+        layout = RecordDictionaryLayout.get(pdict, ['time', 'p000', 'missing'])
+        self.assertEquals(layout.fields, ('time', 'p000'))
+        self.assertEquals(layout.field_set, frozenset(['time', 'p000']))
+        self.assertEquals(layout.temporal_parameter, 'time')
+
+    def test_slots(self):
+        rdt = RecordDictionaryTool(param_dictionary=build_pdict(1))
+        with self.assertRaises(AttributeError):
+            rdt.arbitrary_attribute = 1
+
+
+@attr('BENCHMARK', group='dm')
+class RecordDictionaryBenchmark(PyonTestCase):
+    '''
+    Measures the cost of a granule round trip (RDT -> granule -> RDT) as the
+    number of parameters in the parameter dictionary grows.
+    '''
+    iterations = 100
+    records    = 10
+
+    def round_trip(self, pdict):
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        rdt['time'] = np.arange(self.records, dtype='float64')
+        for field in rdt.fields:
+            if field != 'time':
+                rdt[field] = np.arange(self.records, dtype='float32')
+        granule = rdt.to_granule()
+        return RecordDictionaryTool.load_from_granule(granule)
+
+    def test_round_trip_by_parameter_count(self):
+        per_param = {}
+        for param_count in (10, 50, 100, 200, 400):
+            pdict = build_pdict(param_count)
+            self.round_trip(pdict) # warm the layout cache
+
+            t0 = time.time()
+            for i in xrange(self.iterations):
+                rdt = self.round_trip(pdict)
+            elapsed = (time.time() - t0) / self.iterations
+            per_param[param_count] = elapsed / param_count
+
+            np.testing.assert_array_equal(rdt['p000'], np.arange(self.records, dtype='float32'))
+            log.info('RDT round trip: %4d params %.6fs per granule', param_count, elapsed)
+
+        # The per-parameter cost should stay roughly flat, not grow with P
+        self.assertLess(per_param[400], per_param[10] * 4)
+
+
+def build_pdict(param_count):
+    pdict = ParameterDictionary()
+
+    t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+    t_ctxt.uom = 'seconds since 1900-01-01'
+    pdict.add_context(t_ctxt, is_temporal=True)
+
+    for i in xrange(param_count):
+        ctxt = ParameterContext('p%03d' % i, param_type=QuantityType(value_encoding=np.dtype('float32')))
+        ctxt.uom = '1'
+        pdict.add_context(ctxt)
+    return pdict
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_stream_definition_cache.py
+@brief Unit tests for the container-wide stream definition cache
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.containers import DotDict
+
+from ion.services.dm.utility.granule.record_dictionary import StreamDefinitionCache, RecordDictionaryTool
+from ion.services.dm.utility.test.test_rdt_benchmark import build_pdict
+
+from mock import patch, Mock
+from nose.plugins.attrib import attr
+
+@attr('UNIT', group='dm')
+class TestStreamDefinitionCache(PyonTestCase):
+    def setUp(self):
+        StreamDefinitionCache.invalidate()
+        StreamDefinitionCache.hits = StreamDefinitionCache.misses = StreamDefinitionCache.invalidations = 0
+        self.addCleanup(StreamDefinitionCache.invalidate)
+
+        self.stream_def = Mock()
+        self.stream_def.parameter_dictionary = build_pdict(5).dump()
+        self.stream_def.available_fields = None
+        self.stream_def.stream_configuration = {}
+
+        patcher = patch.object(RecordDictionaryTool, 'read_stream_def', Mock(return_value=self.stream_def))
+        self.read_stream_def = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(StreamDefinitionCache, '_start_listener', Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit_and_miss(self):
+        rdt_a = RecordDictionaryTool(stream_definition_id='sdef')
+        rdt_b = RecordDictionaryTool(stream_definition_id='sdef')
+
+        self.read_stream_def.assert_called_once_with('sdef')
+        self.assertIs(rdt_a._pdict, rdt_b._pdict)
+        self.assertEquals(StreamDefinitionCache.stats(), {'hits':1, 'misses':1, 'invalidations':0, 'size':1})
+
+    def test_invalidation(self):
+        RecordDictionaryTool(stream_definition_id='sdef')
+
+        StreamDefinitionCache._on_resource_modified(DotDict(origin='sdef', sub_type='UPDATE'))
+        self.assertEquals(StreamDefinitionCache.stats()['invalidations'], 1)
+
+        RecordDictionaryTool(stream_definition_id='sdef')
+        self.assertEquals(self.read_stream_def.call_count, 2)
+
+        # Creation of other stream definitions doesn't evict anything
+        StreamDefinitionCache._on_resource_modified(DotDict(origin='sdef', sub_type='CREATE'))
+        self.assertEquals(StreamDefinitionCache.stats()['size'], 1)
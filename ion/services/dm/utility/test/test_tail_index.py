@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_tail_index.py
+@brief Unit tests for the dataset tail index
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.core.exception import Conflict
+from ion.services.dm.utility.tail_index import TailIndex
+
+from mock import Mock
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+class MockRDT(object):
+    temporal_parameter = 'time'
+
+    def __init__(self, **values):
+        self._rd = {'time':None, 'temp':None, 'conductivity':None}
+        self._rd.update(values)
+
+    def __getitem__(self, name):
+        return self._rd[name]
+
+    def iteritems(self):
+        return ((k,v) for k,v in self._rd.iteritems() if v is not None)
+
+    def fill_value(self, name):
+        return -9999.
+
+@attr('UNIT', group='dm')
+class TestTailIndex(PyonTestCase):
+    def test_extend_bounded(self):
+        tail = TailIndex('dataset', 'time', size=10)
+        for i in xrange(5):
+            t = np.arange(i*4, (i+1)*4, dtype='float64')
+            tail.extend(MockRDT(time=t, temp=t*2))
+
+        self.assertEquals(len(tail), 10)
+        np.testing.assert_array_equal(tail.last(3)['time'], [17., 18., 19.])
+        np.testing.assert_array_equal(tail.last(3)['temp'], [34., 36., 38.])
+
+    def test_out_of_order(self):
+        tail = TailIndex('dataset', 'time', size=4)
+        tail.extend(MockRDT(time=np.array([10., 11., 12.]), temp=np.array([1., 2., 3.])))
+        tail.extend(MockRDT(time=np.array([5., 13.]), temp=np.array([0., 4.])))
+
+        np.testing.assert_array_equal(tail.last(4)['time'], [10., 11., 12., 13.])
+        np.testing.assert_array_equal(tail.last(4)['temp'], [1., 2., 3., 4.])
+
+    def test_extend_again(self):
+        tail = TailIndex('dataset', 'time', size=10)
+        rdt = MockRDT(time=np.array([1., 2., 3.]), temp=np.array([1., 2., 3.]))
+        tail.extend(rdt)
+        # A retried granule is only indexed once
+        tail.extend(rdt)
+        tail.extend(MockRDT(time=np.array([3., 4.]), temp=np.array([3., 4.])))
+
+        np.testing.assert_array_equal(tail.last(10)['time'], [1., 2., 3., 4.])
+        np.testing.assert_array_equal(tail.last(10)['temp'], [1., 2., 3., 4.])
+
+    def test_missing_parameters_are_filled(self):
+        tail = TailIndex('dataset', 'time', size=10)
+        tail.extend(MockRDT(time=np.array([1., 2.]), temp=np.array([1., 2.])))
+        tail.extend(MockRDT(time=np.array([3.]), conductivity=np.array([30.])))
+
+        values = tail.last(3)
+        np.testing.assert_array_equal(values['temp'], [1., 2., -9999.])
+        np.testing.assert_array_equal(values['conductivity'], [-9999., -9999., 30.])
+
+    def test_covers(self):
+        tail = TailIndex('dataset', 'time', size=10)
+        tail.extend(MockRDT(time=np.array([1., 2.])))
+        self.assertFalse(tail.covers(5))
+        self.assertTrue(tail.covers(2))
+        tail.complete = True
+        self.assertTrue(tail.covers(5))
+
+    def test_covers_truncated(self):
+        tail = TailIndex('dataset', 'time', size=10, complete=True)
+        tail.extend(MockRDT(time=np.arange(8.)))
+        self.assertTrue(tail.covers(500))
+
+        # Once records are dropped, only requests the index can hold are covered
+        tail.extend(MockRDT(time=np.arange(8., 16.)))
+        self.assertEquals(len(tail), 10)
+        self.assertFalse(tail.complete)
+        self.assertFalse(tail.covers(500))
+        self.assertTrue(tail.covers(10))
+
+    def test_strings_widen(self):
+        tail = TailIndex('dataset', 'time', size=10)
+        tail.extend(MockRDT(time=np.array([1.]), temp=np.array(['ab'])))
+        tail.extend(MockRDT(time=np.array([2.]), temp=np.array(['abcdef'])))
+        np.testing.assert_array_equal(tail.last(2)['temp'], ['ab', 'abcdef'])
+
+    def test_concurrent_persist_merges(self):
+        object_store = Mock()
+        ours = TailIndex('dataset', 'time', size=10, complete=True)
+        ours.extend(MockRDT(time=np.array([1., 2., 4.]), temp=np.array([1., 2., 4.])))
+        ours._rev = '1'
+
+        theirs = TailIndex('dataset', 'time', size=10, complete=True)
+        theirs.extend(MockRDT(time=np.array([1., 2., 3.]), conductivity=np.array([10., 20., 30.])))
+        doc = theirs.to_doc()
+        doc['_rev'] = '2'
+
+        object_store.update_doc.side_effect = [Conflict(), ('dataset_tail', '3')]
+        object_store.read_doc.return_value = doc
+        ours.persist(object_store)
+
+        self.assertEquals(object_store.update_doc.call_args[0][0]['_rev'], '2')
+        self.assertEquals(ours._rev, '3')
+        self.assertTrue(ours.complete)
+        values = ours.last(10)
+        np.testing.assert_array_equal(values['time'], [1., 2., 3., 4.])
+        np.testing.assert_array_equal(values['temp'], [1., 2., -9999., 4.])
+        np.testing.assert_array_equal(values['conductivity'], [-9999., -9999., 30., -9999.])
+
+    def test_persistence(self):
+        object_store = Mock()
+        object_store.create_doc.return_value = ('dataset_tail', '1')
+        object_store.update_doc.return_value = ('dataset_tail', '2')
+
+        tail = TailIndex('dataset', 'time', size=10, complete=True)
+        tail.extend(MockRDT(time=np.array([1., 2.]), temp=np.array([np.nan, 3.])))
+        tail.persist(object_store)
+        doc = object_store.create_doc.call_args[0][0]
+        self.assertEquals(object_store.create_doc.call_args[1], {'object_id':'dataset_tail'})
+
+        tail.persist(object_store)
+        self.assertEquals(object_store.update_doc.call_args[0][0]['_rev'], '1')
+
+        doc['_rev'] = '2'
+        restored = TailIndex.from_doc('dataset', doc)
+        self.assertTrue(restored.complete)
+        self.assertEquals(restored.values['temp'].dtype, np.dtype('float64'))
+        self.assertTrue(np.isnan(restored.values['temp'][0]))
+        np.testing.assert_array_equal(restored.values['time'], [1., 2.])
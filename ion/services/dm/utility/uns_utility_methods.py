@@ -523,6 +523,57 @@ def get_event_summary(event):
     return summary
 
 
+def _notification_children(resource_registry, notification_origin, notification_type, observatory_util=None):
+    """ uses ObservatoryUtil or ResourceRegistry to find children (id) associated with a NotificationRequest """
+    if observatory_util is None:
+         observatory_util = ObservatoryUtil()
+    children = []
+    if notification_type == NotificationTypeEnum.PLATFORM:
+        device_relations = observatory_util.get_child_devices(notification_origin)
+        children = [did for pt,did,dt in device_relations[notification_origin]]
+    elif type == NotificationTypeEnum.SITE:
+        child_site_dict, ancestors = observatory_util.get_child_sites(notification_origin)
+        children = child_site_dict.keys()
+    elif type == NotificationTypeEnum.FACILITY:
+        objects, _ = resource_registry.find_objects(subject=notification_origin, predicate=PRED.hasResource, id_only=False)
+        for o in objects:
+            if o.type_ == RT.DataProduct \
+            or o.type_ == RT.InstrumentSite \
+            or o.type_ == RT.InstrumentDevice \
+            or o.type_ == RT.PlatformSite \
+            or o.type_ == RT.PlatformDevice:
+                children.append(o._id)
+    if notification_origin in children:
+        children.remove(notification_origin)
+    return children
+
+def notification_keys(notification, resource_registry, current_datetime=None):
+    """
+    returns the (origin,origin_type,event_type,event_subtype) keys an active NotificationRequest matches Events by,
+    including the keys of the children of aggregate notifications; no keys if it is disabled or expired
+    """
+    # NotificationRequest disabled by system process?
+    if notification.disabled_by_system:
+        return []
+
+    # NotificationRequest expired? (note this is relative to current time)
+    current_datetime = current_datetime or get_ion_ts()
+    if notification.temporal_bounds.end_datetime:
+        if int(notification.temporal_bounds.end_datetime) < current_datetime:
+            return []
+
+    # create tuple key (origin,origin_type,event_type,event_subtype)
+    event_type = notification.event_type
+    event_subtype = notification.event_subtype
+    keys = [(notification.origin, notification.origin_type, event_type, event_subtype)]
+
+    # add children if applicable - children have same (event, event_subtype) in key and same (notification, user) for value
+    if notification.type != NotificationTypeEnum.SIMPLE and notification.origin:
+        children = _notification_children(resource_registry, notification_origin=notification.origin, notification_type=notification.type)
+        for child in children: # child is _id
+            keys.append((child, '', event_type, event_subtype)) # all children match by origin (_id)
+    return keys
+
 def load_notifications(container=None):
     """
     result is dict:
@@ -534,30 +585,6 @@ def load_notifications(container=None):
     container = container or bootstrap.container_instance
     resource_registry = container.resource_registry
 
-    # uses ObservatoryUtil or ResourceRegistry to find children (id) associated with a NotificationRequest
-    def _notification_children(notification_origin, notification_type, observatory_util=None):
-        if observatory_util is None:
-             observatory_util = ObservatoryUtil()
-        children = []
-        if notification_type == NotificationTypeEnum.PLATFORM:
-            device_relations = observatory_util.get_child_devices(notification_origin)
-            children = [did for pt,did,dt in device_relations[notification_origin]]
-        elif type == NotificationTypeEnum.SITE:
-            child_site_dict, ancestors = observatory_util.get_child_sites(notification_origin)
-            children = child_site_dict.keys()
-        elif type == NotificationTypeEnum.FACILITY:
-            objects, _ = resource_registry.find_objects(subject=notification_origin, predicate=PRED.hasResource, id_only=False)
-            for o in objects:
-                if o.type_ == RT.DataProduct \
-                or o.type_ == RT.InstrumentSite \
-                or o.type_ == RT.InstrumentDevice \
-                or o.type_ == RT.PlatformSite \
-                or o.type_ == RT.PlatformDevice:
-                    children.append(o._id)
-        if notification_origin in children:
-            children.remove(notification_origin)
-        return children
-
     # time when we're loading, used for expired notifications
     current_datetime = get_ion_ts()
 
@@ -566,6 +593,7 @@ def load_notifications(container=None):
 
     # all users (full objects)
     users, _ = resource_registry.find_resources(restype=RT.UserInfo)
+    users_by_id = dict((u._id, u) for u in users)
 
     # subject: UserInfo
     subjects = [u._id for u in users]
@@ -578,38 +606,120 @@ def load_notifications(container=None):
 
         if association.p == PRED.hasNotification:
 
-            user = [u for u in users if u._id == association.s][0]
+            user = users_by_id[association.s]
 
-            # NotificationRequest disabled by system process?
-            if notification.disabled_by_system:
-                continue
+            # store tuple by key containing set of (NotificationRequest,UserInfo)
+            value = (notification, user)
+            for key in notification_keys(notification, resource_registry, current_datetime):
+                if key not in notifications:
+                    notifications[key] = set()
+                notifications[key].add(value)
 
-            # NotificationRequest expired? (note this is relative to current time)
-            if notification.temporal_bounds.end_datetime:
-                if int(notification.temporal_bounds.end_datetime) < current_datetime:
-                    continue
+    return notifications
 
-            # create tuple key (origin,origin_type,event_type,event_subtype)
-            origin = notification.origin
-            origin_type = notification.origin_type
-            event_type = notification.event_type
-            event_subtype = notification.event_subtype
-            key = (origin, origin_type, event_type, event_subtype)
+class NotificationIndex(object):
+    """
+    Compiled index of the active NotificationRequests, matches an Event to the (notification, user) pairs it triggers.
 
-            # store tuple by key containing set of (NotificationRequest,UserInfo)
-            if key not in notifications:
-                notifications[key] = set()
-            value = (notification, user)
-            notifications[key].add(value)
+    A trie over (origin, origin_type, event_type, event_subtype); a NotificationRequest key with '' in a position
+    matches any value there. Matching walks at most two branches per level, and only those that exist, so the cost
+    doesn't grow with the number of NotificationRequests. The index is updated per NotificationRequest or UserInfo
+    instead of being reloaded.
+    """
+    def __init__(self):
+        self._root = {}
+        self._keys = {}     # notification_id -> [keys]
+        self._values = {}   # notification_id -> [(notification, user)]
+        self._users = {}    # user_id -> set of notification_ids
 
-            # add children if applicable - children have same (event, event_subtype) in key and same (notification, user) for value
-            if notification.type != NotificationTypeEnum.SIMPLE and notification.origin:
-                children = _notification_children(notification_origin=notification.origin, notification_type=notification.type)
-                for child in children: # child is _id
-                    key = (child, '', event_type, event_subtype) # all children match by origin (_id)
-                    if key not in notifications:
-                        notifications[key] = set()
-                    notifications[key].add(value)
+    @classmethod
+    def load(cls, container=None):
+        """ builds the index from the resource registry, same NotificationRequests as load_notifications """
+        index = cls()
+        for key, values in load_notifications(container).iteritems():
+            for notification, user in values:
+                index._insert(key, notification, user)
+        return index
+
+    def __len__(self):
+        return len(self._values)
+
+    def match(self, origin, origin_type, event_type, event_subtype):
+        """
+        returns the set of (notification, user) triggered by an Event
 
-    return notifications
+        same semantics as probing every combination of the Event's key with '' filler: each position of a
+        NotificationRequest key is '' or the Event's value, and at least one is the Event's value
+        """
+        # (node, matched at least one position by value)
+        nodes = [(self._root, False)]
+        for value in (origin, origin_type, event_type, event_subtype):
+            branches = []
+            for node, specific in nodes:
+                if value in node:
+                    branches.append((node[value], True))
+                if value != '' and '' in node:
+                    branches.append((node[''], specific))
+            if not branches:
+                return set()
+            nodes = branches
+        matched = set()
+        for leaf, specific in nodes:
+            if specific:
+                matched.update(leaf)
+        return matched
+
+    def add(self, notification, user, keys):
+        """ indexes a NotificationRequest of a user under keys (see notification_keys) """
+        for key in keys:
+            self._insert(key, notification, user)
+
+    def remove(self, notification_id):
+        """ removes a NotificationRequest from the index, for every user """
+        values = self._values.pop(notification_id, [])
+        keys = self._keys.pop(notification_id, [])
+        for notification, user in values:
+            user_notifications = self._users.get(user._id)
+            if user_notifications is not None:
+                user_notifications.discard(notification_id)
+                if not user_notifications:
+                    del self._users[user._id]
+            for key in keys:
+                self._discard(key, (notification, user))
+
+    def notification_ids(self, user_id):
+        return set(self._users.get(user_id, ()))
+
+    def _insert(self, key, notification, user):
+        node = self._root
+        for value in key[:-1]:
+            node = node.setdefault(value, {})
+        node.setdefault(key[-1], set()).add((notification, user))
+
+        keys = self._keys.setdefault(notification._id, [])
+        if key not in keys:
+            keys.append(key)
+        values = self._values.setdefault(notification._id, [])
+        if (notification, user) not in values:
+            values.append((notification, user))
+        self._users.setdefault(user._id, set()).add(notification._id)
+
+    def _discard(self, key, value):
+        path = [self._root]
+        for v in key[:-1]:
+            if v not in path[-1]:
+                return
+            path.append(path[-1][v])
+        leaf = path[-1].get(key[-1])
+        if leaf is None:
+            return
+        leaf.discard(value)
+        if leaf:
+            return
+        # prune the empty branches
+        del path[-1][key[-1]]
+        for depth in xrange(len(key) - 2, -1, -1):
+            if path[depth + 1]:
+                break
+            del path[depth][key[depth]]
 
@@ -830,7 +830,7 @@ class PlatformAgentConfigurationBuilder(AgentConfigurationBuilder):
         log.debug("Getting child platform device ids")
         if self._use_network_parent():
             log.debug("Using hasNetworkParnet")
-            assocs = self.RR2.filter_cached_associations(PRED.hasNetworkParent, lambda a: dev_id == a.o)
+            assocs = self.RR2.find_cached_associations(PRED.hasNetworkParent, object=dev_id)
             child_pdevice_ids = [a.s for a in assocs]
         else:
             log.debug("Using hasDevice")
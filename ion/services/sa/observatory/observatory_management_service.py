@@ -1170,7 +1170,7 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
             device_relations = outil.get_device_relations(site_ids)
 
             # Set parent immediate child sites
-            parent_site_ids = [a.s for a in RR2.filter_cached_associations(PRED.hasSite, lambda a: a.p ==PRED.hasSite and a.o == site_id)]
+            parent_site_ids = [a.s for a in RR2.find_cached_associations(PRED.hasSite, object=site_id)]
             if parent_site_ids:
                 extended_site.parent_site = RR2.read(parent_site_ids[0])
             else:
@@ -1640,11 +1640,9 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
         return extended_org
 
     def _get_root_platforms(self, RR2, platform_device_list):
-        # get all relevant assocation objects
-        filter_fn = lambda a: a.o in platform_device_list
-
-        # get child -> parent dict
-        lookup = dict([(a.o, a.s) for a in RR2.filter_cached_associations(PRED.hasDevice, filter_fn)])
+        # get child -> parent dict from the relevant assocation objects
+        lookup = dict([(a.o, a.s) for dev_id in platform_device_list
+                       for a in RR2.find_cached_associations(PRED.hasDevice, object=dev_id)])
 
         # root platforms have no parent, or a parent that's not in our list
         return [r for r in platform_device_list if (r not in lookup or (lookup[r] not in platform_device_list))]
@@ -6,18 +6,215 @@ __author__ = 'Michael Meisinger, Maurice Manning'
 
 from pyon.core import bootstrap
 from pyon.core.exception import BadRequest
-from pyon.public import RT, PRED, log
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT, RT, PRED, log
 
 from interface.objects import DeviceStatusType, AggregateStatusType
 
+import time
+import weakref
+
+
+class HierarchyIndex(object):
+    """
+    Materialized site/device hierarchy built from hasSite, hasDevice and hasSource associations.
+    Parent and children maps are kept per site and device, so subtree queries walk only the
+    result. Ancestor and descendant sets are computed on first use and kept until an association
+    change touches them.
+
+    A container-level index is shared by the ObservatoryUtil instances created with
+    shared_cache=True, meant for read-only paths such as the container UI. It is dropped when a
+    site, device or data product is modified and otherwise rebuilt after MAX_AGE seconds, since
+    association changes (assign, deploy) emit no event.
+    """
+    SITE_TYPES = (RT.Observatory, RT.Subsite, RT.PlatformSite, RT.InstrumentSite)
+    DEVICE_TYPES = (RT.PlatformDevice, RT.InstrumentDevice)
+    MAX_AGE = CFG.get_safe('container.hierarchy_index.max_age', 10)
+
+    _shared = weakref.WeakKeyDictionary()
+    _subscribers = weakref.WeakKeyDictionary()  # container -> ResourceModifiedEvent subscriber
+
+    def __init__(self, assoc_list=None):
+        self.predicates = set()     # Predicates loaded in full
+        self.site_parents = {}      # site_id -> (site type, parent site_id, parent type)
+        self.site_children = {}     # site_id -> list of child site_ids
+        self.site_devices = {}      # site_id -> (site type, device_id, device type)
+        self.device_parents = {}    # device_id -> list of parent device_ids
+        self.device_children = {}   # device_id -> list of (parent type, child device_id, child type)
+        self.data_products = {}     # resource_id -> list of data product ids
+        self._site_ancestors = {}
+        self._site_descendants = {}
+        self._device_ancestors = {}
+        self._device_descendants = {}
+        self.created = time.time()
+        for assoc in assoc_list or []:
+            self.add_association(assoc)
+
+    def load(self, predicate, assoc_list):
+        """Adds all associations of a predicate and marks the predicate loaded"""
+        for assoc in assoc_list:
+            self.add_association(assoc)
+        self.predicates.add(predicate)
+
+    # -------------------------------------------------------------------------
+    # Maintenance
+
+    def add_association(self, assoc):
+        if assoc.p == PRED.hasSite:
+            old_parent = self.site_parents.get(assoc.o, None)
+            if old_parent:
+                self._invalidate_sites(old_parent[1], assoc.o)
+                self._remove_from(self.site_children, old_parent[1], assoc.o)
+            self._invalidate_sites(assoc.s, assoc.o)
+            self.site_parents[assoc.o] = (assoc.ot, assoc.s, assoc.st)
+            self.site_children.setdefault(assoc.s, []).append(assoc.o)
+        elif assoc.p == PRED.hasDevice:
+            if assoc.st in (RT.PlatformSite, RT.InstrumentSite):
+                self.site_devices[assoc.s] = (assoc.st, assoc.o, assoc.ot)
+            if assoc.st in self.DEVICE_TYPES and assoc.ot in self.DEVICE_TYPES:
+                self._invalidate_devices(assoc.s, assoc.o)
+                self.device_parents.setdefault(assoc.o, []).append(assoc.s)
+                self.device_children.setdefault(assoc.s, []).append((assoc.st, assoc.o, assoc.ot))
+        elif assoc.p == PRED.hasSource:
+            if assoc.st == RT.DataProduct:
+                self.data_products.setdefault(assoc.o, []).append(assoc.s)
+
+    def remove_association(self, assoc):
+        if assoc.p == PRED.hasSite:
+            if self.site_parents.get(assoc.o, (None, None, None))[1] == assoc.s:
+                self._invalidate_sites(assoc.s, assoc.o)
+                del self.site_parents[assoc.o]
+                self._remove_from(self.site_children, assoc.s, assoc.o)
+        elif assoc.p == PRED.hasDevice:
+            if self.site_devices.get(assoc.s, (None, None, None))[1] == assoc.o:
+                del self.site_devices[assoc.s]
+            if assoc.s in self.device_children:
+                self._invalidate_devices(assoc.s, assoc.o)
+                self._remove_from(self.device_children, assoc.s, (assoc.st, assoc.o, assoc.ot))
+                self._remove_from(self.device_parents, assoc.o, assoc.s)
+        elif assoc.p == PRED.hasSource:
+            self._remove_from(self.data_products, assoc.o, assoc.s)
+
+    def _remove_from(self, list_dict, key, value):
+        values = list_dict.get(key, None)
+        if values and value in values:
+            values.remove(value)
+            if not values:
+                del list_dict[key]
+
+    def _invalidate_sites(self, parent_id, child_id):
+        """Drops the cached sets that change when the edge parent_id -> child_id changes"""
+        if self._site_descendants:
+            for site_id in [parent_id] + list(self.get_site_ancestors(parent_id)):
+                self._site_descendants.pop(site_id, None)
+        if self._site_ancestors:
+            for site_id in [child_id] + list(self.get_site_descendants(child_id)):
+                self._site_ancestors.pop(site_id, None)
+
+    def _invalidate_devices(self, parent_id, child_id):
+        if self._device_descendants:
+            for device_id in [parent_id] + list(self.get_device_ancestors(parent_id)):
+                self._device_descendants.pop(device_id, None)
+        if self._device_ancestors:
+            for device_id in [child_id] + list(self.get_device_descendants(child_id)):
+                self._device_ancestors.pop(device_id, None)
+
+    # -------------------------------------------------------------------------
+    # Queries
+
+    def get_site_type(self, site_id):
+        return self.site_parents.get(site_id, (None, None, None))[0]
+
+    def get_parent_site(self, site_id):
+        return self.site_parents.get(site_id, (None, None, None))[1]
+
+    def get_child_sites(self, site_id):
+        return self.site_children.get(site_id, [])
+
+    def get_site_device(self, site_id):
+        """Returns (site type, device_id, device type) for the site's device or None"""
+        return self.site_devices.get(site_id, None)
+
+    def get_child_devices(self, device_id):
+        """Returns list of (parent type, child device_id, child type) tuples"""
+        return self.device_children.get(device_id, [])
+
+    def get_data_products(self, res_id):
+        return self.data_products.get(res_id, None)
+
+    def get_site_ancestors(self, site_id):
+        parent_ids = lambda res_id: [self.get_parent_site(res_id)] if res_id in self.site_parents else []
+        return self._closure(self._site_ancestors, site_id, parent_ids)
+
+    def get_site_descendants(self, site_id):
+        return self._closure(self._site_descendants, site_id, self.get_child_sites)
+
+    def get_device_ancestors(self, device_id):
+        return self._closure(self._device_ancestors, device_id, lambda res_id: self.device_parents.get(res_id, []))
+
+    def get_device_descendants(self, device_id):
+        return self._closure(self._device_descendants, device_id,
+                             lambda res_id: [ch_id for _,ch_id,_ in self.get_child_devices(res_id)])
+
+    def _closure(self, cache, res_id, next_ids):
+        """Returns the set of ids reachable from res_id, computed once and kept in cache"""
+        try:
+            return cache[res_id]
+        except KeyError:
+            pass
+        found, stack = set(), [res_id]
+        while stack:
+            for next_id in next_ids(stack.pop()):
+                if next_id not in found and next_id != res_id:
+                    found.add(next_id)
+                    stack.append(next_id)
+        cache[res_id] = frozenset(found)
+        return cache[res_id]
+
+    # -------------------------------------------------------------------------
+    # Container-level index
+
+    @classmethod
+    def get_shared(cls, container):
+        """Returns the index shared by all users in the container, starting an empty one if necessary"""
+        index = cls._shared.get(container, None)
+        if index is None or time.time() - index.created > cls.MAX_AGE:
+            cls._start_listener(container)
+            index = cls()
+            cls._shared[container] = index
+        return index
+
+    @classmethod
+    def invalidate(cls):
+        cls._shared.clear()
+
+    @classmethod
+    def _on_resource_modified(cls, event, *args, **kwargs):
+        if event.origin_type in cls.SITE_TYPES or event.origin_type in cls.DEVICE_TYPES or event.origin_type == RT.DataProduct:
+            log.debug("Invalidating hierarchy index: %s %s (%s)", event.origin_type, event.origin, event.sub_type)
+            cls.invalidate()
+
+    @classmethod
+    def _start_listener(cls, container):
+        """Subscribes to resource modifications once per container, a restarted container gets its own"""
+        if container in cls._subscribers or container is None or container is not bootstrap.container_instance:
+            return
+        subscriber = EventSubscriber(event_type=OT.ResourceModifiedEvent,
+                                     callback=cls._on_resource_modified,
+                                     auto_delete=True)
+        subscriber.start()
+        cls._subscribers[container] = subscriber
+
 
 class ObservatoryUtil(object):
-    def __init__(self, process=None, container=None, enhanced_rr=None, device_status_mgr=None):
+    def __init__(self, process=None, container=None, enhanced_rr=None, device_status_mgr=None, shared_cache=False):
         self.process = process
         self.container = container or bootstrap.container_instance
         self.RR2 = enhanced_rr
         self.RR = enhanced_rr or self.container.resource_registry if self.container else None
         self.device_status_mgr = device_status_mgr
+        self.shared_cache = shared_cache
+        self._hierarchy_index = None
 
 
     # -------------------------------------------------------------------------
@@ -25,6 +222,7 @@ class ObservatoryUtil(object):
 
     def _set_enhanced_rr(self, enhanced_rr=None):
         self.RR2 = enhanced_rr
+        self._hierarchy_index = None
 
     def _get_predicate_assocs(self, predicate):
         if self.RR2:
@@ -35,6 +233,26 @@ class ObservatoryUtil(object):
             assoc_list = self.container.resource_registry.find_associations(predicate=predicate, id_only=False)
         return assoc_list
 
+    def _get_hierarchy_index(self, predicate, assoc_list=None):
+        """
+        Returns a hierarchy index with all associations of predicate loaded.
+        The index is kept for this instance, or with shared_cache the container-level index
+        is used, which can be up to HierarchyIndex.MAX_AGE seconds behind association changes.
+        """
+        if assoc_list:
+            return HierarchyIndex(assoc_list)
+        if self.shared_cache:
+            index = HierarchyIndex.get_shared(self.container)
+        else:
+            if self._hierarchy_index is None:
+                self._hierarchy_index = HierarchyIndex()
+            index = self._hierarchy_index
+        if predicate not in index.predicates:
+            assoc_list = self._get_predicate_assocs(predicate)
+            if predicate not in index.predicates:
+                index.load(predicate, assoc_list)
+        return index
+
     def _find_objects(self, subject, predicate, object_type='', id_only=False):
         if self.RR2:
             return self.RR2.find_objects(subject, predicate, object_type, id_only=id_only), None
@@ -59,60 +277,53 @@ class ObservatoryUtil(object):
         if exclude_types is None:
             exclude_types = []
 
-        parents = self._get_site_parents()   # Note: root elements are not in list
+        index = self._get_hierarchy_index(PRED.hasSite)
 
         if org_id:
             obsite_ids,_ = self._find_objects(org_id, PRED.hasResource, RT.Observatory, id_only=True)
             if not obsite_ids:
                 return {}, {}
             parent_site_id = org_id
-            for obsite_id in obsite_ids:
-                parents[obsite_id] = ('Observatory', org_id, 'Org')
+            child_sites = [(obsite_id, RT.Observatory) for obsite_id in obsite_ids]
         elif parent_site_id:
-            if parent_site_id not in parents:
-                parents[parent_site_id] = ('Observatory', None, 'Org')
+            child_sites = [(site_id, index.get_site_type(site_id)) for site_id in index.get_child_sites(parent_site_id)]
         else:
             raise BadRequest("Must provide either parent_site_id or org_id")
 
         matchlist = []  # sites with wanted parent
         ancestors = {}  # child ids for sites in result set
-        for site_id, (st, parent_id, pt) in parents.iteritems():
-            # Iterate through sites and find the ones with a wanted parent
-            if st in exclude_types:
-                continue
-            parent_stack = [site_id, parent_id]
-            while parent_id:
-                # Walk up to parents
-                if parent_id == parent_site_id:
-                    matchlist.append(site_id)
-                    # Fill out ancestors
-                    par = parent_stack.pop()
-                    while parent_stack:
-                        ch = parent_stack.pop()
-                        if par not in ancestors:
-                            ancestors[par] = []
-                        if ch not in ancestors[par]:
-                            ancestors[par].append(ch)
-                        par = ch
-                    parent_id = None
-                else:
-                    _,parent_id,_ = parents.get(parent_id, (None,None,None))
-                    parent_stack.append(parent_id)
+        visited = set([parent_site_id])
+
+        def add_child_sites(site_id, child_sites):
+            """Walk down from site_id. Returns True if any site below was matched"""
+            found = False
+            for ch_id, st in child_sites:
+                if ch_id in visited:
+                    continue
+                visited.add(ch_id)
+                matched = st not in exclude_types
+                if matched:
+                    matchlist.append(ch_id)
+                grandchild_sites = [(gch_id, index.get_site_type(gch_id)) for gch_id in index.get_child_sites(ch_id)]
+                if add_child_sites(ch_id, grandchild_sites) or matched:
+                    # Fill out ancestors along the path to matched sites
+                    ancestors.setdefault(site_id, []).append(ch_id)
+                    found = True
+            return found
+
+        add_child_sites(parent_site_id, child_sites)
 
         # Go all the way up to the roots
         if include_parents:
             matchlist.append(parent_site_id)
             child_id = parent_site_id
-            parent = parents.get(child_id, None)
-            while parent:
-                st, parent_id, pt = parent
-                if parent_id:
-                    matchlist.append(parent_id)
-                    if parent_id not in ancestors:
-                        ancestors[parent_id] = []
-                    ancestors[parent_id].append(child_id)
+            parent_id = index.get_parent_site(child_id) if not org_id else None
+            while parent_id and parent_id not in visited:
+                visited.add(parent_id)
+                matchlist.append(parent_id)
+                ancestors.setdefault(parent_id, []).append(child_id)
                 child_id = parent_id
-                parent = parents.get(child_id, None)
+                parent_id = index.get_parent_site(child_id)
 
         if id_only:
             child_site_dict = dict(zip(matchlist, [None]*len(matchlist)))
@@ -122,33 +333,21 @@ class ObservatoryUtil(object):
 
         return child_site_dict, ancestors
 
-    def _get_site_parents(self):
-        """Returns a dict mapping a site_id to site type and parent site_id."""
-        # This function makes one RR call retrieving all hasSite associations.
-        # @TODO: see if this can be done with an id_only=False argument
-        parents = {}
-        assoc_list = self._get_predicate_assocs(PRED.hasSite)
-        for assoc in assoc_list:
-            parents[assoc.o] = (assoc.ot, assoc.s, assoc.st)
-        return parents
-
     def get_device_relations(self, site_list):
         """
         Returns a dict of site_id or device_id mapped to list of (site/device type, device_id, device type)
         tuples, or None, based on hasDevice associations.
         This is a combination of 2 results: site->device(primary) and device(parent)->device(child)
         """
-        assoc_list = self._get_predicate_assocs(PRED.hasDevice)
-
         res_dict = {}
 
-        site_devices = self.get_site_devices(site_list, assoc_list=assoc_list)
+        site_devices = self.get_site_devices(site_list)
         res_dict.update(site_devices)
 
         # Add information for each device
         device_ids = [tuple_list[0][1] for tuple_list in site_devices.values() if tuple_list]
         for device_id in device_ids:
-            res_dict.update(self.get_child_devices(device_id, assoc_list=assoc_list))
+            res_dict.update(self.get_child_devices(device_id))
 
         return res_dict
 
@@ -157,62 +356,23 @@ class ObservatoryUtil(object):
         Returns a dict of site_id mapped to a list of (site type, device_id, device type) tuples,
         based on hasDevice association for given site_list.
         """
-        site_devices = self._get_site_devices(assoc_list=assoc_list)
+        index = self._get_hierarchy_index(PRED.hasDevice, assoc_list)
         res_sites = {}
         for site_id in site_list:
-            sd_tup = site_devices.get(site_id, None)
+            sd_tup = index.get_site_device(site_id)
             res_sites[site_id] = [sd_tup] if sd_tup else []
         return res_sites
 
-    def _get_site_devices(self, assoc_list=None):
-        """
-        Returns a dict of site_id mapped to a list of (site type, device_id, device type) tuples,
-        based on hasDevice association for all sites.
-        """
-        sites = {}
-        if not assoc_list:
-            assoc_list = self._get_predicate_assocs(PRED.hasDevice)
-        for assoc in assoc_list:
-            if assoc.st in [RT.PlatformSite, RT.InstrumentSite]:
-                sites[assoc.s] = (assoc.st, assoc.o, assoc.ot)
-        return sites
-
     def get_child_devices(self, device_id, assoc_list=None):
         """Returns a dict of keys device_id and all children of device_id to
         lists of 3-tuples (parent type, child id, child type
         """
-        child_devices = self._get_child_devices(assoc_list=assoc_list)
-        all_children = set([device_id])
-        def add_children(dev_id):
-            ch_list = child_devices.get(dev_id, [])
-            for _,ch_id,_ in ch_list:
-                all_children.add(ch_id)
-                add_children(ch_id)
-        add_children(device_id)
-        for dev_id in list(child_devices.keys()):
-            if dev_id not in all_children:
-                del child_devices[dev_id]
-        for dev_id in all_children:
-            if dev_id not in child_devices:
-                child_devices[dev_id] = []
+        index = self._get_hierarchy_index(PRED.hasDevice, assoc_list)
+        child_devices = {device_id: list(index.get_child_devices(device_id))}
+        for dev_id in index.get_device_descendants(device_id):
+            child_devices[dev_id] = list(index.get_child_devices(dev_id))
         return child_devices
 
-    def _get_child_devices(self, assoc_list=None):
-        """
-        Returns a dict mapping a device_id to parent type, child device_id, child type based on hasDevice association.
-        """
-        sites = {}
-        if not assoc_list:
-            assoc_list = self._get_predicate_assocs(PRED.hasDevice)
-        for assoc in assoc_list:
-            if assoc.st in [RT.PlatformDevice, RT.InstrumentDevice] and assoc.ot in [RT.PlatformDevice, RT.InstrumentDevice]:
-                if assoc.s not in sites:
-                    sites[assoc.s] = []
-                sites[assoc.s].append((assoc.st, assoc.o, assoc.ot))
-        return sites
-
-
-
     def get_site_root(self, res_id, site_parents=None, ancestors=None):
         if ancestors:
             site_parents = {}
@@ -238,24 +398,13 @@ class ObservatoryUtil(object):
         """
         Returns a dict of resource id mapped to data product id based on hasSource association.
         """
-        device_dps = self._get_data_products_by_source(assoc_list=assoc_list)
+        index = self._get_hierarchy_index(PRED.hasSource, assoc_list)
         res_dps = {}
-        for dev_id in res_list:
-            res_dps[dev_id] = device_dps.get(dev_id, None)
+        for res_id in res_list:
+            dp_list = index.get_data_products(res_id)
+            res_dps[res_id] = list(dp_list) if dp_list is not None else None
         return res_dps
 
-    def _get_data_products_by_source(self, assoc_list=None):
-        """
-        Returns a dict of resource_id (site/device) mapped to data product id based on hasSource association.
-        """
-        data_products = {}
-        if not assoc_list:
-            assoc_list = self._get_predicate_assocs(PRED.hasSource)
-        for assoc in assoc_list:
-            if assoc.st == RT.DataProduct:
-                data_products.setdefault(assoc.o, []).append(assoc.s)
-        return data_products
-
     def get_site_data_products(self, res_id, res_type=None, include_sites=False, include_devices=False, include_data_products=False):
         """
         Determines efficiently all data products for the given site and child sites.
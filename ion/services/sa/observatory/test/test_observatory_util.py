@@ -3,13 +3,14 @@
 __author__ = 'Michael Meisinger'
 
 import unittest
+from mock import Mock, patch
 from nose.plugins.attrib import attr
 
-from pyon.public import RT, log
+from pyon.public import RT, PRED, IonObject, log
 from pyon.util.unit_test import IonUnitTestCase
 
 from ion.services.sa.observatory.mockutil import MockUtil
-from ion.services.sa.observatory.observatory_util import ObservatoryUtil
+from ion.services.sa.observatory.observatory_util import ObservatoryUtil, HierarchyIndex
 
 from interface.objects import DeviceStatusType, DeviceCommsType, AggregateStatusType
 DST = DeviceStatusType
@@ -469,3 +470,68 @@ class TestObservatoryUtil(IonUnitTestCase):
         ['DP_4', 'hasSource', 'PD_1'],
         ['DP_5', 'hasSource', 'PD_1'],
         ]
+
+    def test_hierarchy_index(self):
+        self.mu.load_mock_resources(self.res_list + self.res_list1)
+        self.mu.load_mock_associations(self.assoc_list + self.assoc_list1 + self.assoc_list2 + self.assoc_list3)
+
+        index = HierarchyIndex(self.mu.associations)
+        self.assertEquals(index.get_site_descendants('Obs_1'), {'Sub_1', 'PS_1', 'IS_1'})
+        self.assertEquals(index.get_site_ancestors('IS_1'), {'PS_1', 'Sub_1', 'Obs_1'})
+        self.assertEquals(index.get_device_descendants('PD_1'), {'ID_1'})
+        self.assertEquals(index.get_device_ancestors('ID_1'), {'PD_1'})
+        self.assertEquals(index.get_site_device('IS_1'), ('InstrumentSite', 'ID_1', 'InstrumentDevice'))
+        self.assertEquals(sorted(index.get_data_products('PD_1')), ['DP_3', 'DP_4', 'DP_5'])
+
+        # Moving a subtree updates the cached sets on both sides
+        assoc = [a for a in self.mu.associations if a.s == 'Sub_1' and a.o == 'PS_1'][0]
+        index.remove_association(assoc)
+        self.assertEquals(index.get_site_descendants('Obs_1'), {'Sub_1'})
+        self.assertEquals(index.get_site_ancestors('IS_1'), {'PS_1'})
+
+        index.add_association(IonObject('Association', s='Sub_2', st=RT.Subsite, p=PRED.hasSite, o='PS_1', ot=RT.PlatformSite))
+        self.assertEquals(index.get_site_descendants('Obs_2'), {'Sub_2', 'PS_1', 'IS_1'})
+        self.assertEquals(index.get_site_ancestors('IS_1'), {'PS_1', 'Sub_2', 'Obs_2'})
+
+        assoc = [a for a in self.mu.associations if a.s == 'PD_1' and a.o == 'ID_1'][0]
+        index.remove_association(assoc)
+        self.assertEquals(index.get_device_descendants('PD_1'), set())
+        self.assertEquals(index.get_child_devices('PD_1'), [])
+
+    def test_shared_hierarchy_index(self):
+        self.mu.load_mock_resources(self.res_list)
+        self.mu.load_mock_associations(self.assoc_list)
+        HierarchyIndex.invalidate()
+        find_associations = self.container_mock.resource_registry.find_associations
+
+        # Without shared_cache every instance reads the associations
+        ObservatoryUtil(self.process_mock, self.container_mock).get_child_sites(parent_site_id='Obs_1')
+        ObservatoryUtil(self.process_mock, self.container_mock).get_child_sites(parent_site_id='Obs_1')
+        self.assertEquals(find_associations.call_count, 2)
+
+        # Associations are read once for all shared queries in the container
+        self.obs_util = ObservatoryUtil(self.process_mock, self.container_mock, shared_cache=True)
+        self.obs_util.get_child_sites(parent_site_id='Obs_1')
+        site_resources, _ = ObservatoryUtil(self.process_mock, self.container_mock, shared_cache=True).get_child_sites(parent_site_id='Sub_1', include_parents=False)
+        self.assertEquals(set(site_resources), {'PS_1', 'IS_1'})
+        self.assertEquals(find_associations.call_count, 3)
+
+        # Site modifications drop the index
+        HierarchyIndex._on_resource_modified(Mock(origin='Sub_1', origin_type=RT.Subsite, sub_type='UPDATE'))
+        self.obs_util.get_child_sites(parent_site_id='Obs_1')
+        self.assertEquals(find_associations.call_count, 4)
+
+    def test_hierarchy_listener_per_container(self):
+        old_container, new_container = Mock(), Mock()
+        with patch('ion.services.sa.observatory.observatory_util.EventSubscriber') as subscriber, \
+                patch('ion.services.sa.observatory.observatory_util.bootstrap') as bootstrap:
+            bootstrap.container_instance = old_container
+            HierarchyIndex._start_listener(old_container)
+            HierarchyIndex._start_listener(old_container)
+            self.assertEquals(subscriber.call_count, 1)
+
+            # A restarted container subscribes again
+            bootstrap.container_instance = new_container
+            HierarchyIndex._start_listener(new_container)
+            self.assertEquals(subscriber.call_count, 2)
+        HierarchyIndex._subscribers.clear()
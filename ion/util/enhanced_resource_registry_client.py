@@ -3,19 +3,64 @@
 __author__ = 'Ian Katz, Michael Meisinger'
 
 import re
+import time
+import weakref
 from ooi import logging
 from ooi.logging import log
 
 from pyon.util.containers import get_ion_ts, DotDict
+from pyon.core import bootstrap
+from pyon.core.bootstrap import CFG
 from pyon.core.exception import BadRequest, Inconsistent, NotFound
 from pyon.core.registry import getextends
-from pyon.ion.resource import LCE, RT, PRED
+from pyon.ion.event import EventSubscriber
+from pyon.ion.resource import LCE, RT, PRED, OT
 from pyon.util.config import Config
 
 # Common resource type and association definitions
 errc_lookups = None
 
 
+class CachedAssociations(object):
+    """
+    The cached associations of one predicate, indexed by subject id, object id and (subject type, object type),
+    so lookups are hash probes instead of scans over all associations of the predicate.
+    Instances are not modified after creation and can be shared between clients.
+    """
+
+    def __init__(self, assocs):
+        self.assocs = assocs
+        self.by_subject = {}
+        self.by_object = {}
+        self.by_types = {}
+        self.created = time.time()
+        for a in assocs:
+            self.by_subject.setdefault(a.s, []).append(a)
+            self.by_object.setdefault(a.o, []).append(a)
+            self.by_types.setdefault((a.st, a.ot), []).append(a)
+
+    def __len__(self):
+        return len(self.assocs)
+
+    def find(self, subject_id=None, object_id=None, subject_type='', object_type=''):
+        """
+        Returns the associations matching all given criteria, in the order they were cached
+        """
+        if subject_id is not None:
+            candidates = self.by_subject.get(subject_id, [])
+        elif object_id is not None:
+            candidates = self.by_object.get(object_id, [])
+        elif subject_type and object_type:
+            return list(self.by_types.get((subject_type, object_type), []))
+        else:
+            candidates = self.assocs
+
+        return [a for a in candidates
+                if (object_id is None or object_id == a.o)
+                and ("" == subject_type or subject_type == a.st)
+                and ("" == object_type or object_type == a.ot)]
+
+
 class EnhancedResourceRegistryClient(object):
     """
     This class provides enhanced resource registry client functionality by wrapping the "real" client.
@@ -54,10 +99,18 @@ class EnhancedResourceRegistryClient(object):
      find method name can include "_using_has_model" ("_using_", and the predicate type with underscores)
     """
 
-    def __init__(self, rr_client):
+    # Associations cached with shared_cache=True are reused by all clients in the container until they are
+    # older than this or a resource modification is seen
+    SHARED_CACHE_MAX_AGE = CFG.get_safe('container.association_cache.max_age', 60)
+
+    _shared_predicates = weakref.WeakKeyDictionary()  # container -> {predicate: CachedAssociations}
+    _shared_subscribers = weakref.WeakKeyDictionary()  # container -> ResourceModifiedEvent subscriber
+
+    def __init__(self, rr_client, shared_cache=False):
         self.id = id(self)
         log.debug("EnhancedResourceRegistryClient init")
         self.RR = rr_client
+        self.shared_cache = shared_cache
 
         global errc_lookups
         if not errc_lookups:
@@ -66,11 +119,14 @@ class EnhancedResourceRegistryClient(object):
 
         self._cached_dynamics = {}
 
-        self._cached_predicates = {}
         self._cached_predicates = {}
         self._cached_resources = {}
         self._all_cached_resources = {}
 
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.shared_cache_hits = 0
+
         log.debug("done init")
 
     @classmethod
@@ -310,6 +366,7 @@ class EnhancedResourceRegistryClient(object):
 
         # Note: delete automatically retires associations
         self.RR.delete(resource_id)
+        self.invalidate_shared_cache()
 
 
     def delete_association(self, subject_id='', association_type='', object_id=''):
@@ -327,6 +384,7 @@ class EnhancedResourceRegistryClient(object):
                                         predicate=association_type,
                                         object=object_id)
         self.RR.delete_association(assoc)
+        self.invalidate_shared_cache(association_type)
 
 
     def find_resource_by_name(self, resource_type, name, id_only=False):
@@ -367,6 +425,7 @@ class EnhancedResourceRegistryClient(object):
         object_id, object_type = self._extract_id_and_type(object)
 
         if not self.has_cached_predicate(predicate):
+            self.cache_misses += 1
             ret, _ = self.RR.find_subjects(subject_type=subject_type,
                                            predicate=predicate,
                                            object=object_id,
@@ -375,26 +434,8 @@ class EnhancedResourceRegistryClient(object):
 
         log.debug("Using %s cached results for 'find (%s) subjects'", len(self._cached_predicates[predicate]), predicate)
 
-        def filter_fn(assoc):
-            if object != assoc.o:
-                return False
-
-            if "" != subject_type and subject_type != assoc.st:
-                return False
-
-            return True
-
         log.debug("Checking object_id=%s, subject_type=%s", object_id, subject_type)
-        preds = self._cached_predicates[predicate]
-        time_search_start = get_ion_ts()
-        subject_ids = [a.s for a in self.filter_cached_associations(predicate, filter_fn)]
-        time_search_stop = get_ion_ts()
-        total_time = int(time_search_stop) - int(time_search_start)
-        log.debug("Processed %s %s predicates for %s subjects in %s seconds",
-                 len(preds),
-                 predicate,
-                 len(subject_ids),
-                 total_time / 1000.0)
+        subject_ids = [a.s for a in self.find_cached_associations(predicate, object=object_id, subject_type=subject_type)]
 
 
         if id_only:
@@ -408,6 +449,7 @@ class EnhancedResourceRegistryClient(object):
         subject_id, subject_type = self._extract_id_and_type(subject)
 
         if not self.has_cached_predicate(predicate):
+            self.cache_misses += 1
             ret, _ = self.RR.find_objects(subject=subject_id,
                                          predicate=predicate,
                                          object_type=object_type,
@@ -416,26 +458,8 @@ class EnhancedResourceRegistryClient(object):
 
         log.debug("Using %s cached results for 'find (%s) objects'", len(self._cached_predicates[predicate]), predicate)
 
-        def filter_fn(assoc):
-            if subject_id != assoc.s:
-                return False
-
-            if "" != object_type and object_type != assoc.ot:
-                return False
-
-            return True
-
         log.debug("Checking subject_id=%s, object_type=%s", subject_id, object_type)
-        preds = self._cached_predicates[predicate]
-        time_search_start = get_ion_ts()
-        object_ids = [a.o for a in self.filter_cached_associations(predicate, filter_fn)]
-        time_search_stop = get_ion_ts()
-        total_time = int(time_search_stop) - int(time_search_start)
-        log.debug("Processed %s %s predicates for %s objects in %s seconds",
-                  len(preds),
-                  predicate,
-                  len(object_ids),
-                  total_time / 1000.0)
+        object_ids = [a.o for a in self.find_cached_associations(predicate, subject=subject_id, object_type=object_type)]
 
         if id_only:
             return object_ids
@@ -516,6 +540,7 @@ class EnhancedResourceRegistryClient(object):
 
         for a in associations:
             self.RR.delete_association(a)
+        self.invalidate_shared_cache(association_type)
 
 
     def delete_subject_associations(self, association_type='', object_id=''):
@@ -529,6 +554,7 @@ class EnhancedResourceRegistryClient(object):
 
         for a in associations:
             self.RR.delete_association(a)
+        self.invalidate_shared_cache(association_type)
 
 
     def advance_lcs(self, resource_id, transition_event):
@@ -563,6 +589,14 @@ class EnhancedResourceRegistryClient(object):
             #log.debug("Reusing prior cached predicate %s", predicate)
             return
 
+        if self.shared_cache:
+            cached = self._get_shared_predicate(predicate)
+            if cached is not None:
+                log.debug("Reusing shared cached predicate %s with %s associations", predicate, len(cached))
+                self.shared_cache_hits += 1
+                self._cached_predicates[predicate] = cached
+                return
+
         time_caching_start = get_ion_ts()
         preds = self.RR.find_associations(predicate=predicate, id_only=False)
         time_caching_stop = get_ion_ts()
@@ -570,17 +604,98 @@ class EnhancedResourceRegistryClient(object):
         total_time = int(time_caching_stop) - int(time_caching_start)
 
         log.debug("Cached predicate %s with %s resources in %s seconds", predicate, len(preds), total_time / 1000.0)
-        self._cached_predicates[predicate] = preds
+        cached = CachedAssociations(preds)
+        self._cached_predicates[predicate] = cached
+        if self.shared_cache:
+            shared = self._get_shared_cache()
+            if shared is not None:
+                shared[predicate] = cached
 
 
     def filter_cached_associations(self, predicate, is_match_fn):
         if not self.has_cached_predicate(predicate):
             raise BadRequest("Attempted to filter cached associations of uncached predicate '%s'" % predicate)
 
-        return [a for a in self._cached_predicates[predicate] if is_match_fn(a)]
+        self.cache_hits += 1
+        return [a for a in self._cached_predicates[predicate].assocs if is_match_fn(a)]
+
+    def find_cached_associations(self, predicate, subject=None, object=None, subject_type='', object_type=''):
+        """
+        Returns the cached associations of a predicate matching the given subject/object ids and types,
+        using the indexes of the cache instead of a scan
+        """
+        if not self.has_cached_predicate(predicate):
+            raise BadRequest("Attempted to find cached associations of uncached predicate '%s'" % predicate)
+
+        self.cache_hits += 1
+        return self._cached_predicates[predicate].find(subject_id=subject, object_id=object,
+                                                       subject_type=subject_type, object_type=object_type)
 
     def get_cached_associations(self, predicate):
-        return self.filter_cached_associations(predicate, lambda x: True)
+        return self.find_cached_associations(predicate)
+
+    def cache_stats(self):
+        """
+        Returns the lookup counts of this client. Misses are lookups on uncached predicates that went to the RR
+        """
+        lookups = self.cache_hits + self.cache_misses
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_rate': float(self.cache_hits) / lookups if lookups else 0.0,
+                'shared_hits': self.shared_cache_hits,
+                'predicates': len(self._cached_predicates)}
+
+    @classmethod
+    def _get_shared_cache(cls):
+        """
+        Returns the shared cached associations by predicate of the running container, None without a container
+        """
+        container = bootstrap.container_instance
+        if container is None:
+            return None
+        cls._start_shared_listener(container)
+        return cls._shared_predicates.setdefault(container, {})
+
+    @classmethod
+    def _get_shared_predicate(cls, predicate):
+        shared = cls._get_shared_cache()
+        if shared is None:
+            return None
+        cached = shared.get(predicate, None)
+        if cached is not None and time.time() - cached.created > cls.SHARED_CACHE_MAX_AGE:
+            del shared[predicate]
+            cached = None
+        return cached
+
+    @classmethod
+    def invalidate_shared_cache(cls, predicate=None):
+        """
+        Drops the shared cached associations of a predicate, or of all predicates if none is given
+        """
+        for shared in cls._shared_predicates.values():
+            if not predicate:
+                shared.clear()
+            else:
+                shared.pop(predicate, None)
+
+    @classmethod
+    def _on_resource_modified(cls, event, *args, **kwargs):
+        if any(cls._shared_predicates.values()):
+            log.debug("Invalidating shared association cache: %s %s (%s)", event.origin_type, event.origin, event.sub_type)
+            cls.invalidate_shared_cache()
+
+    @classmethod
+    def _start_shared_listener(cls, container):
+        """
+        Subscribes to resource modifications once per container, a restarted container gets its own
+        """
+        if container in cls._shared_subscribers:
+            return
+        subscriber = EventSubscriber(event_type=OT.ResourceModifiedEvent,
+                                     callback=cls._on_resource_modified,
+                                     auto_delete=True)
+        subscriber.start()
+        cls._shared_subscribers[container] = subscriber
 
     def _add_resource_to_cache(self, resource_type, resource_obj):
         self._cached_resources[resource_type].by_id[resource_obj._id] = resource_obj
@@ -790,6 +905,7 @@ class EnhancedResourceRegistryClient(object):
                 log.debug("Dynamically creating association %s -> %s -> %s", isubj, ipred, iobj)
                 log.debug("%s -> %s -> %s", subj_id, ipred, obj_id)
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self.invalidate_shared_cache(ipred)
 
             return ret_fn
 
@@ -833,6 +949,7 @@ class EnhancedResourceRegistryClient(object):
                         return
 
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self.invalidate_shared_cache(ipred)
 
             return ret_fn
 
@@ -878,6 +995,7 @@ class EnhancedResourceRegistryClient(object):
                         return
 
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self.invalidate_shared_cache(ipred)
 
             return ret_fn
 
@@ -12,7 +12,10 @@ from coverage_model.parameter_types import QuantityType,ConstantRangeType,ArrayT
 from coverage_model.parameter_types import CategoryType, BooleanType, ParameterFunctionType, SparseConstantType
 from coverage_model.parameter_functions import ParameterFunctionException
 from pyon.container.cc import Container
-from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.services.dm.utility.coverage_pool import CoveragePool
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.util.time_utils import TimeUtils
+from ion.util.time_index import time_windows
 from pydap.model import DatasetType,BaseType, GridType, SequenceType
 from pydap.handlers.lib import BaseHandler
 from pyon.public import CFG, PRED
@@ -20,6 +23,7 @@ import time
 import simplejson as json
 import collections
 import functools
+import itertools
 
 numpy_boolean = '?'
 numpy_integer_types = 'bhilqp'
@@ -29,6 +33,10 @@ numpy_complex = 'FDG'
 numpy_object = 'O'
 numpy_str = 'SUV'
 
+supported_types = (QuantityType, ConstantType, ConstantRangeType, BooleanType, CategoryType, ArrayType, RecordType, ParameterFunctionType, SparseConstantType)
+
+to_str = np.frompyfunc(str, 1, 1)
+
 def exception_wrapper(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -53,24 +61,23 @@ def request_profile(enabled=False):
 
 
 class Handler(BaseHandler):
-    CACHE_LIMIT = CFG.get_safe('server.pydap.cache_limit', 5)
-    CACHE_EXPIRATION = CFG.get_safe('server.pydap.cache_expiration', 5)
     REQUEST_LIMIT = CFG.get_safe('server.pydap.request_limit', 200) # MB
-    _coverages = collections.OrderedDict() # Cache has to be a class var because each handler is initialized per request
+    CHUNK_SIZE = CFG.get_safe('server.pydap.chunk_size', 100000) # Records per read
+    CACHE_LIMIT = CFG.get_safe('server.pydap.cache_limit', 1000) # Data products
+    _dataset_ids = collections.OrderedDict() # Cache has to be a class var because each handler is initialized per request
 
     extensions = re.compile(r'^.*[0-9A-Za-z\-]{32}',re.IGNORECASE)
 
     def __init__(self, filepath):
         self.filepath = filepath
 
-    def calculate_bytes(self, bitmask, parameter_num):
-        timesteps = np.sum(bitmask)
+    def calculate_bytes(self, timesteps, parameter_num):
         # Assume 8 bytes per variable per timestep
         count = 8 * parameter_num * timesteps
         return count
 
-    def is_too_large(self, bitmask, parameter_num):
-        requested = self.calculate_bytes(bitmask, parameter_num)
+    def is_too_large(self, timesteps, parameter_num):
+        requested = self.calculate_bytes(timesteps, parameter_num)
         return requested > (self.REQUEST_LIMIT * 1024**2)
 
     def get_numpy_type(self, data):
@@ -100,33 +107,34 @@ class Handler(BaseHandler):
     @classmethod
     def get_coverage(cls, data_product_id):
         '''
-        Memoization (LRU) of _get_coverage
+        Acquires the data product's coverage from the container's pool, the
+        caller releases it with CoveragePool.release
         '''
+        dataset_id = cls.get_dataset_id(data_product_id)
+        if dataset_id is None:
+            return None
+        result = CoveragePool.acquire(dataset_id, mode='r')
+        if result is not None:
+            result.value_caching = False
+        return result
+
+    @classmethod
+    def get_dataset_id(cls, data_product_id):
         if not data_product_id:
-            return
+            return None
         try:
-            result, ts = cls._coverages.pop(data_product_id)
-            if (time.time() - ts) > cls.CACHE_EXPIRATION:
-                result.close()
-                raise KeyError(data_product_id)
+            # Least recently used first
+            dataset_id = cls._dataset_ids.pop(data_product_id)
         except KeyError:
-            if data_product_id is None:
-                return None
             resource_registry = Container.instance.resource_registry
             dataset_ids, _ = resource_registry.find_objects(data_product_id, PRED.hasDataset, id_only=True)
-            if not dataset_ids: return None
-            dataset_id = dataset_ids[0]
-            result = DatasetManagementService._get_coverage(dataset_id, mode='r')
-            result.value_caching = False
-            ts = time.time()
-            if result is None:
+            if not dataset_ids:
                 return None
-            if len(cls._coverages) >= cls.CACHE_LIMIT:
-                key, value = cls._coverages.popitem(0)
-                coverage, ts = value
-                coverage.close(timeout=5)
-        cls._coverages[dataset_id] = result, ts
-        return result
+            dataset_id = dataset_ids[0]
+            if len(cls._dataset_ids) >= cls.CACHE_LIMIT:
+                cls._dataset_ids.popitem(0)
+        cls._dataset_ids[data_product_id] = dataset_id
+        return dataset_id
 
     def get_attrs(self, cov, name):
         pc = cov.get_parameter_context(name)
@@ -138,22 +146,6 @@ class Handler(BaseHandler):
             attrs['long_name'] = pc.display_name
         return attrs
 
-    def get_data(self,cov, name, bitmask):
-        #pc = cov.get_parameter_context(name)
-        try:
-            data = self.get_values(cov, name)
-            data[bitmask]
-            #data = cov._range_value[name][:][bitmask]
-        except ParameterFunctionException:
-            data = np.empty(cov.num_timesteps(), dtype='object')
-        data = np.asanyarray(data) 
-        if not data.shape:
-            data.shape = (1,)
-        return data
-    
-    def get_time_data(self, cov, slice_):
-        return self.get_data(cov, cov.temporal_parameter_name, slice_)
-
     def make_series(self, response, name, data, attrs, ttype):
         base_type = BaseType(name=name, data=data, type=ttype, attributes=attrs)
         #grid[dims[0]] = BaseType(name=dims[0], data=time_data, type=time_data.dtype.char, attributes=time_attrs, dimensions=dims, shape=time_data.shape)
@@ -178,124 +170,220 @@ class Handler(BaseHandler):
 
 
     def ndim_stringify(self, data):
-        retval = np.empty(data.shape[0], dtype='O')
+        '''
+        Joins the trailing dimensions of each record into a comma separated string
+        '''
         try:
-            if len(data.shape)>1:
-                for i in xrange(data.shape[0]):
-                    retval[i] = ','.join(map(lambda x : str(x), data[i].tolist()))
-                return retval
+            rows = to_str(data.reshape(data.shape[0], -1))
+            if not rows.shape[1]:
+                return np.asanyarray([''] * data.shape[0], dtype='O')
+            retval = rows[:,0]
+            for i in xrange(1, rows.shape[1]):
+                retval = retval + ',' + rows[:,i]
+            return retval
         except:
-            retval = np.asanyarray(['None' for d in data])
-        return retval
-
+            return np.asanyarray(['None' for d in data], dtype='O')
 
     def stringify(self, data):
-        retval = np.empty(data.shape, dtype='O')
         try:
-            for i,obj in enumerate(data):
-                retval[i] = str(obj)
+            return to_str(data).astype('O')
         except:
-            retval = np.asanyarray(['None' for d in data])
-        return retval
+            return np.asanyarray(['None' for d in data], dtype='O')
 
     def stringify_inplace(self, data):
         try:
-            for i,obj in enumerate(data):
-                data[i] = str(obj)
+            data[:] = to_str(data)
         except:
             data = np.asanyarray(['None' for d in data])
         return data
 
-    def get_bitmask(self, cov, fields, slices, selectors):
+    def range_stringify(self, data):
         '''
-        returns a bitmask appropriate to the values
+        Converts the (lower, upper) pairs of a constant range into lower_upper
         '''
-        bitmask = np.ones(cov.num_timesteps(), dtype=np.bool)
-        for selector in selectors:
-            field, operator, value = self.parse_selectors(selector)
-            if operator is None:
-                continue
-            values = self.get_values(cov, field)
+        try:
+            if data.shape == (2,):
+                return np.atleast_1d('_'.join([str(data[0]), str(data[1])]))
+            if len(data.shape) > 1:
+                return to_str(data[:,0]) + '_' + to_str(data[:,1])
+            return np.frompyfunc(lambda d : '_'.join([str(d[0]), str(d[1])]), 1, 1)(data)
+        except Exception:
+            return np.asanyarray(['None' for d in data])
+
+    def get_mask(self, data_dict, selectors):
+        '''
+        Returns a bitmask for the records of a window, or None if every record
+        is selected
+        '''
+        bitmask = None
+        for field, operator, value in selectors:
+            values = np.asanyarray(data_dict[field])
             expression = ' '.join(['values', operator, value])
-            bitmask = bitmask & ne.evaluate(expression)
-
+            mask = ne.evaluate(expression)
+            bitmask = mask if bitmask is None else bitmask & mask
         return bitmask
 
-    def get_values(self, cov, field):
-        data_dict = cov.get_parameter_values(param_names=[field], fill_empty_params=True, as_record_array=False).get_data()
-        data = data_dict[field]
-        return data
+    def parse_time_bounds(self, cov, selectors):
+        '''
+        Narrows the time segment from the selectors on the temporal parameter.
+        The selectors are still evaluated against each window, the bounds are
+        inclusive.
+        '''
+        start, end = None, None
+        time_name = cov.temporal_parameter_name
+        for field, operator, value in selectors:
+            if field != time_name:
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if operator in ('>', '>=', '=='):
+                start = value if start is None else max(start, value)
+            if operator in ('<', '<=', '=='):
+                end = value if end is None else min(end, value)
+        return start, end
 
-    def get_dataset(self, cov, fields, slices, selectors, dataset, response):
-        seq = SequenceType('data')
-        bitmask = self.get_bitmask(cov, fields, slices, selectors)
-        if self.is_too_large(bitmask, len(fields)):
-            log.error('Client request too large. \nFields: %s\nSelectors: %s', fields, selectors)
-            return
+    def time_windows(self, cov, start, end, dataset_id=None):
+        '''
+        Splits [start, end] into time segments of roughly CHUNK_SIZE records
+        '''
+        index = TimeUtils.get_time_index(dataset_id)
+        return time_windows(index, start, end, self.CHUNK_SIZE, cov.num_timesteps(), lambda: ReplayProcess._time_bounds(cov, dataset_id))
+
+    def read_window(self, cov, names, time_segment):
+        try:
+            return cov.get_parameter_values(param_names=names, time_segment=time_segment, fill_empty_params=True, as_record_array=False).get_data()
+        except ParameterFunctionException:
+            pass
+        # Read the parameters one at a time so a failing function only blanks its own column
+        data_dict = {}
+        for name in names:
+            try:
+                data_dict.update(cov.get_parameter_values(param_names=[name], time_segment=time_segment, fill_empty_params=True, as_record_array=False).get_data())
+            except ParameterFunctionException:
+                data_dict[name] = None
+        records = max([len(v) for v in data_dict.itervalues() if v is not None] or [0])
+        for name, values in data_dict.iteritems():
+            if values is None:
+                data_dict[name] = np.empty(records, dtype='object')
+        return data_dict
+
+    def iter_chunks(self, cov, fields, selectors, dataset_id=None):
+        '''
+        Reads the fields in bounded time windows and yields a dictionary of the
+        selected records of each window
+        '''
+        start, end = self.parse_time_bounds(cov, selectors)
+        names = list(fields)
+        names.extend(field for field, operator, value in selectors if field not in names)
+        for time_segment in self.time_windows(cov, start, end, dataset_id):
+            data_dict = self.read_window(cov, names, time_segment)
+            bitmask = self.get_mask(data_dict, selectors)
+            chunk = {}
+            for name in fields:
+                data = np.asanyarray(data_dict[name])
+                if not data.shape:
+                    data.shape = (1,)
+                if bitmask is not None and len(data) == len(bitmask):
+                    data = data[bitmask]
+                chunk[name] = data
+            del data_dict
+            yield chunk
+
+    def convert(self, pc, data):
+        if isinstance(pc.param_type, ConstantRangeType):
+            return self.range_stringify(data), 'S'
+        return self.filter_data(data)
+
+    def get_dataset(self, cov, fields, slices, selectors, dataset, response, dataset_id=None):
+        contexts = collections.OrderedDict()
         for name in fields:
             # Strip the data. from the field
             if name.startswith('data.'):
                 name = name[5:]
-            pc = cov.get_parameter_context(name)
             if re.match(r'.*_[a-z0-9]{32}', name):
                 continue # Let's not do this
             try:
-                data = self.get_data(cov, name, bitmask)
-                attrs  = self.get_attrs(cov, name)
-                if isinstance(pc.param_type, QuantityType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type, ConstantType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type, ConstantRangeType):
-                    #start = time.time()
-                    #convert to string
-                    try:
-                        #scalar case
-                        if data.shape == (2,):
-                            data = np.atleast_1d('_'.join([str(data[0]), str(data[1])]))
-                        else:
-                            for i,d in enumerate(data):
-                                f = [str(d[0]),str(d[1])]
-                                data[i] = '_'.join(f)
-                    except Exception, e:
-                        data = np.asanyarray(['None' for d in data])
-                    seq[name] = self.make_series(response, name, data, attrs, 'S')
-                elif isinstance(pc.param_type,BooleanType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type,CategoryType):
-                    data, dtype = self.filter_data(data)
-                    #start = time.time()
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type,ArrayType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type,RecordType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type, ParameterFunctionType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type, SparseConstantType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                #dataset[name] = self.make_series(response, name, data, attrs, dtype)
-#                elif param.is_coordinate and cov.temporal_parameter_name == name:
-#                        dataset[name] = BaseType(name=name, data=data, type=data.dtype.char, attributes=attrs, shape=data.shape)
-#                    else:
-#                        log.error("Unhandled parameter for parameter (%s) type: %s", name, pc.param_type.__class__.__name__)
-                    
+                pc = cov.get_parameter_context(name)
             except Exception, e:
                 log.exception('Problem reading cov %s %s', cov.name, e.__class__.__name__)
                 continue
-            dataset['data'] = seq
+            if isinstance(pc.param_type, supported_types):
+                contexts[name] = pc
+
+        selectors = [s for s in (self.parse_selectors(selector) for selector in selectors) if s[1] is not None]
+        chunks = self.iter_chunks(cov, contexts.keys(), selectors, dataset_id)
+        # The first window decides the DAP type of each column
+        first = next(chunks, None)
+        columns, dtypes = self.convert_chunk(cov, contexts, first or {}, {})
+        names = [name for name in contexts if name in columns]
+        # The records are read after the request returns the coverage to the pool, they hold their own reference
+        CoveragePool.retain(cov)
+        records = self.iter_records(cov, contexts, names, dtypes, columns, chunks, fields, selectors)
+        next(records)
+        seq = SequenceType('data', data=records)
+        for name in names:
+            seq[name] = self.make_series(response, name, None, self.get_attrs(cov, name), dtypes[name])
+        dataset['data'] = seq
         return dataset
 
+    def convert_chunk(self, cov, contexts, chunk, dtypes):
+        '''
+        Converts the columns of a window to their DAP types. Columns that fail
+        to convert are dropped from the first window and filled in later ones,
+        the types can't change once they've been announced.
+        '''
+        columns = {}
+        for name, data in chunk.iteritems():
+            try:
+                data, dtype = self.convert(contexts[name], data)
+                if name in dtypes and dtype != dtypes[name]:
+                    data = self.fill_column(contexts[name], dtypes[name], len(data))
+                columns[name] = data
+                dtypes.setdefault(name, dtype)
+            except Exception, e:
+                log.exception('Problem reading cov %s %s', cov.name, e.__class__.__name__)
+                if name in dtypes:
+                    columns[name] = self.fill_column(contexts[name], dtypes[name], len(data))
+        return columns, dtypes
+
+    def fill_column(self, pc, dtype, records):
+        if dtype == 'S':
+            return np.asanyarray(['None'] * records, dtype='O')
+        data = np.zeros(records, dtype=dtype)
+        try:
+            data[:] = pc.fill_value
+        except (TypeError, ValueError):
+            pass
+        return data
+
+    def iter_records(self, cov, contexts, names, dtypes, columns, chunks, fields, selectors):
+        '''
+        Yields the records of the sequence one window at a time, so only one
+        window of the selection is held in memory while the response is written.
+        The generator releases the coverage once it's finished or closed, the
+        caller primes it so that happens even if no record is ever read.
+        '''
+        try:
+            yield
+            records = 0
+            while columns:
+                window = [columns[name] for name in names]
+                records += max([len(c) for c in window] or [0])
+                if self.is_too_large(records, len(names)):
+                    log.error('Client request too large. \nFields: %s\nSelectors: %s', fields, selectors)
+                    raise RequestTooLargeError('Request exceeds %sMB' % self.REQUEST_LIMIT)
+                for record in itertools.izip(*window):
+                    yield record
+                del window
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                columns, _ = self.convert_chunk(cov, contexts, {name : chunk[name] for name in names}, dtypes)
+        finally:
+            CoveragePool.release(cov)
+
     def value_encoding_to_dap_type(self, value_encoding):
         if value_encoding is None:
             return 'S'
@@ -396,7 +484,12 @@ class Handler(BaseHandler):
     def parse_constraints(self, environ):
         base, data_product_id = os.path.split(self.filepath)
         coverage = self.get_coverage(data_product_id)
+        try:
+            return self.handle_request(environ, coverage, self.get_dataset_id(data_product_id))
+        finally:
+            CoveragePool.release(coverage)
 
+    def handle_request(self, environ, coverage, dataset_id):
         last_modified = formatdate(time.mktime(time.localtime(os.stat(self.filepath)[ST_MTIME])))
         environ['pydap.headers'].append(('Last-modified', last_modified))
 
@@ -418,7 +511,7 @@ class Handler(BaseHandler):
         if not fields:
             fields = all_vars
         if response == "dods":
-            dataset = self.get_dataset(coverage, fields, slices, selectors, dataset, response)
+            dataset = self.get_dataset(coverage, fields, slices, selectors, dataset, response, dataset_id)
 
         elif response in ('dds', 'das'):
             self.handle_dds(coverage, dataset, fields)
@@ -477,3 +570,6 @@ class Handler(BaseHandler):
 
 class TypeNotSupportedError(Exception):
     pass
+
+class RequestTooLargeError(Exception):
+    pass
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+@file ion/util/pydap/handlers/coverage/test/test_coverage_handler.py
+@description Unit tests for windowed reads in the PyDAP coverage handler
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.util.pydap.handlers.coverage.coverage_handler import Handler, RequestTooLargeError
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.util.time_index import TimeIndex
+from ion.util.time_utils import TimeUtils
+
+from coverage_model.parameter_types import QuantityType
+from mock import Mock, patch
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+class MockCoverage(object):
+    temporal_parameter_name = 'time'
+    name = 'mock'
+
+    def __init__(self, times):
+        self.times = np.asarray(times, dtype='float64')
+        self.reads = []
+
+    def num_timesteps(self):
+        return len(self.times)
+
+    def get_parameter_context(self, name):
+        context = Mock()
+        context.param_type = QuantityType(value_encoding=np.dtype('float64'))
+        return context
+
+    def get_parameter_values(self, param_names=None, time_segment=None, **kwargs):
+        self.reads.append(time_segment)
+        times = self.times
+        if time_segment is not None:
+            lower, upper = time_segment
+            if lower is not None:
+                times = times[times >= lower]
+            if upper is not None:
+                times = times[times <= upper]
+        pv = Mock()
+        pv.get_data.return_value = {'time': times, 'temp': times * 2}
+        return pv
+
+@attr('UNIT', group='dm')
+class TestCoverageHandler(PyonTestCase):
+    def setUp(self):
+        self.handler = Handler('/tmp/mock')
+        self.handler.CHUNK_SIZE = 100
+        patcher = patch.object(TimeUtils, 'get_time_index', Mock(return_value=None))
+        self.get_time_index = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(ReplayProcess, '_time_bounds', Mock(side_effect=lambda cov, dataset_id=None: (cov.times[0], cov.times[-1])))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('ion.util.pydap.handlers.coverage.coverage_handler.CoveragePool')
+        self.pool = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_time_selectors_pushdown(self):
+        coverage = MockCoverage(np.arange(1000))
+        selectors = [self.handler.parse_selectors(s) for s in ['time>=100', 'time<200', 'temp>250']]
+        chunks = list(self.handler.iter_chunks(coverage, ['time', 'temp'], selectors))
+
+        times = np.concatenate([c['time'] for c in chunks])
+        np.testing.assert_array_equal(times, np.arange(126, 200))
+        for lower, upper in coverage.reads:
+            self.assertGreaterEqual(lower, 100)
+            self.assertLessEqual(upper, 200)
+
+    def test_windows_are_bounded(self):
+        coverage = MockCoverage(np.arange(1000))
+        chunks = list(self.handler.iter_chunks(coverage, ['time'], []))
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk['time']), 101)
+        np.testing.assert_array_equal(np.concatenate([c['time'] for c in chunks]), np.arange(1000))
+
+    def test_windows_from_time_index(self):
+        times = np.arange(1000, dtype='float64')
+        index = TimeIndex('dataset', block_size=50)
+        index.extend(times)
+        self.get_time_index.return_value = index
+
+        windows = list(self.handler.time_windows(MockCoverage(times), 120, 480, 'dataset'))
+        self.assertEquals(windows[0][0], 120)
+        self.assertEquals(windows[-1][1], 480)
+        coverage = MockCoverage(times)
+        chunks = [self.handler.read_window(coverage, ['time'], w)['time'] for w in windows]
+        np.testing.assert_array_equal(np.concatenate(chunks), np.arange(120, 481))
+
+    def test_get_dataset(self):
+        coverage = MockCoverage(np.arange(1000))
+        dataset = self.handler.get_dataset(coverage, ['data.time', 'temp'], [], ['data.time>990'], {}, 'dods')
+        records = list(dataset['data'].data)
+        self.assertEquals([r[1] for r in records], range(1982, 2000, 2))
+
+    def test_get_dataset_streams(self):
+        coverage = MockCoverage(np.arange(1000))
+        dataset = self.handler.get_dataset(coverage, ['time', 'temp'], [], [], {}, 'dods')
+        # Only the first window is read until the response is written
+        self.assertEquals(len(coverage.reads), 1)
+        records = dataset['data'].data
+        for i, record in enumerate(records):
+            if i == 150:
+                break
+        self.assertEquals(len(coverage.reads), 2)
+        self.assertEquals(len(list(records)) + 151, 1000)
+
+    def test_get_dataset_holds_coverage(self):
+        coverage = MockCoverage(np.arange(1000))
+        dataset = self.handler.get_dataset(coverage, ['time', 'temp'], [], [], {}, 'dods')
+        self.pool.retain.assert_called_once_with(coverage)
+        records = dataset['data'].data
+        next(records)
+        self.assertFalse(self.pool.release.called)
+        list(records)
+        self.pool.release.assert_called_once_with(coverage)
+
+        # A response that's never written still returns the coverage
+        dataset = self.handler.get_dataset(coverage, ['time', 'temp'], [], [], {}, 'dods')
+        dataset['data'].data.close()
+        self.assertEquals(self.pool.release.call_count, 2)
+
+    def test_request_too_large(self):
+        coverage = MockCoverage(np.arange(1000))
+        self.handler.REQUEST_LIMIT = 8 * 2 * 150 / 1024.**2
+        dataset = self.handler.get_dataset(coverage, ['time', 'temp'], [], [], {}, 'dods')
+        with self.assertRaises(RequestTooLargeError):
+            list(dataset['data'].data)
+        self.pool.release.assert_called_once_with(coverage)
+
+    def test_dataset_id_cache(self):
+        resource_registry = Mock()
+        resource_registry.find_objects.side_effect = lambda subject, *args, **kwargs: (['dataset_' + subject], None)
+        self.handler._dataset_ids.clear()
+        self.addCleanup(self.handler._dataset_ids.clear)
+        with patch('ion.util.pydap.handlers.coverage.coverage_handler.Container') as container, \
+                patch.object(Handler, 'CACHE_LIMIT', 2):
+            container.instance.resource_registry = resource_registry
+            self.assertEquals(Handler.get_dataset_id('a'), 'dataset_a')
+            Handler.get_dataset_id('b')
+            Handler.get_dataset_id('a')
+            Handler.get_dataset_id('c') # Evicts b
+            self.assertEquals(Handler._dataset_ids.keys(), ['a', 'c'])
+            Handler.get_dataset_id('a')
+            self.assertEquals(resource_registry.find_objects.call_count, 3)
+
+    def test_stringify(self):
+        data = np.empty(3, dtype='O')
+        data[0], data[1], data[2] = [1, 2], None, 'a'
+        self.assertEquals(self.handler.stringify(data).tolist(), ['[1, 2]', 'None', 'a'])
+
+        ndim = np.arange(6).reshape(3, 2)
+        self.assertEquals(self.handler.ndim_stringify(ndim).tolist(), ['0,1', '2,3', '4,5'])
+        self.assertEquals(self.handler.range_stringify(ndim).tolist(), ['0_1', '2_3', '4_5'])
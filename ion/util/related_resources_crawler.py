@@ -75,17 +75,17 @@ class RelatedResourcesCrawler(object):
                     """
                     retval = {}
 
-                    sto_match = lambda assn: assn.s == resource_id and assn.ot in resource_whitelist
-                    ots_match = lambda assn: assn.o == resource_id and assn.st in resource_whitelist
                     for p, (search_sto, search_ots) in predicate_dictionary.iteritems():
                         if search_sto:
-                            for a in RR2.filter_cached_associations(p, sto_match):
-                                log.trace("lookup_fn matched %s object", a.ot)
-                                retval[a.o] = a
+                            for a in RR2.find_cached_associations(p, subject=resource_id):
+                                if a.ot in resource_whitelist:
+                                    log.trace("lookup_fn matched %s object", a.ot)
+                                    retval[a.o] = a
                         if search_ots:
-                            for a in RR2.filter_cached_associations(p, ots_match):
-                                log.trace("lookup_fn matched %s subject", a.st)
-                                retval[a.s] = a
+                            for a in RR2.find_cached_associations(p, object=resource_id):
+                                if a.st in resource_whitelist:
+                                    log.trace("lookup_fn matched %s subject", a.st)
+                                    retval[a.s] = a
 
 
                     return retval
@@ -8,7 +8,7 @@
 from unittest.case import SkipTest
 from ion.services.sa.test.helpers import any_old
 
-from mock import Mock #, sentinel, patch
+from mock import Mock, patch #, sentinel
 from ion.util.enhanced_resource_registry_client import EnhancedResourceRegistryClient
 from nose.plugins.attrib import attr
 
@@ -553,3 +553,94 @@ class TestEnhancedResourceRegistryClient(PyonTestCase):
         self.assertEqual([d], results)
 
         self.assertEqual(0, self.rr.find_subjects.call_count)
+
+
+    def test_cached_predicate_index(self):
+        assns = []
+        for i in range(50):
+            assns.append(DotDict(s="p_%d" % (i % 5), st=RT.PlatformDevice, p=PRED.hasDevice, o="i_%d" % i, ot=RT.InstrumentDevice))
+            assns.append(DotDict(s="p_%d" % (i % 5), st=RT.PlatformDevice, p=PRED.hasDevice, o="c_%d" % (i % 7), ot=RT.PlatformDevice))
+
+        self.rr.find_associations.return_value = assns
+        self.RR2.cache_predicate(PRED.hasDevice)
+
+        # indexed lookups give the same results as a scan, in the same order
+        for s in ["p_%d" % i for i in range(6)]:
+            for ot in ["", RT.InstrumentDevice, RT.PlatformDevice]:
+                expected = [a.o for a in assns if a.s == s and ot in ("", a.ot)]
+                self.assertEqual(expected, self.RR2.find_objects(s, PRED.hasDevice, ot, True))
+        for o in ["c_%d" % i for i in range(8)]:
+            expected = [a.s for a in assns if a.o == o]
+            self.assertEqual(expected, self.RR2.find_subjects(RT.PlatformDevice, PRED.hasDevice, o, True))
+            self.assertEqual([], self.RR2.find_subjects(RT.InstrumentDevice, PRED.hasDevice, o, True))
+
+        self.assertEqual(len(assns) / 2,
+                         len(self.RR2.find_cached_associations(PRED.hasDevice, subject_type=RT.PlatformDevice, object_type=RT.InstrumentDevice)))
+        self.assertEqual(assns, self.RR2.get_cached_associations(PRED.hasDevice))
+
+        stats = self.RR2.cache_stats()
+        self.assertEqual(0, stats['misses'])
+        self.assertEqual(1.0, stats['hit_rate'])
+        self.assertEqual(0, self.rr.find_objects.call_count + self.rr.find_subjects.call_count)
+
+
+    def _patch_container(self, container):
+        mocks = []
+        for name in ('bootstrap', 'EventSubscriber'):
+            patcher = patch('ion.util.enhanced_resource_registry_client.%s' % name)
+            self.addCleanup(patcher.stop)
+            mocks.append(patcher.start())
+        mocks[0].container_instance = container
+        self.addCleanup(EnhancedResourceRegistryClient._shared_subscribers.clear)
+        self.addCleanup(EnhancedResourceRegistryClient._shared_predicates.clear)
+        return mocks
+
+    def test_shared_cache(self):
+        assn = DotDict(s="d_id", st=RT.InstrumentDevice, p=PRED.hasModel, o="m_id", ot=RT.InstrumentModel)
+        self.rr.find_associations.return_value = [assn]
+        container = Mock()
+        self._patch_container(container)
+
+        RR2a = EnhancedResourceRegistryClient(self.rr, shared_cache=True)
+        RR2b = EnhancedResourceRegistryClient(self.rr, shared_cache=True)
+        RR2a.cache_predicate(PRED.hasModel)
+        RR2b.cache_predicate(PRED.hasModel)
+        self.assertEqual(1, self.rr.find_associations.call_count)
+        self.assertEqual(1, RR2b.cache_stats()['shared_hits'])
+        self.assertEqual(["m_id"], RR2b.find_objects("d_id", PRED.hasModel, "", True))
+
+        # clients without the shared cache don't use it
+        self.RR2.cache_predicate(PRED.hasModel)
+        self.assertEqual(2, self.rr.find_associations.call_count)
+
+        # writes through any client drop the shared entry
+        self.RR2.delete_association("d_id", PRED.hasModel, "m_id")
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        self.assertEqual(3, self.rr.find_associations.call_count)
+
+        # as do resource modifications
+        EnhancedResourceRegistryClient._on_resource_modified(Mock(origin="d_id", origin_type=RT.InstrumentDevice, sub_type=""))
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        self.assertEqual(4, self.rr.find_associations.call_count)
+
+    def test_shared_cache_per_container(self):
+        self.rr.find_associations.return_value = []
+        old_container, new_container = Mock(), Mock()
+        bootstrap, subscriber = self._patch_container(old_container)
+
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        self.assertEqual(1, self.rr.find_associations.call_count)
+        self.assertEqual(1, subscriber.call_count)
+
+        # A restarted container subscribes again and doesn't see the old container's associations
+        bootstrap.container_instance = new_container
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        self.assertEqual(2, self.rr.find_associations.call_count)
+        self.assertEqual(2, subscriber.call_count)
+
+        # Without a container nothing is shared
+        bootstrap.container_instance = None
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        EnhancedResourceRegistryClient(self.rr, shared_cache=True).cache_predicate(PRED.hasModel)
+        self.assertEqual(4, self.rr.find_associations.call_count)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_time_index.py
+@test ion.util.time_index Unit test suite
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.core.exception import Conflict
+from ion.util.time_index import TimeIndex
+
+from mock import Mock
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+@attr('UNIT')
+class TestTimeIndex(PyonTestCase):
+    def setUp(self):
+        self.times = np.arange(0, 1000, 0.5)
+        self.index = TimeIndex('dataset', block_size=100)
+        for chunk in np.array_split(self.times, 37):
+            self.index.extend(chunk)
+        self.reads = []
+
+    def read_block(self, tmin, tmax):
+        self.reads.append((tmin, tmax))
+        return self.times[(self.times >= tmin) & (self.times <= tmax)]
+
+    def test_blocks(self):
+        self.assertEquals(len(self.index), len(self.times))
+        self.assertTrue(self.index.monotonic)
+        self.assertEquals(len(self.index.blocks), 20)
+        self.assertTrue(all(b[1] <= 100 for b in self.index.blocks))
+
+    def test_range(self):
+        start, stop = self.index.range(10.25, 700, self.read_block)
+        # At most one block read per bound
+        self.assertLessEqual(len(self.reads), 2)
+        for tmin, tmax in list(self.reads):
+            self.assertLessEqual(len(self.read_block(tmin, tmax)), 100)
+        np.testing.assert_array_equal(self.times[start:stop], self.times[(self.times >= 10.25) & (self.times <= 700)])
+        self.assertEquals(self.index.range(-10, -5, self.read_block), (0, 0))
+        self.assertEquals(self.index.range(5000, 6000, self.read_block), (len(self.times), len(self.times)))
+
+    def test_non_monotonic(self):
+        index = TimeIndex('dataset', block_size=100)
+        index.extend(np.arange(10.))
+        index.extend(np.arange(5.))
+        self.assertFalse(index.monotonic)
+        self.assertIsNone(index.range(1, 3, self.read_block))
+
+    def test_persistence(self):
+        object_store = Mock()
+        object_store.create_doc.return_value = ('dataset_time_index', '1')
+        self.index.persist(object_store)
+        doc = object_store.create_doc.call_args[0][0]
+        restored = TimeIndex.from_doc('dataset', doc)
+        self.assertEquals(restored.blocks, self.index.blocks)
+        self.assertTrue(restored.monotonic)
+
+    def test_repeated_boundary_times(self):
+        # The last time of each granule is repeated as the first of the next
+        times = np.concatenate([np.arange(i, i + 11) for i in xrange(0, 200, 10)]).astype('float64')
+        index = TimeIndex('dataset', block_size=11)
+        for chunk in np.split(times, 20):
+            index.extend(chunk)
+        self.assertTrue(index.monotonic)
+        self.assertEquals(len(index), len(times))
+        # No two blocks share a time
+        self.assertTrue(all(b[2] > a[3] for a, b in zip(index.blocks, index.blocks[1:])))
+
+        read_block = lambda tmin, tmax: times[(times >= tmin) & (times <= tmax)]
+        for start, end in ((10, 20), (10.5, 19.5), (0, 200), (30, 30), (-5, 5)):
+            lower, upper = index.range(start, end, read_block)
+            np.testing.assert_array_equal(times[lower:upper], times[(times >= start) & (times <= end)])
+
+    def test_shared_boundary_blocks(self):
+        # Blocks stored before repeated times were kept together
+        times = np.array([0, 5, 10, 10, 15, 20], dtype='float64')
+        index = TimeIndex('dataset', blocks=[[0, 3, 0., 10., True], [3, 3, 10., 20., True]])
+        self.assertTrue(index.monotonic)
+        read_block = lambda tmin, tmax: times[(times >= tmin) & (times <= tmax)]
+        self.assertEquals(index.range(10, 15, read_block), (2, 5))
+        self.assertEquals(index.range(12, 20, read_block), (4, 6))
+
+    def test_persist_conflict(self):
+        object_store = Mock()
+        object_store.update_doc.side_effect = Conflict('Revision mismatch')
+        self.index._rev = '1'
+        with self.assertRaises(Conflict):
+            self.index.persist(object_store)
+        # The stored index is never overwritten with our offsets
+        self.assertEquals(object_store.update_doc.call_count, 1)
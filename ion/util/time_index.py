@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+'''
+@file ion/util/time_index.py
+@description Sparse block index over the time axis of a dataset
+'''
+
+from pyon.core.exception import NotFound
+from pyon.util.log import log
+
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+class TimeIndex(object):
+    '''
+    A sparse index over the time axis of a dataset. Records are grouped into
+    blocks, in the order they were ingested, and each block keeps its offset,
+    length, minimum and maximum time and whether its values are sorted.
+
+    When every block is sorted and the blocks don't overlap, apart from
+    repeated times at their boundaries (monotonic data), lookups binary search the blocks and read at most one block's worth of
+    time values from the coverage. Otherwise the caller falls back to a full
+    scan of the time axis.
+
+    The ingestion worker extends the index with every granule it persists and
+    stores it in the object store as <dataset_id>_time_index.
+    '''
+    BLOCK_SIZE = 4096
+
+    def __init__(self, dataset_id, blocks=None, block_size=None):
+        self.dataset_id = dataset_id
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.blocks     = blocks or [] # [offset, count, tmin, tmax, sorted]
+        self._rev       = None
+        self._reindex()
+
+    def _reindex(self):
+        self._tmins = [b[2] for b in self.blocks]
+        self._tmaxs = [b[3] for b in self.blocks]
+        # Blocks may share a time at their boundary (repeated timestamps)
+        self.monotonic = all(b[4] for b in self.blocks) and \
+                all(self.blocks[i][2] >= self.blocks[i-1][3] for i in xrange(1, len(self.blocks)))
+
+    @classmethod
+    def doc_key(cls, dataset_id):
+        return '%s_time_index' % dataset_id
+
+    def __len__(self):
+        if not self.blocks:
+            return 0
+        offset, count = self.blocks[-1][:2]
+        return offset + count
+
+    #--------------------------------------------------------------------------------
+    # Updates
+    #--------------------------------------------------------------------------------
+
+    def extend(self, times):
+        '''
+        Appends the time values of newly ingested records
+        '''
+        times = np.asanyarray(times, dtype='float64').flatten()
+        i = 0
+        while i < len(times):
+            offset = len(self)
+            if self.blocks and self.blocks[-1][4] and times[i] == self.blocks[-1][3]:
+                # Repeated times stay in the block they started in, so a time
+                # segment read of a block doesn't pick up its neighbour's records
+                changed = times[i:] != times[i]
+                repeats = int(changed.argmax()) if changed.any() else len(times) - i
+                self.blocks[-1][1] += repeats
+                i += repeats
+                continue
+            if self.blocks and self.blocks[-1][4] and self.blocks[-1][1] < self.block_size:
+                # Fill up the last block if the values keep it sorted
+                last = self.blocks[-1]
+                chunk = times[i:i + self.block_size - last[1]]
+                if (np.diff(chunk) >= 0).all() and chunk[0] >= last[3]:
+                    last[1] += len(chunk)
+                    last[3] = float(chunk[-1])
+                    i += len(chunk)
+                    continue
+            chunk = times[i:i + self.block_size]
+            chunk_sorted = bool((np.diff(chunk) >= 0).all())
+            self.blocks.append([offset, len(chunk), float(chunk.min()), float(chunk.max()), chunk_sorted])
+            i += len(chunk)
+        self._reindex()
+
+    #--------------------------------------------------------------------------------
+    # Lookups
+    #--------------------------------------------------------------------------------
+
+    def range(self, start, end, read_block):
+        '''
+        Returns the (start, stop) slice of the records with start <= time <= end,
+        or None if the index can't answer.
+        '''
+        if not self.monotonic:
+            return None
+        if not self.blocks:
+            return (0, 0)
+        lower = self._search(start, 'left', read_block)
+        upper = self._search(end, 'right', read_block)
+        if lower is None or upper is None:
+            return None
+        return (lower, max(lower, upper))
+
+    def _search(self, value, side, read_block):
+        if side == 'left':
+            # First block that reaches value
+            i = bisect_left(self._tmaxs, value)
+            if i == len(self.blocks):
+                return len(self)
+            offset, count, tmin, tmax, _ = self.blocks[i]
+            if value <= tmin:
+                return offset
+        else:
+            # Last block that starts at or before value
+            i = bisect_right(self._tmins, value) - 1
+            if i < 0:
+                return 0
+            offset, count, tmin, tmax, _ = self.blocks[i]
+            if value >= tmax:
+                return offset + count
+        values = self._read(read_block, i)
+        if values is None:
+            return None
+        return offset + int(np.searchsorted(values, value, side=side))
+
+    def _read(self, read_block, i):
+        '''
+        Reads the time values of the i-th block. The time segment also returns
+        the records of the neighbouring blocks that share its boundary times,
+        those are trimmed off.
+        '''
+        offset, count, tmin, tmax, _ = self.blocks[i]
+        values = np.asanyarray(read_block(tmin, tmax))
+        extra = len(values) - count
+        if extra > 0:
+            shares_min = i > 0 and self.blocks[i-1][3] == tmin
+            shares_max = i + 1 < len(self.blocks) and self.blocks[i+1][2] == tmax
+            if tmin == tmax or (shares_max and not shares_min):
+                values = values[:count]
+            elif shares_min and not shares_max:
+                values = values[extra:]
+            # Otherwise there's no telling which end the extra records are on
+        if len(values) != count:
+            log.warning('Time index for dataset %s is inconsistent with the coverage', self.dataset_id)
+            return None
+        return values
+
+    #--------------------------------------------------------------------------------
+    # Persistence
+    #--------------------------------------------------------------------------------
+
+    def to_doc(self):
+        return {'block_size': self.block_size, 'blocks': self.blocks}
+
+    @classmethod
+    def from_doc(cls, dataset_id, doc):
+        index = cls(dataset_id, blocks=[list(b) for b in doc['blocks']], block_size=doc['block_size'])
+        index._rev = doc.get('_rev')
+        return index
+
+    @classmethod
+    def read(cls, object_store, dataset_id):
+        try:
+            doc = object_store.read_doc(cls.doc_key(dataset_id))
+        except NotFound:
+            return None
+        return cls.from_doc(dataset_id, doc)
+
+    def persist(self, object_store):
+        '''
+        Stores the index, raises Conflict if another writer updated it since it
+        was read; the blocks can't be merged because both writers numbered their
+        records from the same offset.
+        '''
+        doc = self.to_doc()
+        if self._rev is None:
+            _, self._rev = object_store.create_doc(doc, object_id=self.doc_key(self.dataset_id))
+            return
+        doc['_id'] = self.doc_key(self.dataset_id)
+        doc['_rev'] = self._rev
+        _, self._rev = object_store.update_doc(doc)
+
+
+def time_windows(index, start, end, window_records, num_timesteps, time_bounds):
+    '''
+    Splits [start, end] into inclusive time segments of about window_records
+    records, either bound may be None. The blocks of the time index are used
+    when it's monotonic, otherwise time_bounds() returns the (min, max) of the
+    dataset and its span is divided evenly over num_timesteps records.
+    '''
+    if start is not None and end is not None and start > end:
+        return
+    if index is not None and index.monotonic and index.blocks:
+        lower, records = None, 0
+        for offset, count, tmin, tmax, _ in index.blocks:
+            if (start is not None and tmax < start) or (end is not None and tmin > end):
+                continue
+            if lower is None:
+                lower = tmin if start is None else max(tmin, start)
+            records += count
+            upper = tmax if end is None else min(tmax, end)
+            if records >= window_records:
+                yield (lower, upper)
+                # Blocks can share a time at their boundary
+                start = np.nextafter(upper, np.inf)
+                lower, records = None, 0
+        if lower is not None:
+            yield (lower, upper)
+        return
+
+    if num_timesteps <= window_records:
+        yield (start, end)
+        return
+    bounds = time_bounds()
+    if bounds is None:
+        return # Empty dataset
+    lower = bounds[0] if start is None else max(bounds[0], start)
+    upper = bounds[1] if end is None else min(bounds[1], end)
+    windows = int(np.ceil(num_timesteps / float(window_records)))
+    step = (bounds[1] - bounds[0]) / float(windows)
+    while lower <= upper:
+        window_end = min(lower + step, upper)
+        yield (lower, window_end)
+        # time_segment is inclusive of both ends
+        lower = np.nextafter(window_end, np.inf)
@@ -5,6 +5,9 @@ import time
 import netCDF4
 import numpy as np
 
+from pyon.container.cc import Container
+from ion.util.time_index import TimeIndex
+
 class TimeUtils(object):
 
     @classmethod
@@ -21,6 +24,19 @@ class TimeUtils(object):
         values = coverage.get_parameter_values(time_name)
         return cls.find_nearest(values,time)
 
+    @classmethod
+    def get_time_index(cls, dataset_id):
+        if not dataset_id or Container.instance is None:
+            return None
+        return TimeIndex.read(Container.instance.object_store, dataset_id)
+
+    @classmethod
+    def _block_reader(cls, coverage):
+        time_name = coverage.temporal_parameter_name
+        def read_block(tmin, tmax):
+            return coverage.get_parameter_values([time_name], time_segment=(tmin, tmax), fill_empty_params=True).get_data()[time_name]
+        return read_block
+
     @classmethod
     def ts_to_units(cls,units, val):
         '''